@@ -0,0 +1,202 @@
+import pandas as pd
+import numpy as np
+import operator
+from sqlalchemy import text
+from storage import dialect_text
+
+
+
+
+#######################################################################################
+############################### ALERT RULES: ##########################################
+#######################################################################################
+
+# Rules are plain parameter sets evaluated together against one AlertSnapshot (2 queries, however many rules there are).
+# Every rule returns one row per subject ('portfolio' or a ticker) telling whether its condition holds right now.
+# The state of each (rule, subject) is kept in alert_state, so a message is sent once when the condition starts to hold
+# and the rule is re-armed after the condition stops holding.
+#
+# Messages are format strings filled with the subject's snapshot fields (see AlertSnapshot).
+
+PORTFOLIO = 'portfolio'
+
+COMPARISONS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+
+class ThresholdRule:
+
+    # A portfolio_daily field compared with a fixed value, e.g. total_profit > 500
+    def __init__(self, name, field, comparison, value, message):
+        self.name = name
+        self.field = field
+        self.comparison = COMPARISONS[comparison]
+        self.value = value
+        self.message = message
+
+    def evaluate(self, snapshot):
+        portfolio = snapshot.portfolio
+        active = portfolio is not None and pd.notna(portfolio[self.field]) and bool(self.comparison(portfolio[self.field], self.value))
+        return rule_results([PORTFOLIO], [active], [portfolio])
+
+
+class DrawdownRule:
+
+    # The time-weighted return fell at least 'max_drawdown' (0.1 = 10%) below its highest value so far. Measured on
+    # portfolio_analytics, so buys & sales don't move it - only price changes do
+    def __init__(self, name, max_drawdown, message):
+        self.name = name
+        self.max_drawdown = max_drawdown
+        self.message = message
+
+    def evaluate(self, snapshot):
+        portfolio = snapshot.portfolio
+        active = portfolio is not None and pd.notna(portfolio['drawdown']) and bool(portfolio['drawdown'] >= self.max_drawdown)
+        return rule_results([PORTFOLIO], [active], [portfolio])
+
+
+class DailyMoveRule:
+
+    # A stock's end price moved at least 'max_move' % (up or down) since its previous record
+    def __init__(self, name, max_move, message):
+        self.name = name
+        self.max_move = max_move
+        self.message = message
+
+    def evaluate(self, snapshot):
+        stocks = snapshot.stocks
+        return rule_results(stocks['ticker'], (stocks['move'].abs() >= self.max_move).to_numpy(), stocks.to_dict('records'))
+
+
+class PositionWeightRule:
+
+    # A stock makes up more than 'max_weight' (0.3 = 30%) of the portfolio value
+    def __init__(self, name, max_weight, message):
+        self.name = name
+        self.max_weight = max_weight
+        self.message = message
+
+    def evaluate(self, snapshot):
+        stocks = snapshot.stocks
+        return rule_results(stocks['ticker'], (stocks['weight'] > self.max_weight).to_numpy(), stocks.to_dict('records'))
+
+
+def rule_results(subjects, active, fields):
+    return pd.DataFrame({'subject': list(subjects), 'active': np.asarray(active, dtype=bool), 'fields': list(fields)})
+
+
+
+# Rule registry - add, remove or tune rules here:
+ALERT_RULES = [
+    ThresholdRule('tax_free_profit', 'total_profit', '>', 500,
+                  'TAX FREE PROFIT ALERT: you can only cash out 500 euros per year without paying taxes.'),
+    DrawdownRule('drawdown_10', 0.10,
+                 'DRAWDOWN ALERT: the time-weighted return is {drawdown:.1%} below its peak (portfolio value {total_value:.2f}).'),
+    DailyMoveRule('daily_move_5', 5.0,
+                  'PRICE MOVE ALERT: {name} ({ticker}) moved {move:+.2f}% to {end_price:.2f}.'),
+    PositionWeightRule('position_weight_30', 0.30,
+                       'CONCENTRATION ALERT: {name} ({ticker}) is {weight:.1%} of the portfolio value.'),
+]
+
+
+
+#######################################################################################
+############################### SNAPSHOT & EVALUATION: ################################
+#######################################################################################
+
+
+class AlertSnapshot:
+
+    # portfolio - latest portfolio_daily row + twr, twr_peak & drawdown of the latest portfolio_analytics day up to it
+    #             (NaN before the analytics are computed), None if empty
+    # stocks    - latest portfolio_history record of every stock: ticker, name, end_price, prev_price, move (%),
+    #             value, profit & weight (share of the day's total value)
+    def __init__(self, portfolio, stocks):
+        self.portfolio = portfolio
+        self.stocks = stocks
+
+
+    @classmethod
+    def load(cls, connection):
+        portfolio = pd.read_sql(sql_alert_portfolio, connection)
+        stocks = pd.read_sql(sql_alert_stocks, connection)
+
+        if portfolio.empty:
+            portfolio = None
+        else:
+            portfolio = portfolio.astype({'twr': float, 'twr_peak': float, 'drawdown': float}).iloc[0].to_dict()
+
+        stocks = stocks.astype({'end_price': float, 'prev_price': float, 'value': float, 'profit': float})
+        stocks['move'] = ((stocks['end_price'] - stocks['prev_price']) * 100 / stocks['prev_price']).fillna(0)
+        total_value = stocks['value'].sum()
+        stocks['weight'] = stocks['value'] / total_value if total_value else 0.0
+
+        return cls(portfolio, stocks)
+
+
+sql_alert_portfolio = text('''
+                SELECT latest.*, pa.twr, pa.twr_peak, pa.drawdown
+                FROM (SELECT * FROM portfolio_daily ORDER BY dt DESC LIMIT 1) latest
+                LEFT JOIN portfolio_analytics pa                -- trading days only, a weekend takes Friday's
+                    ON pa.dt = (SELECT MAX(dt) FROM portfolio_analytics WHERE dt <= latest.dt)''')
+
+sql_alert_stocks = dialect_text('''
+                SELECT ph.ticker, ph.name, ph.end_price, prev.end_price AS prev_price, ph.value, ph.profit
+                FROM portfolio_history ph
+                LEFT JOIN LATERAL (
+                    SELECT p.end_price
+                    FROM portfolio_history p
+                    WHERE p.id = ph.id AND p.dt < ph.dt
+                    ORDER BY p.dt DESC
+                    LIMIT 1
+                ) prev ON TRUE
+                WHERE ph.dt = (SELECT MAX(dt) FROM portfolio_history)''', sqlite='''
+                SELECT ph.ticker, ph.name, ph.end_price,
+                    (
+                        SELECT p.end_price
+                        FROM portfolio_history p
+                        WHERE p.id = ph.id AND p.dt < ph.dt
+                        ORDER BY p.dt DESC
+                        LIMIT 1
+                    ) AS prev_price,
+                    ph.value, ph.profit
+                FROM portfolio_history ph
+                WHERE ph.dt = (SELECT MAX(dt) FROM portfolio_history)''')
+
+sql_alert_state = text('''
+                SELECT rule, subject, active FROM alert_state''')
+
+sql_upsert_alert_state = text('''
+                INSERT INTO alert_state (rule, subject, active, changed_dt)
+                VALUES (:rule, :subject, :active, :changed_dt)
+                ON CONFLICT (rule, subject) DO UPDATE
+                SET active = EXCLUDED.active,
+                    changed_dt = EXCLUDED.changed_dt''')
+
+
+def evaluate_alerts(connection, rules=None, dt=None, snapshot=None):
+    # Evaluates every rule against one snapshot (the latest stored records unless one is given, e.g. the intraday valuation),
+    # stores the state changes & returns the messages of newly crossed rules
+    rules = ALERT_RULES if rules is None else rules
+    snapshot = AlertSnapshot.load(connection) if snapshot is None else snapshot
+    if not rules:
+        return []
+
+    results = pd.concat([rule.evaluate(snapshot).assign(rule=rule.name) for rule in rules], ignore_index=True)
+    if results.empty:
+        return []
+
+    state = pd.read_sql(sql_alert_state, connection)
+    results = results.merge(state.rename(columns={'active': 'was_active'}), on=['rule', 'subject'], how='left')
+    was_active = results['was_active'].astype('boolean').fillna(False).to_numpy(dtype=bool)
+
+    # Fire on the crossing only, store rules whose state changed (or that were never seen before)
+    changed = results[(results['active'].to_numpy() != was_active) | results['was_active'].isna().to_numpy()]
+    if not changed.empty:
+        dt = dt or (snapshot.portfolio['dt'] if snapshot.portfolio is not None else None)
+        connection.execute(sql_upsert_alert_state, [
+            {'rule': rule, 'subject': subject, 'active': bool(active), 'changed_dt': dt}
+            for rule, subject, active in changed[['rule', 'subject', 'active']].itertuples(index=False)])
+
+    messages = {rule.name: rule.message for rule in rules}
+    fired = results[results['active'].to_numpy() & ~was_active]
+    return [messages[rule].format(**fields) for rule, fields in fired[['rule', 'fields']].itertuples(index=False)]
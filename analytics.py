@@ -0,0 +1,382 @@
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+from sqlalchemy import text
+import functions as f
+from price_providers import daily_closes
+
+
+
+
+#######################################################################################
+############################### RISK & PERFORMANCE ANALYTICS: #########################
+#######################################################################################
+
+# Risk & performance figures of the whole portfolio, one portfolio_analytics row per trading day (Mon-Fri, history rows of
+# weekends only carry Friday's close):
+#   daily_return     - (value - net cash flow of the day) / previous day's value - 1, cash flows are the buys in 'changes'
+#                      & the sale proceeds in realized_gains, changes of non trading days count on the next trading day
+#   twr              - time-weighted return as a growth index (1 = first day), drawdown & max_drawdown are measured on it,
+#                      so deposits & withdrawals don't show up as gains or losses
+#   volatility, sharpe, sortino, beta - over the last 'window' trading days, annualized with TRADING_DAYS,
+#                      beta against the daily returns of a benchmark ticker (fetched like the stock prices)
+#
+# The daily run only computes the new days: the rolling sums are taken over the returns still inside the window
+# (read back from the last 'window' stored rows) plus the new ones, the running twr, peak & max drawdown continue
+# from the last row. Backfill & replay delete the rows from the first changed day on, the next update recomputes them.
+#
+# Sale proceeds only exist in realized_gains. Sales without a record there (made before the table existed) would count as
+# losses of the sold value, so nothing is computed while there are any: 'python main.py replay' once writes their records.
+#
+# The stock correlation matrix of the Telegram summary is computed on demand from the date x stock price matrix.
+
+TRADING_DAYS = 252
+MIN_PERIODS = 20                   # returns needed before a rolling figure or a correlation is reported
+
+ANALYTICS_COLUMNS = ['dt', 'net_flow', 'daily_return', 'benchmark_return', 'twr', 'twr_peak', 'drawdown', 'max_drawdown',
+                     'volatility', 'sharpe', 'sortino', 'beta']
+
+
+sql_analytics_state = text('''
+                SELECT dt, daily_return, benchmark_return, twr, twr_peak, max_drawdown
+                FROM portfolio_analytics
+                ORDER BY dt DESC
+                LIMIT :window''')
+
+sql_first_history_dt = text('''
+                SELECT MIN(dt) FROM portfolio_history''')
+
+sql_analytics_history = text('''
+                SELECT id, ticker, dt, end_price, value
+                FROM portfolio_history
+                WHERE dt >= :start''')
+
+sql_analytics_flows = text('''
+                SELECT dt, shares_bought_sold * purchase_price AS flow
+                FROM changes
+                WHERE shares_bought_sold > 0
+                    AND dt > :after
+                UNION ALL
+                SELECT dt, -shares_sold * sale_price AS flow
+                FROM realized_gains
+                WHERE dt > :after''')
+
+sql_sales_without_proceeds = text('''
+                SELECT COUNT(*)
+                FROM changes c
+                WHERE c.shares_bought_sold <= 0
+                    AND c.dt > :after
+                    AND NOT EXISTS
+                    (
+                        SELECT 1 FROM realized_gains rg
+                        WHERE rg.stock_id = c.stock_id
+                            AND rg.dt = c.dt
+                    )''')
+
+sql_delete_analytics = text('''
+                DELETE FROM portfolio_analytics
+                WHERE dt >= :from_dt''')
+
+sql_latest_analytics = text('''
+                SELECT a.*, first.first_dt
+                FROM (SELECT * FROM portfolio_analytics ORDER BY dt DESC LIMIT 1) a
+                CROSS JOIN (SELECT MIN(dt) AS first_dt FROM portfolio_analytics) first''')
+
+
+def to_date(value):
+    return None if value is None else datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+
+#######################################################################################
+############################### DATE x STOCK MATRIX: ##################################
+#######################################################################################
+
+
+class HistoryMatrix:
+
+    # portfolio_history of the trading days from 'start' on as dense arrays:
+    #   dates   - sorted trading days (datetime.date)
+    #   tickers - one column per stock id
+    #   prices, values - date x stock end prices & values, NaN where the stock has no record that day
+    def __init__(self, dates, tickers, prices, values):
+        self.dates = dates
+        self.tickers = tickers
+        self.prices = prices
+        self.values = values
+
+
+    @classmethod
+    def load(cls, connection, start):
+        history = pd.read_sql(sql_analytics_history, connection, params={'start': start})
+        dt = pd.to_datetime(history['dt'])
+        history = history[(dt.dt.weekday < 5).to_numpy()]
+        dt = pd.to_datetime(history['dt'])
+
+        date_codes, dates = pd.factorize(dt, sort=True)
+        id_codes, ids = pd.factorize(history['id'], sort=True)
+        tickers = history.drop_duplicates(subset='id', keep='last').set_index('id')['ticker'].reindex(ids).to_numpy()
+
+        prices = np.full((len(dates), len(ids)), np.nan)
+        values = np.full((len(dates), len(ids)), np.nan)
+        prices[date_codes, id_codes] = history['end_price'].astype(float).to_numpy()
+        values[date_codes, id_codes] = history['value'].astype(float).to_numpy()
+        return cls([dt.date() for dt in dates], tickers, prices, values)
+
+
+    def total_values(self):
+        return np.nansum(self.values, axis=1)
+
+
+    def net_flows(self, flows):
+        # Cash flows ['dt', 'flow'] summed per trading day, each counted on the first trading day on or after its date
+        # (flows after the last day are left for the next update)
+        net_flows = np.zeros(len(self.dates))
+        position = np.searchsorted(np.array(self.dates, dtype='datetime64[D]'), pd.to_datetime(flows['dt']).to_numpy(dtype='datetime64[D]'))
+        inside = position < len(self.dates)
+        np.add.at(net_flows, position[inside], flows['flow'].astype(float).to_numpy()[inside])
+        return net_flows
+
+
+    def portfolio_returns(self, net_flows):
+        # Day over day return of the whole portfolio net of the day's cash flows, NaN for the first day & after empty days
+        totals = self.total_values()
+        returns = np.full(len(totals), np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns[1:] = np.where(totals[:-1] > 0, (totals[1:] - net_flows[1:]) / totals[:-1] - 1, np.nan)
+        return returns
+
+
+    def stock_returns(self):
+        # date x stock price returns, NaN where a stock has no record on either day
+        returns = np.full(self.prices.shape, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns[1:] = self.prices[1:] / self.prices[:-1] - 1
+        return returns
+
+
+
+#######################################################################################
+############################### ROLLING STATISTICS: ###################################
+#######################################################################################
+
+
+def rolling_sum(x, window):
+    # Sum of the last 'window' values at every position (fewer at the start), from one cumulative sum
+    cumulative = np.concatenate([[0.0], np.cumsum(x)])
+    end = np.arange(1, len(x) + 1)
+    return cumulative[end] - cumulative[np.maximum(end - window, 0)]
+
+
+def rolling_statistics(returns, benchmark_returns, window, risk_free_rate=0.0):
+    # Annualized volatility, Sharpe & Sortino ratios and beta of the window ending at every position, NaN below MIN_PERIODS
+    risk_free = (1 + risk_free_rate) ** (1 / TRADING_DAYS) - 1
+    valid = ~np.isnan(returns)
+    r = np.where(valid, returns, 0.0)
+    pair = valid & ~np.isnan(benchmark_returns)
+    rp, bp = np.where(pair, returns, 0.0), np.where(pair, benchmark_returns, 0.0)
+
+    n = rolling_sum(valid, window)
+    total = rolling_sum(r, window)
+    squares = rolling_sum(r * r, window)
+    downside = rolling_sum(np.where(valid, np.minimum(r - risk_free, 0.0) ** 2, 0.0), window)
+    pairs = rolling_sum(pair, window)
+    r_pair, b_pair = rolling_sum(rp, window), rolling_sum(bp, window)
+    rb, bb = rolling_sum(rp * bp, window), rolling_sum(bp * bp, window)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / n
+        std = np.sqrt(np.maximum(squares - total * mean, 0.0) / (n - 1))
+        statistics = {
+            'volatility': std * np.sqrt(TRADING_DAYS),
+            'sharpe': (mean - risk_free) / std * np.sqrt(TRADING_DAYS),
+            'sortino': (mean - risk_free) / np.sqrt(downside / n) * np.sqrt(TRADING_DAYS),
+            'beta': (rb - r_pair * b_pair / pairs) / (bb - b_pair * b_pair / pairs),
+        }
+
+    for name, values in statistics.items():
+        enough = (pairs if name == 'beta' else n) >= MIN_PERIODS
+        statistics[name] = np.where(enough & np.isfinite(values), values, np.nan)
+    return statistics
+
+
+def correlation_matrix(returns, min_periods=MIN_PERIODS):
+    # Pairwise correlation of the columns over the rows where both are known, from a few matrix products
+    valid = ~np.isnan(returns)
+    x = np.where(valid, returns, 0.0)
+    mask = valid.astype(float)
+
+    n = mask.T @ mask
+    sums = x.T @ mask                              # sums[i, j] - column i over the rows where j is known too
+    squares = (x * x).T @ mask
+    products = x.T @ x
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = products - sums * sums.T / n
+        variance = squares - sums * sums / n
+        correlation = covariance / np.sqrt(variance * variance.T)
+    return np.where((n >= min_periods) & np.isfinite(correlation), np.clip(correlation, -1, 1), np.nan)
+
+
+
+#######################################################################################
+############################### INCREMENTAL UPDATE: ###################################
+#######################################################################################
+
+
+class AnalyticsState:
+
+    # The last 'window' stored rows: returns still inside the rolling window, running twr, peak & max drawdown
+    def __init__(self, dts, returns, benchmark_returns, twr=1.0, twr_peak=1.0, max_drawdown=0.0):
+        self.dts = dts
+        self.returns = returns
+        self.benchmark_returns = benchmark_returns
+        self.twr = twr
+        self.twr_peak = twr_peak
+        self.max_drawdown = max_drawdown
+
+
+    @classmethod
+    def load(cls, connection, window):
+        rows = pd.read_sql(sql_analytics_state, connection, params={'window': window}).iloc[::-1]
+        if rows.empty:
+            return cls([], np.array([]), np.array([]))
+        last = rows.iloc[-1]
+        return cls([to_date(dt) for dt in rows['dt']], rows['daily_return'].astype(float).to_numpy(),
+                   rows['benchmark_return'].astype(float).to_numpy(), float(last['twr']), float(last['twr_peak']), float(last['max_drawdown']))
+
+
+    @property
+    def last_dt(self):
+        return self.dts[-1] if self.dts else None
+
+
+    def advance(self, dts, returns, benchmark_returns, window, risk_free_rate=0.0):
+        # Rows of the new days 'dts' with their returns, continuing the stored state
+        statistics = rolling_statistics(np.concatenate([self.returns, returns]),
+                                        np.concatenate([self.benchmark_returns, benchmark_returns]), window, risk_free_rate)
+
+        twr = self.twr * np.cumprod(1 + np.nan_to_num(returns))
+        twr_peak = np.maximum(self.twr_peak, np.maximum.accumulate(twr))
+        drawdown = 1 - twr / twr_peak
+        max_drawdown = np.maximum(self.max_drawdown, np.maximum.accumulate(drawdown))
+
+        rows = pd.DataFrame({'dt': dts, 'daily_return': returns, 'benchmark_return': benchmark_returns, 'twr': twr,
+                             'twr_peak': twr_peak, 'drawdown': drawdown, 'max_drawdown': max_drawdown})
+        for name, values in statistics.items():
+            rows[name] = values[len(self.returns):]
+
+        self.dts = (self.dts + list(dts))[-window:]
+        self.returns = np.concatenate([self.returns, returns])[-window:]
+        self.benchmark_returns = np.concatenate([self.benchmark_returns, benchmark_returns])[-window:]
+        self.twr, self.twr_peak, self.max_drawdown = float(twr[-1]), float(twr_peak[-1]), float(max_drawdown[-1])
+        return rows
+
+
+def benchmark_returns(price_provider, benchmark, dates):
+    # Daily returns of the benchmark on the given trading days, NaN without a benchmark or its prices
+    if not benchmark or price_provider is None or len(dates) < 2:
+        return np.full(len(dates), np.nan)
+    closes = daily_closes(price_provider, [benchmark], dates[0], dates[-1]).droplevel('ticker')
+    closes = closes.reindex(dates).to_numpy(dtype=float)
+    returns = np.full(len(dates), np.nan)
+    returns[1:] = closes[1:] / closes[:-1] - 1
+    return returns
+
+
+def update_analytics(connection, price_provider=None, benchmark=None, window=TRADING_DAYS, risk_free_rate=0.0):
+    # Appends the trading days of portfolio_history after the last portfolio_analytics row, returns the rows written
+    state = AnalyticsState.load(connection, window)
+    start = state.last_dt or to_date(connection.execute(sql_first_history_dt).scalar())
+    if start is None:
+        return 0
+
+    missing_sales = connection.execute(sql_sales_without_proceeds, {'after': start}).scalar()
+    if missing_sales:
+        print(f"Warning: portfolio_analytics not updated - {missing_sales} sales in changes have no realized_gains record "
+              f"(their proceeds would count as losses), run 'python main.py replay' once to write them")
+        return 0
+
+    # The last stored day (or the first history day) is loaded too, as the base of the first new return
+    matrix = HistoryMatrix.load(connection, start)
+    flows = pd.read_sql(sql_analytics_flows, connection, params={'after': start})
+    net_flows = matrix.net_flows(flows)
+    returns = matrix.portfolio_returns(net_flows)
+    benchmark_daily = benchmark_returns(price_provider, benchmark, matrix.dates)
+
+    new = np.array([state.last_dt is None or dt > state.last_dt for dt in matrix.dates], dtype=bool)
+    if not new.any():
+        return 0
+
+    dts = [dt for dt, is_new in zip(matrix.dates, new) if is_new]
+    rows = state.advance(dts, returns[new], benchmark_daily[new], window, risk_free_rate)
+    rows['net_flow'] = net_flows[new]
+
+    connection.execute(sql_delete_analytics, {'from_dt': dts[0]})
+    f.copy_rows(connection, 'portfolio_analytics', rows[ANALYTICS_COLUMNS])
+    return len(rows)
+
+
+def invalidate_analytics(connection, from_dt=None):
+    # Deletes the rows from 'from_dt' on (all without one) after portfolio_history changed, the next update recomputes them
+    return connection.execute(sql_delete_analytics, {'from_dt': from_dt or datetime.min.date()}).rowcount
+
+
+
+#######################################################################################
+############################### SUMMARY: ##############################################
+#######################################################################################
+
+
+def percent(value, signed=False):
+    if value is None or pd.isna(value):
+        return 'n/a'
+    return f'{value:+.1%}' if signed else f'{value:.1%}'
+
+
+def ratio(value):
+    return 'n/a' if value is None or pd.isna(value) else f'{value:.2f}'
+
+
+def top_correlation(connection, last_dt, window=TRADING_DAYS):
+    # Most correlated pair of the held stocks & the mean pairwise correlation over the last 'window' trading days
+    matrix = HistoryMatrix.load(connection, last_dt - timedelta(days=window * 7 // 5 + 7))
+    held = matrix.values[-1] > 0 if len(matrix.dates) else np.array([], dtype=bool)
+    if held.sum() < 2:
+        return None
+
+    correlation = correlation_matrix(matrix.stock_returns()[-window:, held])
+    first, second = np.triu_indices(len(correlation), 1)
+    pairs = correlation[first, second]
+    if np.isnan(pairs).all():
+        return None
+    best = np.nanargmax(pairs)
+    tickers = matrix.tickers[held]
+    return tickers[first[best]], tickers[second[best]], pairs[best], np.nanmean(pairs)
+
+
+def analytics_summary(connection, benchmark=None, window=TRADING_DAYS, risk_free_rate=0.0):
+    # Lines of the Telegram summary from the latest portfolio_analytics row & the current correlations
+    latest = pd.read_sql(sql_latest_analytics, connection)
+    if latest.empty:
+        return []
+    latest = latest.iloc[0]
+    last_dt, first_dt = to_date(latest['dt']), to_date(latest['first_dt'])
+
+    twr = latest['twr'] - 1
+    years = (last_dt - first_dt).days / 365.25
+    annualized = f", {percent(latest['twr'] ** (1 / years) - 1, signed=True)} p.a." if years >= 1 else ''
+
+    lines = [f'Risk & Performance (last {window} trading days):',
+             f'Time-weighted return: {percent(twr, signed=True)} since {first_dt}{annualized}',
+             f"Volatility: {percent(latest['volatility'])} p.a.",
+             f"Max drawdown: {percent(latest['max_drawdown'])} (current {percent(latest['drawdown'])})",
+             f"Sharpe: {ratio(latest['sharpe'])}, Sortino: {ratio(latest['sortino'])} (risk free {risk_free_rate:.1%})"]
+    if benchmark:
+        lines.append(f"Beta vs {benchmark}: {ratio(latest['beta'])}")
+
+    correlation = top_correlation(connection, last_dt, window)
+    if correlation is not None:
+        first, second, highest, mean = correlation
+        lines.append(f'Highest correlation: {first} / {second} {highest:.2f} (mean {mean:.2f})')
+    return lines
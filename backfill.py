@@ -0,0 +1,232 @@
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import text
+import functions as f
+import analytics
+from storage import dialect_text
+from price_providers import daily_closes
+
+
+
+
+#######################################################################################
+############################### HISTORY BACKFILL: #####################################
+#######################################################################################
+
+# Fills the days missing from portfolio_history, e.g. after missed runs or deleted periods:
+#   1) every (stock, day) held according to positions (shares > 0) within [from_dt; to_dt] without a history record is a gap
+#   2) the missing days are split into date chunks of 'chunk_days'
+#   3) chunks are fetched in parallel (only the tickers missing in the chunk, plus 'lookback_days' before it to carry
+#      the last close into weekends & holidays) and each chunk is inserted in its own transaction
+#   4) portfolio_daily is recomputed from the first filled day on, portfolio_analytics is deleted from it on (see analytics.py)
+# Inserts skip (id, dt) pairs that already exist, so an interrupted backfill can simply be run again.
+
+
+sql_missing_history_days = dialect_text('''
+                WITH held AS
+                (
+                    SELECT
+                        id,
+                        ticker,
+                        shares,
+                        dt AS from_dt,
+                        LEAD(dt) OVER (PARTITION BY id ORDER BY dt) AS next_dt
+                    FROM positions
+                )
+                SELECT held.id, held.ticker, CAST(days.dt AS DATE) AS dt
+                FROM held
+                CROSS JOIN LATERAL generate_series(
+                    GREATEST(held.from_dt, CAST(:from_dt AS DATE)),
+                    LEAST(held.next_dt - 1, CAST(:to_dt AS DATE)),
+                    INTERVAL '1 day'
+                ) AS days (dt)
+                WHERE held.shares > 0
+                    AND NOT EXISTS                         -- index lookup on portfolio_history (id, dt)
+                    (
+                        SELECT 1 FROM portfolio_history ph
+                        WHERE ph.id = held.id
+                            AND ph.dt = CAST(days.dt AS DATE)
+                    )
+                ORDER BY held.id, dt''', sqlite='''
+                WITH RECURSIVE held AS
+                (
+                    SELECT
+                        id,
+                        ticker,
+                        shares,
+                        dt AS from_dt,
+                        LEAD(dt) OVER (PARTITION BY id ORDER BY dt) AS next_dt
+                    FROM positions
+                ),
+                days (id, ticker, dt, last_dt) AS            -- date series of every held period (no generate_series)
+                (
+                    SELECT id, ticker, MAX(from_dt, COALESCE(:from_dt, from_dt)), MIN(COALESCE(DATE(next_dt, '-1 day'), :to_dt), :to_dt)
+                    FROM held
+                    WHERE shares > 0
+                    UNION ALL
+                    SELECT id, ticker, DATE(dt, '+1 day'), last_dt
+                    FROM days
+                    WHERE dt < last_dt
+                )
+                SELECT days.id, days.ticker, days.dt
+                FROM days
+                WHERE days.dt <= days.last_dt
+                    AND NOT EXISTS
+                    (
+                        SELECT 1 FROM portfolio_history ph
+                        WHERE ph.id = days.id
+                            AND ph.dt = days.dt
+                    )
+                ORDER BY days.id, days.dt''')
+
+sql_insert_backfill = dialect_text('''
+                INSERT INTO portfolio_history (id, name, ticker, end_price, shares, value, invested, profit, dt)
+                SELECT
+                    s.id,
+                    s.name,
+                    s.ticker,
+                    new.end_price,
+                    p.shares,
+                    (new.end_price*p.shares) as value,
+                    p.invested,
+                    (new.end_price*p.shares - p.invested) as profit,
+                    new.dt
+                FROM unnest(CAST(:ids AS INTEGER[]), CAST(:dts AS DATE[]), CAST(:end_prices AS REAL[])) AS new (id, dt, end_price)
+                JOIN stocks s
+                    ON s.id = new.id
+                JOIN LATERAL
+                (
+                    SELECT shares, invested
+                    FROM positions
+                    WHERE positions.id = new.id
+                        AND positions.dt <= new.dt
+                    ORDER BY positions.dt DESC
+                    LIMIT 1
+                ) p ON TRUE
+                WHERE NOT EXISTS
+                (
+                    SELECT 1 FROM portfolio_history ph
+                    WHERE ph.id = new.id
+                        AND ph.dt = new.dt
+                )''', sqlite='''
+                INSERT INTO portfolio_history (id, name, ticker, end_price, shares, value, invested, profit, dt)
+                SELECT
+                    s.id,
+                    s.name,
+                    s.ticker,
+                    :end_price,
+                    p.shares,
+                    (:end_price*p.shares) as value,
+                    p.invested,
+                    (:end_price*p.shares - p.invested) as profit,
+                    :dt
+                FROM stocks s
+                JOIN positions p
+                    ON p.id = s.id
+                    AND p.dt = (SELECT MAX(dt) FROM positions WHERE positions.id = s.id AND positions.dt <= :dt)
+                WHERE s.id = :id
+                    AND NOT EXISTS
+                    (
+                        SELECT 1 FROM portfolio_history ph
+                        WHERE ph.id = :id
+                            AND ph.dt = :dt
+                    )''')
+
+sql_update_stock_price_from_history = text('''
+                UPDATE stocks
+                SET price = ph.end_price
+                FROM portfolio_history ph
+                WHERE ph.id = stocks.id
+                    AND stocks.st = 'Active'
+                    AND ph.dt = (SELECT MAX(dt) FROM portfolio_history)''')
+
+
+sql_stocks_without_positions = text('''
+                SELECT DISTINCT s.id, s.ticker
+                FROM changes c
+                JOIN stocks s
+                    ON s.id = c.stock_id
+                WHERE NOT EXISTS (SELECT 1 FROM positions p WHERE p.id = c.stock_id)''')
+
+
+def find_gaps(connection, from_dt=None, to_dt=None):
+    # Missing (id, ticker, dt) records, sorted by stock & date. Days up to yesterday only (today has no close yet)
+    # Gaps are found from positions, stocks with changes but no positions (sold before the positions table existed) are reported
+    unknown = pd.read_sql_query(sql_stocks_without_positions, connection)
+    if not unknown.empty:
+        print(f"Warning: {len(unknown)} stocks have changes but no positions, their history can't be backfilled "
+              f"({', '.join(unknown['ticker'].astype(str))}) - run 'python main.py replay' once to rebuild their positions")
+
+    yesterday = datetime.now().date() - timedelta(days=1)
+    to_dt = min(to_dt or yesterday, yesterday)
+    missing = pd.read_sql_query(sql_missing_history_days, connection, params={'from_dt': from_dt, 'to_dt': to_dt})
+    missing['dt'] = pd.to_datetime(missing['dt']).dt.date
+    return missing
+
+
+def gap_ranges(missing):
+    # Consecutive missing days of every stock as one range: id, ticker, start, end, days
+    if missing.empty:
+        return pd.DataFrame(columns=['id', 'ticker', 'start', 'end', 'days'])
+    days = pd.to_datetime(missing['dt'])
+    range_no = ((days.diff().dt.days != 1) | (missing['id'] != missing['id'].shift())).cumsum()
+    return missing.groupby(range_no).agg(id=('id', 'first'), ticker=('ticker', 'first'), start=('dt', 'min'),
+                                         end=('dt', 'max'), days=('dt', 'size')).reset_index(drop=True)
+
+
+def split_into_chunks(missing, chunk_days):
+    # Missing records grouped by date chunks of 'chunk_days', counted from the first missing day
+    first_day = pd.Timestamp(missing['dt'].min())
+    chunk_no = (pd.to_datetime(missing['dt']) - first_day).dt.days // chunk_days
+    return [chunk.reset_index(drop=True) for _, chunk in missing.groupby(chunk_no)]
+
+
+def backfill_chunk(engine, price_provider, chunk, lookback_days):
+    first_day, last_day = chunk['dt'].min(), chunk['dt'].max()
+    tickers = chunk['ticker'].unique().tolist()
+
+    # Closes of the chunk's tickers, carried forward over days without one (and back to the chunk start if needed)
+    end_prices = daily_closes(price_provider, tickers, first_day - timedelta(days=lookback_days), last_day)
+
+    rows = chunk.merge(end_prices.reset_index(), on=['ticker', 'dt'], how='left')
+    rows = rows.dropna(subset=['end_price'])
+
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            # the whole chunk as 3 arrays in one statement
+            params = {'ids': [int(id) for id in rows['id']], 'dts': rows['dt'].tolist(), 'end_prices': rows['end_price'].tolist()}
+        else:
+            params = [{'id': int(id), 'dt': dt, 'end_price': float(end_price)}
+                      for id, dt, end_price in rows[['id', 'dt', 'end_price']].itertuples(index=False)]
+        inserted = connection.execute(sql_insert_backfill, params).rowcount if params else 0
+
+    return {'start': first_day, 'end': last_day, 'tickers': len(tickers), 'missing': len(chunk),
+            'without_price': len(chunk) - len(rows), 'inserted': inserted}
+
+
+def backfill(engine, price_provider, from_dt=None, to_dt=None, chunk_days=90, max_workers=4, lookback_days=10):
+    # Fills the gaps of portfolio_history within [from_dt; to_dt] (default: whole history up to yesterday),
+    # returns one summary row per chunk
+    with engine.connect() as connection:
+        missing = find_gaps(connection, from_dt, to_dt)
+
+    if missing.empty:
+        print("No missing days in portfolio_history")
+        return pd.DataFrame()
+
+    ranges = gap_ranges(missing)
+    print(f"Missing {len(missing)} records in {len(ranges)} gaps of {ranges['id'].nunique()} stocks, "
+          f"[{missing['dt'].min()};{missing['dt'].max()}]")
+
+    chunks = split_into_chunks(missing, chunk_days)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as pool:
+        summary = pd.DataFrame(list(pool.map(lambda chunk: backfill_chunk(engine, price_provider, chunk, lookback_days), chunks)))
+
+    # Daily totals from the first filled day on & the latest prices of the active stocks
+    with engine.begin() as connection:
+        f.update_portfolio_daily(connection, missing['dt'].min())
+        analytics.invalidate_analytics(connection, missing['dt'].min())
+        connection.execute(sql_update_stock_price_from_history)
+
+    return summary
@@ -0,0 +1,105 @@
+import functions as f
+import pandas as pd
+import numpy as np
+import time
+import argparse
+
+
+
+
+#######################################################################################
+############################### STOCK GROWTH BENCHMARK: ###############################
+#######################################################################################
+
+# Times the growth chart on a synthetic portfolio_history (one record per stock & day, random walk prices):
+#   loop   - previous implementation, one filter + reindex + plot per stock over the long growth frame
+#   pivot  - ReportData.growth_pivot (date x stock matrix) + plotting its columns
+# '_prep' columns time the data preparation only, the others include drawing the lines.
+#
+# Run from the project root:  python -m benchmarks.stock_growth --tickers 10 50 100 250 500 --days 730
+
+
+def synthetic_report_data(tickers, days, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(end=pd.Timestamp.today().normalize(), periods=days)
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, (days, tickers)), axis=0))
+
+    history = pd.DataFrame({
+        'id': np.tile(np.arange(1, tickers + 1, dtype='int32'), days),
+        'dt': np.repeat(dates, tickers),
+        'end_price': prices.ravel(),
+    })
+    history['value'] = history['end_price'] * 10
+    history['profit'] = history['value'] - 1000
+
+    ids = range(1, tickers + 1)
+    return f.ReportData(history, [], {id: 'C0' for id in ids}, {id: f'STOCK{id}' for id in ids})
+
+
+def growth_loop(report_data, plot=True):
+    # Previous implementation of plot_stock_growth's data preparation & plotting
+    history = report_data.history
+    prev_price = history.groupby('id')['end_price'].shift(1).fillna(history['end_price'])
+    growth_df = history[['id', 'dt']].assign(growth=(history['end_price'] - prev_price) * 100 / prev_price)
+    growth_df = growth_df[growth_df['growth'] != 0]
+    date_range = pd.date_range(start=growth_df['dt'].min(), end=growth_df['dt'].max())
+
+    fig, ax = f.new_figure()
+    for id in growth_df['id'].unique():
+        stock_growth = growth_df[growth_df['id'] == id].set_index('dt')
+        stock_growth = stock_growth.reindex(date_range, fill_value=0).reset_index().rename(columns={'index': 'dt'})
+        if not plot:
+            continue
+        ax.plot(stock_growth['dt'], stock_growth['growth'], color='gray', linewidth=2)
+        ax.plot(stock_growth['dt'], stock_growth['growth'], color='C0', linewidth=1.5)
+
+
+def growth_pivot(report_data, plot=True):
+    daily_growth = report_data.growth_pivot()
+    if not plot:
+        return
+
+    fig, ax = f.new_figure()
+    for id in daily_growth.columns:
+        ax.plot(daily_growth.index, daily_growth[id], color='gray', linewidth=2)
+        ax.plot(daily_growth.index, daily_growth[id], color='C0', linewidth=1.5)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def run(ticker_counts, days, render):
+    results = []
+    for tickers in ticker_counts:
+        report_data = synthetic_report_data(tickers, days)
+        row = {
+            'tickers': tickers,
+            'rows': len(report_data.history),
+            'loop_prep_s': timed(growth_loop, report_data, False),
+            'pivot_prep_s': timed(growth_pivot, report_data, False),
+            'loop_s': timed(growth_loop, report_data),
+            'pivot_s': timed(growth_pivot, report_data),
+        }
+        if render:
+            row['chart_s'] = timed(f.render_chart, 'growth', report_data)
+        results.append(row)
+        print(row)
+
+    results = pd.DataFrame(results)
+    results['prep_speedup'] = results['loop_prep_s'] / results['pivot_prep_s']
+    results['speedup'] = results['loop_s'] / results['pivot_s']
+    return results
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Growth chart: per stock loop vs date x stock matrix')
+    parser.add_argument('--tickers', type=int, nargs='+', default=[10, 50, 100, 250, 500])
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--render', action='store_true', help='also time rendering the full growth chart to PNG')
+    args = parser.parse_args()
+
+    print(run(args.tickers, args.days, args.render).to_string(index=False))
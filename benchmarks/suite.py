@@ -0,0 +1,226 @@
+import functions as f
+import analytics
+from benchmarks.synthetic import synthetic_portfolio
+from telegram_delivery import TelegramSender
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+from sqlalchemy import text
+import contextlib
+import statistics
+import platform
+import tempfile
+import argparse
+import shutil
+import json
+import time
+import io
+import os
+
+
+
+
+#######################################################################################
+############################### BENCHMARK SUITE: ######################################
+#######################################################################################
+
+# Times the stages of the daily run on a synthetic portfolio (see synthetic.py) of realistic size:
+#   get_stock_info           - price update of all active stocks over the last 'update_days' days (offline fixture prices)
+#   apply_portfolio_changes  - a batch of 'batch' buys & sells of active stocks (rolled back after every repetition)
+#   load_staging             - staging the fetched prices (COPY on Postgres)
+#   sql_insert_history       - history insert of the staged days (deleted first, rolled back after every repetition)
+#   portfolio_view           - reading the whole 'portfolio' view
+#   report_data              - loading the report data
+#   plot:<chart>             - drawing each report chart into a PNG
+#   telegram_payload         - summary message & media group of a Telegram update (nothing is sent)
+# Every benchmark runs 'repeat' times, the median & min are kept. Results are written as JSON and compared with a baseline:
+#
+#   python -m benchmarks.suite --tickers 200 --years 5 --changes 2000 --output results.json --baseline baseline.json
+#
+# Without --database the data lives in a temporary SQLite file. A PostgreSQL URI has to point to an empty, disposable database.
+
+
+def timed(function, repeat, setup=None, teardown=None):
+    # Runs setup() -> state, function(state), teardown(state) 'repeat' times, only function() is timed.
+    # Returns (seconds of every run, result of the last run)
+    seconds = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function(state)
+            seconds.append(time.perf_counter() - start)
+        if teardown:
+            teardown(state)
+    return seconds, result
+
+
+class Transaction:
+
+    # Connection & transaction that are rolled back after the timed part, so every repetition starts from the same data
+    def __init__(self, engine):
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+
+    def rollback(self):
+        self.transaction.rollback()
+        self.connection.close()
+
+
+def benchmark_changes(engine, batch, seed=0):
+    # 'batch' trades on yesterday: buys of random active stocks & partial sells of the biggest holdings
+    rng = np.random.default_rng(seed)
+    active = pd.read_sql_query(f.sql_active_stocks, engine)
+    picked = active.sample(n=batch, replace=len(active) < batch, random_state=seed).reset_index(drop=True)
+    sells = rng.random(batch) < 0.35
+    share = np.where(sells, -np.maximum(np.floor(picked['share'].to_numpy() * 0.05), 1), rng.integers(1, 20, batch))
+    # never sell more than once per stock, so the batch can't empty a position
+    share = np.where(sells & picked['ticker'].duplicated().to_numpy(), np.abs(share), share)
+    return pd.DataFrame({'name': picked['name'], 'ticker': picked['ticker'], 'price': picked['price'].astype(float),
+                         'share': share.astype(float), 'dt': datetime.now().date() - timedelta(days=1)})
+
+
+def run_benchmarks(engine, price_provider, repeat=3, update_days=30, batch=100):
+    results = {}
+
+    def add(name, seconds, **info):
+        results[name] = {'median_s': round(statistics.median(seconds), 5), 'min_s': round(min(seconds), 5), 'runs': len(seconds), **info}
+        print(f"{name:<28} {results[name]['median_s']:>9.4f}s  " + ', '.join(f'{key}={value}' for key, value in info.items()))
+
+    last_day = datetime.now().date() - timedelta(days=update_days + 1)
+    active_stocks = pd.read_sql_query(f.sql_active_stocks, engine)
+
+    seconds, new_stock_info_df = timed(lambda _: f.get_stock_info(active_stocks, last_day, price_provider), repeat)
+    add('get_stock_info', seconds, tickers=len(active_stocks), rows=len(new_stock_info_df))
+
+    changes = benchmark_changes(engine, batch)
+    seconds, _ = timed(lambda tx: f.apply_portfolio_changes(changes, tx.connection, f.sql_active_stocks), repeat,
+                       setup=lambda: Transaction(engine), teardown=Transaction.rollback)
+    add('apply_portfolio_changes', seconds, rows=len(changes))
+
+    seconds, _ = timed(lambda tx: f.load_staging(tx.connection, new_stock_info_df), repeat,
+                       setup=lambda: Transaction(engine), teardown=Transaction.rollback)
+    add('load_staging', seconds, rows=len(new_stock_info_df))
+
+    def staged_days_deleted():
+        tx = Transaction(engine)
+        tx.connection.execute(text('DELETE FROM portfolio_history WHERE dt > :last_day'), {'last_day': last_day})
+        with contextlib.redirect_stdout(io.StringIO()):
+            f.load_staging(tx.connection, new_stock_info_df)
+        return tx
+    seconds, inserted = timed(lambda tx: tx.connection.execute(f.sql_insert_history).rowcount, repeat,
+                              setup=staged_days_deleted, teardown=Transaction.rollback)
+    add('sql_insert_history', seconds, rows=inserted)
+
+    # Risk & performance figures of the whole history, then of the last 'update_days' days on top of the stored ones
+    # (a daily run), the summary payload below reads the committed rows
+    seconds, days = timed(lambda tx: analytics.update_analytics(tx.connection, price_provider), repeat,
+                          setup=lambda: Transaction(engine), teardown=Transaction.rollback)
+    add('analytics_rebuild', seconds, rows=days)
+    with engine.begin() as connection:
+        analytics.update_analytics(connection, price_provider)
+
+    def recent_analytics_deleted():
+        tx = Transaction(engine)
+        analytics.invalidate_analytics(tx.connection, last_day)
+        return tx
+    seconds, days = timed(lambda tx: analytics.update_analytics(tx.connection, price_provider), repeat,
+                          setup=recent_analytics_deleted, teardown=Transaction.rollback)
+    add('analytics_update', seconds, rows=days)
+
+    def read_portfolio_view(_):
+        with engine.connect() as connection:
+            return pd.read_sql(text('SELECT * FROM portfolio'), connection)
+    seconds, portfolio = timed(read_portfolio_view, repeat)
+    add('portfolio_view', seconds, rows=len(portfolio))
+
+    seconds, report_data = timed(lambda _: f.ReportData.load(engine), repeat)
+    add('report_data', seconds, rows=len(report_data.history))
+
+    charts = {}
+    for chart_name in f.REPORT_CHARTS:
+        seconds, (_, png, _) = timed(lambda _: f.render_chart(chart_name, report_data), repeat)
+        charts[chart_name + '.png'] = png
+        add(f'plot:{chart_name}', seconds, bytes=len(png))
+
+    sender = TelegramSender('123456:benchmark', 1)
+    seconds, deliveries = timed(lambda _: sender.build_deliveries(f.telegram_messages(engine, []), charts), repeat)
+    add('telegram_payload', seconds, deliveries=len(deliveries), bytes=sum(len(png) for png in charts.values()))
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    # Median of every benchmark vs. the baseline: ratio > 1 + tolerance = 'slower', < 1 - tolerance = 'faster'
+    rows = []
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        ratio = result['median_s'] / base['median_s'] if base and base['median_s'] else None
+        status = '' if ratio is None or abs(ratio - 1) <= tolerance else ('slower' if ratio > 1 else 'faster')
+        rows.append({'benchmark': name, 'baseline_s': base['median_s'] if base else None, 'median_s': result['median_s'],
+                     'ratio': round(ratio, 3) if ratio else None, 'status': status if base else 'new'})
+
+    if results['parameters'] != baseline['parameters']:
+        print(f"Warning: baseline was measured with {baseline['parameters']}, results with {results['parameters']}")
+    return pd.DataFrame(rows)
+
+
+def run(tickers=50, years=3, changes=500, repeat=3, update_days=30, batch=100, database_uri=None, seed=0):
+    directory = tempfile.mkdtemp(prefix='portfolio_benchmark_')
+    try:
+        start = time.perf_counter()
+        engine, price_provider, prices, trades = synthetic_portfolio(directory, database_uri, tickers, years, changes, seed)
+        with engine.connect() as connection:
+            history_rows = connection.execute(text('SELECT COUNT(*) FROM portfolio_history')).scalar()
+        print(f"Synthetic portfolio: {tickers} tickers, {len(prices)} prices, {len(trades)} changes, {history_rows} history records "
+              f"({engine.dialect.name}, built in {time.perf_counter() - start:.1f}s)")
+
+        benchmarks = run_benchmarks(engine, price_provider, repeat, update_days, batch)
+        engine.dispose()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'parameters': {'tickers': tickers, 'years': years, 'changes': changes, 'update_days': update_days, 'batch': batch,
+                       'repeat': repeat, 'seed': seed, 'database': engine.dialect.name},
+        'environment': {'python': platform.python_version(), 'pandas': pd.__version__, 'machine': platform.machine(),
+                        'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count()},
+        'history_rows': history_rows,
+        'benchmarks': benchmarks,
+    }
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Daily run stages on a synthetic portfolio')
+    parser.add_argument('--tickers', type=int, default=50)
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--changes', type=int, default=500, help='buys & sells in the change log')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--update-days', type=int, default=30, help='days fetched, staged & inserted')
+    parser.add_argument('--batch', type=int, default=100, help='changes applied by the apply_portfolio_changes benchmark')
+    parser.add_argument('--database', help='empty, disposable database URI (default: temporary SQLite file)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with this JSON file (written from the results if it doesn\'t exist yet)')
+    parser.add_argument('--update-baseline', action='store_true', help='overwrite the baseline with the results')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as slower/faster')
+    args = parser.parse_args()
+
+    results = run(args.tickers, args.years, args.changes, args.repeat, args.update_days, args.batch, args.database, args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline and os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as file:
+            comparison = compare(results, json.load(file), args.tolerance)
+        print(comparison.to_string(index=False))
+        if (comparison['status'] == 'slower').any():
+            raise SystemExit(f"{(comparison['status'] == 'slower').sum()} benchmarks are slower than the baseline")
+    elif args.baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline written to {args.baseline}")
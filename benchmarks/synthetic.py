@@ -0,0 +1,112 @@
+import functions as f
+import storage
+import replay
+from price_providers import FixturePriceProvider
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+from sqlalchemy import text
+import contextlib
+import io
+import os
+
+
+
+
+#######################################################################################
+############################### SYNTHETIC PORTFOLIO: ##################################
+#######################################################################################
+
+# Realistic test data without network or a production database:
+#   prices  - N tickers x M years of business day closes (random walks), written as a fixture file for FixturePriceProvider
+#   changes - K trades: a first buy of every ticker early in the period, then random buys & partial sells of held tickers
+#             (never everything, so every ticker keeps one stock id), at that day's close
+# build_database() writes stocks & changes into an empty database and lets the replay engine derive positions, lots,
+# realized gains, portfolio_history & portfolio_daily from them - the same tables a daily run would have produced.
+
+
+def synthetic_prices(tickers, years, seed=0, end=None):
+    # Closes up to 'end' (default: yesterday) - columns dt, ticker, end_price
+    rng = np.random.default_rng(seed)
+    end = end or datetime.now().date() - timedelta(days=1)
+    dates = pd.bdate_range(end=end, periods=max(int(years * 261), 2))
+    start_prices = rng.uniform(20, 200, tickers)
+    returns = rng.normal(0.0003, 0.02, (len(dates), tickers))
+    prices = start_prices * np.exp(np.cumsum(returns, axis=0))
+
+    return pd.DataFrame({
+        'dt': np.tile(dates.date, tickers),
+        'ticker': np.repeat([f'TCK{i:04d}' for i in range(tickers)], len(dates)),
+        'end_price': prices.T.ravel().round(4),
+    })
+
+
+def synthetic_changes(prices, changes, seed=0):
+    # 'changes' trades against 'prices' - columns name, ticker, price, share, dt (as a change file)
+    rng = np.random.default_rng(seed)
+    closes = prices.set_index(['ticker', 'dt'])['end_price']
+    dates = np.sort(prices['dt'].unique())
+    tickers = prices['ticker'].unique()[:changes]
+
+    # First buys within the first 20% of the period, the other trades anywhere after them
+    first_buy = pd.Series(rng.choice(dates[:max(len(dates) // 5, 1)], len(tickers)), index=tickers)
+    trade_tickers = rng.choice(tickers, changes - len(tickers))
+    trade_dates = [rng.choice(dates[dates >= first_buy[ticker]]) for ticker in trade_tickers]
+
+    trades = pd.DataFrame({'ticker': np.concatenate([tickers, trade_tickers]), 'dt': np.concatenate([first_buy.to_numpy(), trade_dates]),
+                           'first': np.arange(changes) < len(tickers)})
+    trades = trades.sort_values(['dt', 'first'], ascending=[True, False], kind='stable').reset_index(drop=True)
+
+    # Buy 1-50 shares, 35% of the later trades sell 10-50% of the shares held at that time
+    held = dict.fromkeys(tickers, 0.0)
+    shares = []
+    for ticker, is_first in zip(trades['ticker'], trades['first']):
+        if not is_first and held[ticker] > 1 and rng.random() < 0.35:
+            share = -max(np.floor(held[ticker] * rng.uniform(0.1, 0.5)), 1.0)     # never 0, that would sell all
+        else:
+            share = float(rng.integers(1, 51))
+        held[ticker] += share
+        shares.append(share)
+
+    trades['share'] = shares
+    trades['price'] = closes.reindex(pd.MultiIndex.from_arrays([trades['ticker'], trades['dt']])).to_numpy()
+    trades['name'] = trades['ticker'].str.replace('TCK', 'Synthetic ', regex=False)
+    return trades[['name', 'ticker', 'price', 'share', 'dt']]
+
+
+def build_database(engine, prices_path, changes):
+    # Fills an empty database with the synthetic portfolio, returns the price provider serving 'prices_path'
+    if not storage.bootstrap_schema(engine):
+        with engine.connect() as connection:
+            if connection.execute(text('SELECT COUNT(*) FROM stocks')).scalar():
+                raise ValueError("The benchmark database already contains stocks, use an empty (disposable) database")
+    f.generate_and_store_colors(engine)
+
+    stocks = changes.drop_duplicates(subset='ticker')[['name', 'ticker', 'price']].reset_index(drop=True)
+    with engine.begin() as connection:
+        connection.execute(text('''INSERT INTO stocks (name, ticker, price, share, color_id, st)
+                                   VALUES (:name, :ticker, :price, 0, :color_id, 'Active')'''),
+                           [{'name': name, 'ticker': ticker, 'price': float(price), 'color_id': i % 50 + 1}
+                            for i, (name, ticker, price) in enumerate(stocks.itertuples(index=False))])
+        ids = dict(connection.execute(text('SELECT ticker, id FROM stocks')).fetchall())
+        f.copy_rows(connection, 'changes', pd.DataFrame({'dt': changes['dt'], 'stock_id': changes['ticker'].map(ids),
+                                                         'shares_bought_sold': changes['share'], 'purchase_price': changes['price']}))
+
+    price_provider = FixturePriceProvider(prices_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        replay.run_replay(engine, price_provider, end_dt=max(changes['dt'].max(), datetime.now().date() - timedelta(days=1)))
+    return price_provider
+
+
+def synthetic_portfolio(directory, database_uri=None, tickers=50, years=3, changes=500, seed=0):
+    # Writes the price fixture into 'directory' & builds the database (default: a new SQLite file in 'directory'),
+    # returns (engine, price provider, prices, changes)
+    os.makedirs(directory, exist_ok=True)
+    prices = synthetic_prices(tickers, years, seed)
+    trades = synthetic_changes(prices, max(changes, 1), seed)
+
+    prices_path = os.path.join(directory, 'prices.csv')
+    prices.to_csv(prices_path, index=False)
+    engine = storage.make_engine(database_uri or 'sqlite:///' + os.path.join(directory, 'portfolio.sqlite'))
+    price_provider = build_database(engine, prices_path, trades)
+    return engine, price_provider, prices, trades
@@ -0,0 +1,178 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from sqlalchemy import text
+import hashlib
+import shutil
+import os
+
+
+
+
+#######################################################################################
+############################### CHANGE INGESTION: #####################################
+#######################################################################################
+
+# Portfolio changes are picked up from a drop directory (config.CHANGES_DROP_DIRECTORY):
+#   1) every .csv, .parquet & .xlsx file is hashed (SHA-256 of its content), files already ingested are skipped
+#      (ingested_change_files), so a file dropped twice or left behind by a failed move is not applied again
+#   2) the new files are parsed & validated in parallel worker processes
+#   3) the changes of all valid files go to processing as one batch sorted by date, the files are recorded as ingested
+#      in the same transaction & moved to the processed directory once it is committed
+# Files with invalid rows are rejected as a whole and stay in the drop directory, every bad cell is reported.
+# Files without rows (e.g. a blank template) are left alone.
+#
+# Columns (as in changes_in_portfolio.xlsx): name, ticker, price, share (number or 'all' to sell everything), date
+
+CHANGE_FILE_FORMATS = ('.csv', '.parquet', '.xlsx')
+CHANGE_COLUMNS = ['name', 'ticker', 'price', 'share', 'date']
+ERROR_COLUMNS = ['file', 'row', 'column', 'value', 'error']
+
+
+class PendingChanges:
+
+    # changes - valid changes of all new files: name, ticker, price, share, dt (sorted by dt)
+    # files   - ingested files: path, sha256, bytes, rows
+    # errors  - rejected cells: file, row (as numbered in a spreadsheet, header = 1), column, value, error
+    def __init__(self, changes, files, errors):
+        self.changes = changes
+        self.files = files
+        self.errors = errors
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def scan_drop_directory(directory):
+    # Change files of the drop directory (sorted by name) with their content hash & size
+    if not os.path.isdir(directory):
+        return pd.DataFrame(columns=['path', 'sha256', 'bytes'])
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.lower().endswith(CHANGE_FILE_FORMATS) and not name.startswith('~$'))   # ~$ = Excel lock files
+    return pd.DataFrame({'path': paths, 'sha256': [file_sha256(path) for path in paths], 'bytes': [os.path.getsize(path) for path in paths]})
+
+
+def read_change_file(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return pd.read_csv(path, skipinitialspace=True)
+    if extension == '.parquet':
+        return pd.read_parquet(path)
+    return pd.read_excel(path, header=0)
+
+
+def validate_changes(raw, file_name):
+    # Vectorized checks of all rows at once, returns (valid changes, errors). Any error rejects the whole file
+    raw = raw.rename(columns=lambda column: str(column).strip().lower())
+    missing_columns = [column for column in CHANGE_COLUMNS if column not in raw]
+    if missing_columns:
+        return None, pd.DataFrame({'file': file_name, 'row': None, 'column': missing_columns, 'value': None, 'error': 'missing column'})
+
+    raw = raw[CHANGE_COLUMNS].replace(r'^\s*$', np.nan, regex=True)
+    raw = raw[raw.notna().any(axis=1)]                                   # trailing empty rows of spreadsheets
+
+    share_text = raw['share'].astype(str).str.strip().str.lower()
+    changes = pd.DataFrame({
+        'name': raw['name'],
+        'ticker': raw['ticker'],
+        'price': pd.to_numeric(raw['price'], errors='coerce'),
+        'share': pd.to_numeric(raw['share'], errors='coerce').where(share_text != 'all', 0.0),
+        'dt': pd.to_datetime(raw['date'], errors='coerce'),
+    })
+
+    # column -> (failed rows, message)
+    checks = [
+        (column, raw[column].isna(), 'missing value') for column in CHANGE_COLUMNS
+    ] + [
+        ('price', raw['price'].notna() & changes['price'].isna(), 'not a number'),
+        ('price', changes['price'] <= 0, 'must be positive'),
+        ('share', raw['share'].notna() & changes['share'].isna(), "not a number or 'all'"),
+        ('date', raw['date'].notna() & changes['dt'].isna(), 'not a date'),
+        ('date', changes['dt'] > pd.Timestamp(datetime.now().date()), 'in the future'),
+    ]
+    errors = [pd.DataFrame({'file': file_name, 'row': raw.index[failed.to_numpy()] + 2, 'column': column,
+                            'value': raw.loc[failed, column].to_numpy(), 'error': message})
+              for column, failed, message in checks if failed.any()]
+    if errors:
+        return None, pd.concat(errors, ignore_index=True).sort_values(['row', 'column'], kind='stable').reset_index(drop=True)
+
+    changes['dt'] = changes['dt'].dt.date
+    changes['ticker'] = changes['ticker'].astype(str).str.strip()
+    return changes.reset_index(drop=True), pd.DataFrame(columns=ERROR_COLUMNS)
+
+
+def parse_change_file(path):
+    # Worker: read & validate one file -> (changes or None, errors)
+    file_name = os.path.basename(path)
+    try:
+        raw = read_change_file(path)
+    except Exception as e:
+        return None, pd.DataFrame([[file_name, None, None, None, f'unreadable: {e}']], columns=ERROR_COLUMNS)
+    return validate_changes(raw, file_name)
+
+
+def load_pending_changes(connection, directory, max_workers=None):
+    # New (not yet ingested) change files of 'directory', parsed in parallel & merged into one batch
+    files = scan_drop_directory(directory)
+    ingested = set(pd.read_sql(sql_ingested_hashes, connection)['sha256'])
+    skipped = files['sha256'].isin(ingested) | files['sha256'].duplicated()
+    if skipped.any():
+        print("Already ingested, skipped: " + ', '.join(os.path.basename(path) for path in files.loc[skipped, 'path']))
+    files = files[~skipped].reset_index(drop=True)
+
+    max_workers = max_workers or min(len(files), os.cpu_count() or 1)
+    if len(files) <= 1 or max_workers == 1:
+        parsed = [parse_change_file(path) for path in files['path']]
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(files))) as pool:
+            parsed = list(pool.map(parse_change_file, files['path']))
+
+    files['rows'] = [len(changes) if changes is not None else 0 for changes, _ in parsed]
+    valid = np.array([changes is not None for changes, _ in parsed], dtype=bool)
+    errors = pd.concat([errors for _, errors in parsed if not errors.empty] or [pd.DataFrame(columns=ERROR_COLUMNS)], ignore_index=True)
+
+    if not errors.empty:
+        print(f"Rejected {errors['file'].nunique()} change files, fix them in {directory}:")
+        print(errors.to_string(index=False))
+
+    # Stable sort: same day changes keep their file & row order
+    batches = [changes.assign(file_no=file_no) for file_no, (changes, _) in enumerate(parsed) if changes is not None]
+    changes = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame(columns=['name', 'ticker', 'price', 'share', 'dt', 'file_no'])
+    changes = changes.sort_values(['dt', 'file_no'], kind='stable').drop(columns='file_no').reset_index(drop=True)
+
+    files = files[valid & (files['rows'] > 0).to_numpy()].reset_index(drop=True)
+    if not files.empty:
+        print(f"Ingesting {len(changes)} changes from {len(files)} files: " + ', '.join(os.path.basename(path) for path in files['path']))
+    return PendingChanges(changes, files, errors)
+
+
+sql_ingested_hashes = text('''
+                SELECT sha256 FROM ingested_change_files''')
+
+sql_insert_ingested_file = text('''
+                INSERT INTO ingested_change_files (sha256, file_name, row_count, ingested_at)
+                VALUES (:sha256, :file_name, :row_count, :ingested_at)''')
+
+
+def record_ingested(connection, files):
+    # Inside the transaction that applies the changes, so a failed run leaves the files pending
+    if not files.empty:
+        ingested_at = datetime.now()
+        connection.execute(sql_insert_ingested_file, [
+            {'sha256': sha256, 'file_name': os.path.basename(path), 'row_count': int(rows), 'ingested_at': ingested_at}
+            for path, sha256, rows in files[['path', 'sha256', 'rows']].itertuples(index=False)])
+
+
+def archive_files(files, processed_dir):
+    # Moves the ingested files out of the drop directory (after the commit), prefixed with the processing time
+    os.makedirs(processed_dir, exist_ok=True)
+    for path in files['path']:
+        new_file_path = os.path.join(processed_dir, f"processed_{datetime.now().strftime('%Y%m%d%H%M%S')}_{os.path.basename(path)}")
+        shutil.move(path, new_file_path)
+        print(f"File moved to {new_file_path}")
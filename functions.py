@@ -1,51 +1,26 @@
-import yfinance as yf
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import to_hex
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, text
-from itertools import product
-import shutil
+from sqlalchemy import create_engine, text, bindparam
+from storage import dialect_text
+import contextlib
+import io
 import os
 import time
-from telegram import Bot, InputMediaPhoto
 import asyncio
+from lot_ledger import LotLedger
+from alert_rules import evaluate_alerts
 
 
 
 
 ####################################################################################### 
-####################### RETRIEVING DATA FROM YAHOO AND EXCEL: #########################
+############################### RETRIEVING PRICE DATA: ################################
 ####################################################################################### 
 
 
-def convert_shares(value):
-    if value == 'all':
-        return 0
-    try:
-        return float(value)
-    except ValueError:
-        return None 
-
-
-def portfolio_changes_etl_excel(file_name, base_directory):
-    portfolio_changes = pd.read_excel(base_directory+file_name, header=0)
-    if portfolio_changes.empty or not portfolio_changes.replace('', np.nan).isnull().any().any():
-        portfolio_changes['price'] = pd.to_numeric(portfolio_changes['price'], errors='coerce')
-        portfolio_changes['share'] = portfolio_changes['share'].apply(convert_shares)
-        portfolio_changes['date'] = pd.to_datetime(portfolio_changes['date']).dt.date
-        portfolio_changes.rename(columns={'date': 'dt'}, inplace=True)
-        portfolio_changes.sort_values(by='dt', ascending=True, inplace=True)
-
-        return portfolio_changes
-
-    else:
-        raise ValueError("There are empty values in the updates file") 
-
-
-
-def get_stock_info(active_stocks, last_day):
+def get_stock_info(active_stocks, last_day, price_provider=None):
 
     # Calculate runtime days & intervals
     next_day = last_day + timedelta(days=1)         
@@ -61,205 +36,154 @@ def get_stock_info(active_stocks, last_day):
     # Get active stock tickers:
     tickers = active_stocks['ticker'].tolist()
 
-    all_stocks_df = pd.DataFrame()
-
-    for ticker in tickers:
-        stock = yf.Ticker(ticker)
-        # Get historical market data
-
-        hist = stock.history(period="1d", start=last_day, end=end_date)                  # dates retrieved: [start; end). Interval lenght has to be > 1
-        if not hist.empty:
-            # Reset index to turn the Date index into a column
-            hist.reset_index(inplace=True)
-
-            # Convert 'Date' to datetime format
-            hist['Date'] = pd.to_datetime(hist['Date']).dt.date
-            hist['ticker'] = ticker 
-
-            # Keep only the required columns
-            hist = hist[['Date', 'Close', 'ticker']]
-            hist.rename(columns={'Close': 'end_price'}, inplace=True)
-            hist.rename(columns={'Date': 'dt'}, inplace=True)
-
-            # Append this data to the main DataFrame
-            all_stocks_df = pd.concat([all_stocks_df, hist])
+    # Get historical market data for all tickers at once (batched & concurrent for Yahoo, see price_providers.py)
+    if price_provider is None:
+        from price_providers import YahooPriceProvider
+        price_provider = YahooPriceProvider()
+    all_stocks_df = price_provider.fetch(tickers, last_day, end_date)                     # dates retrieved: [start; end). Interval lenght has to be > 1
 
-        else:                                                      
-                    
-            # If there are no new of stock value
-            missing_data = pd.DataFrame({
-                'dt': [next_day],
-                'end_price': [None],
-                'ticker': [ticker]
-            })
+    all_stocks_df = all_stocks_df.drop_duplicates(subset=['ticker', 'dt'], keep='last')
 
-            all_stocks_df = pd.concat([all_stocks_df, missing_data])
+    # Combine all dates with all tickers (ticker, dt) and add new info in a single reindex
+    grid = pd.MultiIndex.from_product([tickers, update_dates], names=['ticker', 'dt'])
+    end_prices = all_stocks_df.set_index(['ticker', 'dt'])['end_price'].astype(float).reindex(grid)
 
-    # Reset the index of the final DataFrame
-    all_stocks_df.reset_index(drop=True, inplace=True)
+    # Fill the earliest date's missing price with the current price of each ticker
+    known_info = active_stocks.drop_duplicates(subset='ticker').set_index('ticker')
+    current_prices = known_info['price'].astype(float).reindex(grid.get_level_values('ticker')).to_numpy()
+    earliest_date_mask = (grid.get_level_values('dt') == min(update_dates, default=None)) & end_prices.isna().to_numpy()
+    end_prices[earliest_date_mask] = current_prices[earliest_date_mask]
 
-    # Combine all dates with all tickers and add new & known info
-    all_dates_df = pd.DataFrame(list(product(tickers, update_dates)), columns=['ticker', 'dt'])
-    all_dates_and_named_df = all_dates_df.merge(active_stocks[['ticker','name']], on=['ticker'], how='left')
-    all_dates_and_updates = all_dates_and_named_df.merge(all_stocks_df, on=['ticker', 'dt'], how='left')
+    # Forward fill missing ticker prices, never across tickers
+    end_prices = end_prices.groupby(level='ticker', sort=False).ffill().groupby(level='ticker', sort=False).bfill()
 
+    all_dates_and_updates = end_prices.rename('end_price').reset_index()
+    all_dates_and_updates.insert(2, 'name', all_dates_and_updates['ticker'].map(known_info['name']))
 
-    # For each ticker, fill the earliest date's missing price with the current price
-    for ticker in tickers:
-        current_price = active_stocks[active_stocks['ticker'] == ticker]['price'].iloc[0]
-        earliest_date_mask = (all_dates_and_updates['ticker'] == ticker) & \
-                             (all_dates_and_updates['dt'] == all_dates_and_updates['dt'].min())
-        all_dates_and_updates.loc[earliest_date_mask & all_dates_and_updates['end_price'].isna(), 'end_price'] = current_price
 
+    return all_dates_and_updates
 
-    # Forward fill missing ticker prices
-    all_dates_and_updates['end_price'] = all_dates_and_updates.groupby('ticker')['end_price'].ffill().bfill()
 
+def apply_portfolio_changes(portfolio_changes, connection, sql_active_stocks):
 
-    return all_dates_and_updates
+    # Load the active stock state & their purchase records once, all changes are then applied in memory
+    active_stocks = pd.read_sql_query(sql_active_stocks, connection)
+    active = {row['ticker']: {'id': row['id'], 'name': row['name'], 'ticker': row['ticker'], 'price': row['price'],
+                              'share': row['share'], 'st': 'Active', 'is_new': False}
+              for row in active_stocks.to_dict('records')}
 
+    changed_tickers = [ticker for ticker in portfolio_changes['ticker'].unique() if ticker in active]
+    records = pd.read_sql_query(sql_active_stocks_info_for_tickers, connection, params={'tickers': changed_tickers}) \
+        if changed_tickers else pd.DataFrame(columns=['id', 'name', 'ticker', 'price', 'share', 'dt'])
 
-def process_portfolio_changes(file_name, base_directory, portfolio_changes, engine, connection, sql_active_stocks):   
+    # Resolve all buys & FIFO sales at once (see lot_ledger.py)
+    portfolio_changes = portfolio_changes.reset_index(drop=True)
+    ledger = LotLedger(records)
+    ledger_result = ledger.apply(portfolio_changes[['ticker', 'price', 'share', 'dt']])
 
-    for index, row in portfolio_changes.iterrows():             
+    touched_stocks = {}                      # every stock whose row in "stocks" has to be inserted or updated
+    change_stocks = []                       # stock each change belongs to
 
-        active_stocks = pd.read_sql_query(sql_active_stocks, engine)
-        active_tickers = active_stocks['ticker'].tolist()
+    for position, row in enumerate(portfolio_changes.to_dict('records')):
+        ticker, share = row['ticker'], row['share']
 
-        instrument = pd.DataFrame([row], columns=['name', 'ticker', 'price', 'share', 'dt'])
-        
-        if instrument['share'].iloc[0] > 0:
+        if share > 0:
 
             # Check if "stocks" ticker is between stocks WHERE st = 'Active'
-            if instrument['ticker'].iloc[0] in active_tickers:
-                # Insert stocks name, stocks ticker, stocks purchase price & date into "active_stock_info" & into "stocks"
-                active_stock_id = active_stocks[active_stocks['ticker'] == instrument['ticker'].iloc[0]]['id'].iloc[0]
-                instrument['id'] = active_stock_id
-                sql_update_share_price = text(f'''
-                                                UPDATE stocks
-                                                SET
-                                                    share = share + {instrument['share'].iloc[0]}
-                                                WHERE id = {instrument['id'].iloc[0]} 
-                                            ''')
-                connection.execute(sql_update_share_price)
-                # Insert stocks name, stocks ticker, stocks purchase price & date into "active_stock_info"
-                instrument.to_sql('active_stocks_info', con=engine, if_exists='append', index=False, method='multi')
-
+            if ticker in active:
+                stock = active[ticker]
+                stock['share'] += share
             else:
-                # Insert stocks name, stocks ticker & set stocks purchase price as price and set st = 'Active' in table "stocks"
-                instrument['st'] = 'Active'
-                instrument['color_id'] = color_to_new_stock(engine)
-                instrument[['name', 'ticker', 'price', 'share', 'color_id', 'st']].to_sql('stocks', con=engine, if_exists='append', index=False, method='multi')
-                # Insert stocks name, stocks ticker, stocks purchase price & date into "active_stock_info"
-                sql_find_max_id = text('''SELECT MAX(id) FROM stocks''')
-                new_max_id = pd.read_sql_query(sql_find_max_id, engine).iloc[0, 0]
-                instrument['id'] = new_max_id
-                instrument[['id', 'name', 'ticker', 'price', 'share', 'dt']].to_sql('active_stocks_info', con=engine, if_exists='append', index=False, method='multi')
-
-
-        elif instrument['share'].iloc[0] < 0 or instrument['share'].iloc[0] == 0:    # sell all shares <==> share = 0
-            
-            # Check if "stocks" ticker is between stocks WHERE st = 'Active'
-            if instrument['ticker'].iloc[0] in active_tickers:
-
-                active_stock_id = active_stocks[active_stocks['ticker'] == instrument['ticker'].iloc[0]]['id'].iloc[0]
-                instrument['id'] = active_stock_id
-
-                if instrument['share'].iloc[0] == 0:
-                    # If share = 'all' then remove all records active records
-                    sql_delete_share_stocks = text(f'''
-                                                    UPDATE stocks
-                                                    SET
-                                                        st = 'Disabled',
-                                                        share = 0
-                                                    WHERE 
-                                                        ticker = '{instrument['ticker'].iloc[0]}'
-                                                        AND st = 'Active'
-                                                ''')
-                    connection.execute(sql_delete_share_stocks) 
-                    sql_delete_share_active_stocks_info = text(f'''
-                                                    DELETE FROM active_stocks_info WHERE ticker = '{instrument['ticker'].iloc[0]}'
-                                                ''')
-                    connection.execute(sql_delete_share_active_stocks_info) 
-                
-                else:
-                    # Use first in first out algorithm to update stock records for that ticker in "active_stocks_info"
-                    shares_to_sell = abs(instrument['share'].iloc[0])
-                    sales_ticker = instrument['ticker'].iloc[0]
-
-                    # Fetch all active stock info for the ticker
-                    active_records = pd.read_sql_query(
-                        f"SELECT * FROM active_stocks_info WHERE ticker = '{sales_ticker}' ORDER BY dt ASC",
-                        engine
-                    )
-
-                    # Perform FIFO on the DataFrame
-                    for index, record in active_records.iterrows():
-                        if shares_to_sell <= 0:
-                            break  # All shares have been sold
-
-                        shares_in_record = record['share']
-                        if shares_to_sell > shares_in_record:
-                            # All shares in this record are sold
-                            shares_to_sell -= shares_in_record
-                            active_records.at[index, 'share'] = 0
-                        else:
-                            # Only some shares in this record are sold
-                            active_records.at[index, 'share'] -= shares_to_sell
-                            shares_to_sell = 0
-
-                    # Delete old records from the database for this ticker                             
-                    connection.execute(f"DELETE FROM active_stocks_info WHERE ticker = '{sales_ticker}'")
-
-
-                    # Filter out records with 0 shares as they are considered sold
-                    active_records = active_records[active_records['share'] > 0]
-
-                    # Insert updated records back into the database
-                    active_records.to_sql('active_stocks_info', con=engine, if_exists='append', index=False, method='multi')
-
-                    # Update the 'stocks' table with the new total number of shares
-                    if active_records['share'].sum() == 0:
-                        connection.execute(
-                            f"UPDATE stocks SET st = 'Disabled', share = 0 WHERE ticker = '{sales_ticker}' AND st ='Active'"
-                        ) 
-                    else:
-                        connection.execute(
-                            f"UPDATE stocks SET share = {active_records['share'].sum()} WHERE ticker = '{sales_ticker}' AND st = 'Active'"
-                        )                                
-
-            else:
-                raise ValueError(f"Instrument not found: {instrument['ticker'].iloc[0]}")
-
-        # Insert stocks name, stocks ticker, stocks purchase price & date into "changes"
-        instrument[['stock_id', 'shares_bought_sold', 'purchase_price']] = instrument[['id', 'share', 'price']]
-        instrument[['dt', 'stock_id', 'shares_bought_sold', 'purchase_price']].to_sql('changes', con=engine, if_exists='append', index=False, method='multi')
-
-    # Move excel file the to a folder named "processed" with a changed, parametrized name:
-
-    processed_dir = 'processed_portfolio_changes'
-    # Check if the directory exists, if not, create it
-    if not os.path.exists(processed_dir):
-        os.makedirs(processed_dir)
-
-    new_filename = f"processed_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file_name}"
-
-    # Construct the new file path
-    new_file_path = os.path.join(processed_dir, new_filename)
-
-    # Move the file
-    shutil.move(file_name, new_file_path)
-
-    print(f"File moved to {new_file_path}") 
-
-    # Make another empty portfolio changes file for the future: 
-    original_file = base_directory +'changes_in_portfolio_blank.xlsx'
-    new_file = base_directory + 'changes_in_portfolio.xlsx'
-    # Copy the file
-    shutil.copy(original_file, new_file)
-
-    print(f"File copied successfully: {new_file}")
-
+                # New stock: purchase price as price & st = 'Active', its id is only known after the insert
+                stock = {'id': None, 'name': row['name'], 'ticker': ticker, 'price': row['price'],
+                         'share': share, 'st': 'Active', 'is_new': True}
+                active[ticker] = stock
+
+        elif share < 0 or share == 0:    # sell all shares <==> share = 0
+
+            if ticker not in active:
+                raise ValueError(f"Instrument not found: {ticker}")
+            stock = active[ticker]
+
+            # Shares left after the FIFO sale, a stock with nothing left gets disabled
+            stock['share'] = ledger_result.holdings[position]
+            if stock['share'] == 0:
+                stock['st'] = 'Disabled'
+                del active[ticker]
+
+        touched_stocks[id(stock)] = stock
+        change_stocks.append(stock)
+
+
+    ### Write the results with a few bulk, parameterized statements inside the caller's transaction:
+
+    # New stocks - one multi-row insert, ids come back through RETURNING
+    new_stocks = [stock for stock in touched_stocks.values() if stock['is_new']]
+    if new_stocks:
+        colors = colors_for_new_stocks(connection, len(new_stocks))
+        values = ', '.join(f'(:name_{i}, :ticker_{i}, :price_{i}, :share_{i}, :color_id_{i}, :st_{i})' for i in range(len(new_stocks)))
+        params = {}
+        for i, (stock, color_id) in enumerate(zip(new_stocks, colors)):
+            params.update({f'name_{i}': stock['name'], f'ticker_{i}': stock['ticker'], f'price_{i}': float(stock['price']),
+                           f'share_{i}': float(stock['share']), f'color_id_{i}': color_id, f'st_{i}': stock['st']})
+        returned = connection.execute(text(f'''
+                                            INSERT INTO stocks (name, ticker, price, share, color_id, st)
+                                            VALUES {values}
+                                            RETURNING id, ticker'''), params).fetchall()
+
+        # Serial ids are handed out in insertion order, so match them per ticker in that order
+        returned_ids = {}
+        for new_id, ticker in sorted(returned):
+            returned_ids.setdefault(ticker, []).append(new_id)
+        for stock in new_stocks:
+            stock['id'] = returned_ids[stock['ticker']].pop(0)
+
+    # Existing stocks - share & status
+    updated_stocks = [{'id': int(stock['id']), 'share': float(stock['share']), 'st': stock['st']}
+                      for stock in touched_stocks.values() if not stock['is_new']]
+    if updated_stocks:
+        connection.execute(sql_update_stock_share, updated_stocks)
+
+    # Purchase records - tickers with sold lots get their remaining records rewritten, the rest only get their new lots
+    changed_lots = ledger_result.changed_lots
+    rewritten_tickers = changed_lots.loc[changed_lots['status'] != 'added', 'ticker'].unique().tolist()
+    if rewritten_tickers:
+        connection.execute(sql_delete_active_stocks_info_for_tickers, {'tickers': rewritten_tickers})
+    new_lots = pd.concat([ledger.lots(rewritten_tickers),
+                          changed_lots[(changed_lots['status'] == 'added') & ~changed_lots['ticker'].isin(rewritten_tickers)]])
+
+    lot_rows = []
+    for lot in new_lots.to_dict('records'):
+        if lot['record'] >= 0:
+            source = records.iloc[int(lot['record'])]
+            stock_id, name = source['id'], source['name']
+        else:
+            stock_id, name = change_stocks[int(lot['change'])]['id'], portfolio_changes.at[int(lot['change']), 'name']
+        lot_rows.append({'id': int(stock_id), 'name': name, 'ticker': lot['ticker'], 'price': float(lot['price']),
+                         'share': float(lot['share']), 'dt': lot['dt']})
+    if lot_rows:
+        connection.execute(sql_insert_active_stocks_info, lot_rows)
+
+    # Realized gains of every sale, matched against the FIFO cost basis
+    realized_rows = [{'dt': sale['dt'], 'stock_id': int(change_stocks[int(sale['change'])]['id']), 'ticker': sale['ticker'],
+                      'shares_sold': float(sale['shares_sold']), 'sale_price': float(sale['sale_price']),
+                      'cost_basis': float(sale['cost_basis']), 'realized_gain': float(sale['realized_gain'])}
+                     for sale in ledger_result.realized.to_dict('records')]
+    if realized_rows:
+        connection.execute(sql_insert_realized_gains, realized_rows)
+
+    # Positions - shares & invested amount of every changed stock as of each change date (last change of the day wins)
+    position_rows = {}
+    for position, (row, stock) in enumerate(zip(portfolio_changes.to_dict('records'), change_stocks)):
+        position_rows[(stock['id'], row['dt'])] = {'id': int(stock['id']), 'ticker': row['ticker'], 'dt': row['dt'],
+                                                  'shares': float(ledger_result.holdings[position]),
+                                                  'invested': float(ledger_result.invested[position])}
+    connection.execute(sql_upsert_positions, list(position_rows.values()))
+
+    # Change log
+    connection.execute(sql_insert_changes, [{'dt': row['dt'], 'stock_id': int(stock['id']), 'shares_bought_sold': float(row['share']),
+                                             'purchase_price': float(row['price'])}
+                                            for row, stock in zip(portfolio_changes.to_dict('records'), change_stocks)])
 
 
 ####################################################################################### 
@@ -271,9 +195,40 @@ sql_active_stocks = text('''
                 SELECT * FROM stocks
                 WHERE st = 'Active';''')
 
+sql_active_stocks_info_for_tickers = text('''
+                SELECT * FROM active_stocks_info
+                WHERE ticker IN :tickers
+                ORDER BY dt ASC''').bindparams(bindparam('tickers', expanding=True))
+
+sql_delete_active_stocks_info_for_tickers = text('''
+                DELETE FROM active_stocks_info
+                WHERE ticker IN :tickers''').bindparams(bindparam('tickers', expanding=True))
+
+sql_insert_active_stocks_info = text('''
+                INSERT INTO active_stocks_info (id, name, ticker, price, share, dt)
+                VALUES (:id, :name, :ticker, :price, :share, :dt)''')
+
+sql_update_stock_share = text('''
+                UPDATE stocks
+                SET
+                    share = :share,
+                    st = :st
+                WHERE id = :id''')
+
+sql_insert_changes = text('''
+                INSERT INTO changes (dt, stock_id, shares_bought_sold, purchase_price)
+                VALUES (:dt, :stock_id, :shares_bought_sold, :purchase_price)''')
+
+sql_insert_realized_gains = text('''
+                INSERT INTO realized_gains (dt, stock_id, ticker, shares_sold, sale_price, cost_basis, realized_gain)
+                VALUES (:dt, :stock_id, :ticker, :shares_sold, :sale_price, :cost_basis, :realized_gain)''')
+
 sql_last_runtime = text('''
                 SELECT MAX(dt) FROM portfolio_history''')
 
+sql_first_change = text('''
+                SELECT MIN(dt) FROM changes''')
+
 sql_update_stock_price = text('''
                 WITH latest_prices AS 
                 (
@@ -289,39 +244,182 @@ sql_update_stock_price = text('''
                 WHERE
                     stocks.ticker = latest_prices.ticker AND latest_prices.rn = 1;''')  
 
-sql_insert_history = text('''
-                INSERT INTO portfolio_history
-                WITH sum_of_shares_and_investments AS
+sql_upsert_positions = text('''
+                INSERT INTO positions (id, ticker, shares, invested, dt)
+                VALUES (:id, :ticker, :shares, :invested, :dt)
+                ON CONFLICT (id, dt) DO UPDATE
+                SET
+                    shares = EXCLUDED.shares,
+                    invested = EXCLUDED.invested''')
+
+sql_insert_history = dialect_text('''
+                INSERT INTO portfolio_history (id, name, ticker, end_price, shares, value, invested, profit, dt)
+                SELECT
+                    s.id,
+                    new.name,
+                    new.ticker,
+                    new.end_price,
+                    p.shares,
+                    (new.end_price*p.shares) as value,
+                    p.invested,
+                    (new.end_price*p.shares - p.invested) as profit,
+                    new.dt
+                FROM new_data_stg new
+                JOIN stocks s
+                    ON s.ticker = new.ticker
+                    AND s.st = 'Active'
+                JOIN LATERAL                               -- latest position held on that day, one index lookup on positions (id, dt)
+                (
+                    SELECT shares, invested
+                    FROM positions
+                    WHERE positions.id = s.id
+                        AND positions.dt <= new.dt
+                    ORDER BY positions.dt DESC
+                    LIMIT 1
+                ) p ON TRUE
+                WHERE NOT EXISTS                           -- skip already processed days, index lookup on portfolio_history (dt)
+                (
+                    SELECT 1 FROM portfolio_history ph
+                    WHERE ph.dt = new.dt
+                )''', sqlite='''
+                INSERT INTO portfolio_history (id, name, ticker, end_price, shares, value, invested, profit, dt)
+                SELECT
+                    s.id,
+                    new.name,
+                    new.ticker,
+                    new.end_price,
+                    p.shares,
+                    (new.end_price*p.shares) as value,
+                    p.invested,
+                    (new.end_price*p.shares - p.invested) as profit,
+                    new.dt
+                FROM new_data_stg new
+                JOIN stocks s
+                    ON s.ticker = new.ticker
+                    AND s.st = 'Active'
+                JOIN positions p                           -- latest position held on that day (no LATERAL in SQLite)
+                    ON p.id = s.id
+                    AND p.dt = (SELECT MAX(dt) FROM positions WHERE positions.id = s.id AND positions.dt <= new.dt)
+                WHERE NOT EXISTS
+                (
+                    SELECT 1 FROM portfolio_history ph
+                    WHERE ph.dt = new.dt
+                )''')
+
+
+sql_update_portfolio_daily = text('''
+                INSERT INTO portfolio_daily (dt, total_profit, total_value, change, ch_1D_ago, ch_7D_ago, ch_1M_ago, ch_6M_ago, ch_1Y_ago)
+                WITH new_days AS                           -- days to (re)compute, index range scan on portfolio_history (dt)
                 (
                     SELECT
-                        s.id,
-                        new.ticker,
-                        new.name,
-                        new.end_price,
-                        sum(asi.share) AS shares_owned,
-                        sum(asi.share*asi.price) AS invested,
-                        new.dt
-                    FROM new_data_stg new
-                    LEFT JOIN active_stocks_info asi
-                        ON asi.ticker = new.ticker
-                        AND asi.dt <= new.dt               -- only join on data that has been accumulated
-                    LEFT JOIN stocks s
-                        ON asi.ticker = s.ticker           -- ensure having all ids
-                    WHERE s.st = 'Active'
-                    GROUP BY s.id,new.ticker,new.name,new.end_price,new.dt
+                        SUM(profit) AS total_profit,
+                        SUM(value) AS total_value,
+                        dt
+                    FROM portfolio_history
+                    WHERE dt >= :from_dt
+                    GROUP BY dt
+                ),
+                previous_days AS                           -- enough already computed days for the longest (1Y) comparison
+                (
+                    SELECT total_profit, total_value, dt
+                    FROM portfolio_daily
+                    WHERE dt < :from_dt
+                    ORDER BY dt DESC
+                    LIMIT 365
+                ),
+                daily_comparative_portfolio AS
+                (
+                    SELECT *,
+                           LAG(total_value) OVER(ORDER BY dt) as yesterdays_total,
+                           LAG(total_value, 7) OVER(ORDER BY dt) as week_ago_total,
+                           LAG(total_value, 30) OVER(ORDER BY dt) as month_ago_total,
+                           LAG(total_value, 180) OVER(ORDER BY dt) as _6month_ago_total,
+                           LAG(total_value, 365) OVER(ORDER BY dt) as year_ago_total
+                    FROM (SELECT * FROM previous_days UNION ALL SELECT * FROM new_days) days
                 )
                 SELECT
-                    id,
-                    name,
-                    ticker,
-                    end_price,
-                    shares_owned,
-                    (end_price*shares_owned) as value,
-                    invested,
-                    (end_price*shares_owned - invested) as profit,
-                    dt
-                FROM sum_of_shares_and_investments
-                WHERE dt NOT IN (SELECT dt FROM portfolio_history)''')
+                    dcp.dt,
+                    dcp.total_profit,
+                    dcp.total_value,
+                    CASE
+                        WHEN EXISTS (SELECT 1 FROM changes ch WHERE ch.dt = dcp.dt) THEN 1
+                    END AS change,
+                    ROUND(CAST((total_value - yesterdays_total) / yesterdays_total AS numeric), 3) as ch_1D_ago,
+                    ROUND(CAST((total_value - week_ago_total) / week_ago_total AS numeric), 3) as ch_7D_ago,
+                    ROUND(CAST((total_value - month_ago_total) / month_ago_total AS numeric), 3) as ch_1M_ago,
+                    ROUND(CAST((total_value - _6month_ago_total) / _6month_ago_total AS numeric), 3) as ch_6M_ago,
+                    ROUND(CAST((total_value - year_ago_total) / year_ago_total AS numeric), 3) as ch_1Y_ago
+                FROM daily_comparative_portfolio dcp
+                WHERE dcp.dt >= :from_dt
+                ON CONFLICT (dt) DO UPDATE
+                SET
+                    total_profit = EXCLUDED.total_profit,
+                    total_value = EXCLUDED.total_value,
+                    change = EXCLUDED.change,
+                    ch_1D_ago = EXCLUDED.ch_1D_ago,
+                    ch_7D_ago = EXCLUDED.ch_7D_ago,
+                    ch_1M_ago = EXCLUDED.ch_1M_ago,
+                    ch_6M_ago = EXCLUDED.ch_6M_ago,
+                    ch_1Y_ago = EXCLUDED.ch_1Y_ago''')
+
+sql_latest_portfolio_daily = text('''
+                SELECT * FROM portfolio_daily
+                ORDER BY dt DESC
+                LIMIT 1''')
+
+
+def update_portfolio_daily(connection, from_dt):
+    # Recompute the daily totals from 'from_dt' on (appends new days, updates later days if an earlier gap got filled),
+    # returns the number of days written
+    return connection.execute(sql_update_portfolio_daily, {'from_dt': from_dt}).rowcount
+
+
+def rebuild_portfolio_daily(connection):
+    connection.execute(text('DELETE FROM portfolio_daily'))
+    first_dt = connection.execute(text('SELECT MIN(dt) FROM portfolio_history')).scalar()
+    if first_dt is not None:
+        update_portfolio_daily(connection, first_dt)
+
+
+def copy_rows(connection, table, frame):
+    # Bulk load of a DataFrame (columns named as in the table) with COPY FROM STDIN, on the connection of the caller's
+    # transaction. Much faster than INSERTs for large row counts, NaN/None are loaded as NULL. Returns the bytes streamed
+    if connection.dialect.name != 'postgresql':
+        # embedded databases: one executemany INSERT
+        rows = frame.astype(object).where(frame.notna(), None).to_dict('records')
+        if rows:
+            columns = ', '.join(frame.columns)
+            values = ', '.join(f':{column}' for column in frame.columns)
+            connection.execute(text(f'INSERT INTO {table} ({columns}) VALUES ({values})'), rows)
+        return None
+
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False)
+    size = buffer.tell()
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+    return size
+
+
+sql_truncate_staging = dialect_text('''TRUNCATE new_data_stg''', sqlite='''DELETE FROM new_data_stg''')
+
+
+def load_staging(connection, new_stock_info_df):
+    # Replaces the contents of the persistent new_data_stg table (typed DDL kept, UNLOGGED on Postgres) with the fetched
+    # end prices, streamed with COPY on the connection of the caller's transaction. Returns (rows, bytes streamed)
+    start = time.perf_counter()
+    connection.execute(sql_truncate_staging)
+    size = copy_rows(connection, 'new_data_stg', new_stock_info_df[['dt', 'end_price', 'name', 'ticker']])
+    seconds = time.perf_counter() - start
+
+    print(f"Staged {len(new_stock_info_df)} rows ({new_stock_info_df['ticker'].nunique()} tickers, "
+          f"{new_stock_info_df['dt'].nunique()} days) in {seconds:.2f}s")
+    return len(new_stock_info_df), size
 
 
 sql_insert_profit_tracker_history = text('''
@@ -342,72 +440,160 @@ sql_insert_profit_tracker_history = text('''
 ####################################################################################### 
 
 
-def color_to_new_stock(engine):
-    with engine.connect() as conn:
-        # Fetch currently active and disabled stocks with their colors
-        disabled_colors_query = "SELECT id, color_id FROM stocks WHERE st = 'Disabled' ORDER BY id"
-        never_used_colors_query = '''SELECT color_id
-                                     FROM colors
-                                     WHERE color_id NOT IN (SELECT color_id FROM stocks)
-                                   '''
-        
-        disabled_colors_df = pd.read_sql_query(disabled_colors_query, conn)
-        never_used_colors_df = pd.read_sql_query(never_used_colors_query, conn)
-
-        # Check if any unused colors are available
-        unused_colors = [color for color in never_used_colors_df['color_id']]
-
-        # Assign color to the new stock
-        if unused_colors:
-            new_color = unused_colors[0]
-        else:
-            # If no unused colors, take color from disabled stock with lowest id
-            new_color = disabled_colors_df.iloc[0]['color_id'] if not disabled_colors_df.empty else 'grey'
-
-        return new_color  # Return the new color
+def colors_for_new_stocks(connection, count):
+    # Fetch currently active and disabled stocks with their colors
+    disabled_colors_query = "SELECT id, color_id FROM stocks WHERE st = 'Disabled' ORDER BY id"
+    never_used_colors_query = '''SELECT color_id
+                                 FROM colors
+                                 WHERE color_id NOT IN (SELECT color_id FROM stocks WHERE color_id IS NOT NULL)
+                                 ORDER BY color_id
+                               '''
     
+    disabled_colors_df = pd.read_sql_query(text(disabled_colors_query), connection)
+    never_used_colors_df = pd.read_sql_query(text(never_used_colors_query), connection)
 
-def plot_total_value(engine, visual_reports_dir):
-    # Assuming 'engine' is your SQLAlchemy engine connected to the database
-    with engine.connect() as conn:
-        # Retrieve all history from portfolio_history
-        query = """
-                SELECT ph.id, s.name, ph.value, ph.dt, c.color_name_hex
-                FROM portfolio_history ph
-                JOIN stocks s ON ph.id = s.id
-                JOIN colors c ON s.color_id = c.color_id
-                ORDER BY s.id ASC
-                """
-        portfolio_history_df = pd.read_sql(query, conn)
-        # Retrieve all change dates from changes
-        change_dates_df = pd.read_sql("SELECT DISTINCT dt FROM changes", conn)
+    # Unused colors first, then colors of disabled stocks (lowest id first), repeated if there are more new stocks than colors
+    candidates = list(dict.fromkeys(never_used_colors_df['color_id'].tolist() + disabled_colors_df['color_id'].tolist()))
+    if not candidates:
+        return ['grey'] * count
 
-    # Extract name and color to plot them when using stocks id:
-    color_mapping = dict(zip(portfolio_history_df['id'], portfolio_history_df['color_name_hex']))
-    stock_mapping = dict(zip(portfolio_history_df['id'], portfolio_history_df['name']))
+    return [int(candidates[i % len(candidates)]) for i in range(count)]
     
 
-    # Group by 'dt' and sum 'value' to get the total value per day
-    daily_totals = portfolio_history_df.groupby(['dt','id'])['value'].sum().unstack('id').fillna(0)
+class ReportData:
+
+    # Everything the plots need, read from the database once:
+    #   history       - one compact row per stock & day: id, dt, end_price, value, profit
+    #   change_dates  - distinct dates of portfolio changes
+    #   color_mapping, name_mapping - stock id -> plot color / stock name
+    def __init__(self, history, change_dates, color_mapping, name_mapping):
+        self.history = history
+        self.change_dates = change_dates
+        self.color_mapping = color_mapping
+        self.name_mapping = name_mapping
+
+
+    @classmethod
+    def load(cls, engine):
+        with engine.connect() as conn:
+            history = pd.read_sql(sql_report_history, conn)
+            stocks = pd.read_sql(sql_report_stocks, conn)
+            change_dates = pd.read_sql(sql_report_change_dates, conn)
+
+        # Only stocks with a color are plotted (same as joining stocks & colors)
+        history = history[history['id'].isin(stocks['id'])]
+        history = history.astype({'id': 'int32', 'end_price': 'float64', 'value': 'float64', 'profit': 'float64'})
+        history['dt'] = pd.to_datetime(history['dt'])
+        history = history.sort_values(['id', 'dt']).reset_index(drop=True)
+
+        return cls(history, pd.to_datetime(change_dates['dt']).tolist(),
+                   dict(zip(stocks['id'], stocks['color_name_hex'])), dict(zip(stocks['id'], stocks['name'])))
+
+
+    def windowed(self, window):
+        # Only the last 'window' ('1M', '3M', '6M', '1Y', 'all') of history, counted back from the latest day
+        if window in (None, 'all') or self.history.empty:
+            return self
+        start = self.history['dt'].max() - REPORT_WINDOWS[window]
+        return ReportData(self.history[self.history['dt'] >= start], [dt for dt in self.change_dates if dt >= start],
+                          self.color_mapping, self.name_mapping)
+
+
+    def value_pivot(self):
+        # date x stock id matrix of values, sorted by date
+        return self.history.pivot_table(index='dt', columns='id', values='value', aggfunc='sum', fill_value=0).sort_index()
+
+
+    def profit_pivot(self):
+        # date x stock id matrix of profits, sorted by date
+        return self.history.pivot_table(index='dt', columns='id', values='profit', aggfunc='sum', fill_value=0).sort_index()
+
+
+    def growth_pivot(self):
+        # date x stock id matrix of day to day end price growth (%), comparing each record with the stock's previous record.
+        # Days without a record or a price change are 0, only stocks & the date range with some growth are kept
+        prices = self.history.pivot_table(index='dt', columns='id', values='end_price', aggfunc='mean').sort_index()
+        growth = prices.ffill().pct_change(fill_method=None).mul(100).where(prices.notna()).fillna(0)
+        growth = growth.loc[:, (growth != 0).any()]
+
+        growth_days = growth.index[(growth != 0).any(axis=1)]
+        if growth_days.empty:
+            return growth.iloc[:0]
+        return growth.reindex(pd.date_range(growth_days.min(), growth_days.max()), fill_value=0)
+
+
+
+REPORT_WINDOWS = {
+    '1M': pd.DateOffset(months=1),
+    '3M': pd.DateOffset(months=3),
+    '6M': pd.DateOffset(months=6),
+    '1Y': pd.DateOffset(years=1),
+}
+
+
+def downsample(frame, max_points, recent_days=90, how='mean'):
+    # Bounds the number of plotted points of a date indexed frame: the latest 'recent_days' stay daily, older rows
+    # are merged into equal calendar buckets (at least a week wide) so that at most 'max_points' rows remain.
+    #   how='mean' - bucket average (stacked values & profits)
+    #   how='peak' - the bucket value furthest from zero, keeps spikes of growth lines visible
+    if not max_points or len(frame) <= max_points:
+        return frame
+
+    recent = frame[frame.index > frame.index.max() - pd.Timedelta(days=recent_days)]
+    if len(recent) >= max_points // 2:
+        recent = frame.iloc[len(frame) - max_points // 2:]
+    older = frame.iloc[:len(frame) - len(recent)]
+
+    # Buckets are counted back from the last older day & labelled with their last day
+    last_day = older.index.max()
+    span_days = (last_day - older.index.min()).days + 1
+    width = max(7, -(-span_days // (max_points - len(recent))))
+    bucket = (last_day - older.index).days // width
+    buckets = older.groupby(bucket)
+    if how == 'peak':
+        highs, lows = buckets.max(), buckets.min()
+        older = highs.where(highs.abs() >= lows.abs(), lows)
+    else:
+        older = buckets.mean()
+    older.index = last_day - pd.to_timedelta(older.index * width, unit='D')
+
+    return pd.concat([older.sort_index(), recent])
 
+
+sql_report_history = text('''
+                SELECT id, dt, end_price, value, profit
+                FROM portfolio_history''')
+
+sql_report_stocks = text('''
+                SELECT s.id, s.name, c.color_name_hex
+                FROM stocks s
+                JOIN colors c ON s.color_id = c.color_id''')
+
+sql_report_change_dates = text('''
+                SELECT DISTINCT dt FROM changes''')
+
+
+def plot_total_value(report_data, window='all', max_points=None):
+    report_data = report_data.windowed(window)
+
+    # Extract name and color to plot them when using stocks id:
+    color_mapping = report_data.color_mapping
+    stock_mapping = report_data.name_mapping
     
-    # Sort the DataFrame by date to ensure correct plotting
-    daily_totals.sort_index(ascending=True, inplace=True)
+
+    # Total value per day & stock, sorted by date (older days averaged into buckets when there are too many)
+    daily_totals = downsample(report_data.value_pivot(), max_points)
 
     # Plot the stacked area chart for each name
-    fig, ax = plt.subplots(figsize=(15, 5))
+    fig, ax = new_figure()
 
-    # Initialize a baseline (starting point for the stacking)
-    baseline = pd.Series(0, index=daily_totals.index)
-    
-    # Plot each stock's value over time and color the area under the curve
-    for id in daily_totals.columns:
-        color = color_mapping[id]
-        name = stock_mapping[id]
-        ax.fill_between(daily_totals.index, baseline, baseline + daily_totals[id], label=name, color = color)
-        baseline += daily_totals[id]
+    # Plot every stock's value over time as one stacked area chart
+    if not daily_totals.columns.empty:
+        ax.stackplot(daily_totals.index, daily_totals.to_numpy().T,
+                     labels=[stock_mapping[id] for id in daily_totals.columns],
+                     colors=[color_mapping[id] for id in daily_totals.columns])
 
-    for change_date in change_dates_df['dt']:
+    for change_date in report_data.change_dates:
         ax.axvline(x=change_date, color='gray', linestyle=':')
 
     # Formatting the plot
@@ -415,164 +601,102 @@ def plot_total_value(engine, visual_reports_dir):
     ax.set_title('Portfolio Value Over Time')
     ax.set_xlabel('Date')
     ax.set_ylabel('Value')
-    plt.xticks(rotation=45)
-    plt.tight_layout()  # Adjust the plot to ensure everything fits without overlapping
-    
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()  # Adjust the plot to ensure everything fits without overlapping
 
-    # Show the plot
-    #plt.show()
+    return fig
 
-    # Saving the plot as an image:
-    fig.savefig(os.path.join(visual_reports_dir, 'total_portfolio' + '.png'))
-    plt.close(fig)  # Close the figure to free memory
-
-
-def plot_combined_profits(engine, visual_reports_dir):
-    with engine.connect() as conn:
 
-        profit_query = """
-                SELECT 
-                    ph.id, 
-                    s.name, 
-                    ph.profit, 
-                    ph.dt, 
-                    c.color_name_hex
-                FROM portfolio_history ph
-                JOIN stocks s ON ph.id = s.id
-                JOIN colors c ON s.color_id = c.color_id
-                ORDER BY s.id ASC
-                """
-        profit_df = pd.read_sql(profit_query, conn)
-
-        # Retrieve all change dates from changes
-        change_dates_df = pd.read_sql("SELECT DISTINCT dt FROM changes", conn)
+def plot_combined_profits(report_data, window='all', max_points=None):
+    report_data = report_data.windowed(window)
 
     # Extract color mapping
-    color_mapping = dict(zip(profit_df['id'], profit_df['color_name_hex']))
-    name_mapping = dict(zip(profit_df['id'], profit_df['name']))
+    color_mapping = report_data.color_mapping
+    name_mapping = report_data.name_mapping
+
+    # Profit per day & stock, sorted by date (older days averaged into buckets when there are too many)
+    daily_profits = downsample(report_data.profit_pivot(), max_points)
 
     # Create figure and axis
-    fig, ax = plt.subplots(figsize=(15, 5))
+    fig, ax = new_figure()
 
-    # Group by 'dt' and sum 'profit' to get the total profit per day
-    total_profit_series = profit_df.groupby('dt')['profit'].sum()
+    # Sum 'profit' to get the total profit per day
+    total_profit_series = daily_profits.sum(axis=1)
 
     # Plot total sum of profits as a black curve
     ax.plot(total_profit_series.index, total_profit_series, label='Total Profit', color='black')
 
-    for change_date in change_dates_df['dt']:
+    for change_date in report_data.change_dates:
         ax.axvline(x=change_date, color='gray', linestyle=':')
 
     # Plot positive and negative profits using helper function
     used_labels = set()  # Set to keep track of used labels
-    plot_profits(ax, profit_df[profit_df['profit'] > 0], color_mapping, name_mapping, 'Positive Profits', 0, used_labels)
-    plot_profits(ax, profit_df[profit_df['profit'] < 0], color_mapping, name_mapping, 'Negative Profits', 0, used_labels)
+    positive_profits = daily_profits.where(daily_profits > 0, 0)
+    negative_profits = daily_profits.where(daily_profits < 0, 0)
+    plot_profits(ax, positive_profits.loc[:, (positive_profits != 0).any()], color_mapping, name_mapping, 'Positive Profits', 0, used_labels)
+    plot_profits(ax, negative_profits.loc[:, (negative_profits != 0).any()], color_mapping, name_mapping, 'Negative Profits', 0, used_labels)
 
     # Formatting the plot
     ax.legend(loc='upper left')
     ax.set_title('Portfolio Profits Over Time')
     ax.set_xlabel('Date')
     ax.set_ylabel('Profit (euro)')
-    plt.xticks(rotation=45)
-    plt.grid(True)
-    plt.tight_layout()  # Adjust the plot to ensure everything fits without overlapping
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.grid(True)
+    fig.tight_layout()  # Adjust the plot to ensure everything fits without overlapping
 
-    # Show the plot
-    #plt.show()
+    return fig
 
-    # Saving the plot as an image:
-    fig.savefig(os.path.join(visual_reports_dir, 'combined_profits' + '.png'))
-    plt.close(fig)  # Close the figure to free memory
 
 
 
 
+def plot_profits(ax, daily_totals, color_mapping, name_mapping, title, start_baseline, used_labels):
+    # daily_totals: date x stock id profits, sorted by date
 
-def plot_profits(ax, profit_df, color_mapping, name_mapping, title, start_baseline, used_labels):
-    # Group by 'dt' and 'id' and sum 'profit' to get the total value per day
-    daily_totals = profit_df.groupby(['dt', 'id'])['profit'].sum().unstack('id').fillna(0)
+    if daily_totals.columns.empty:
+        return
 
-    # Sort the DataFrame by date to ensure correct plotting
-    daily_totals.sort_index(ascending=True, inplace=True)
+    # Label every stock once across the positive & negative stacks
+    labels = []
+    for id in daily_totals.columns:
+        label = name_mapping[id] if name_mapping[id] not in used_labels else '_nolegend_'
+        used_labels.add(name_mapping[id])
+        labels.append(label)
+    colors = [color_mapping[id] for id in daily_totals.columns]
+    layers = daily_totals.to_numpy().T
 
-    # Initialize a baseline for stacking
-    baseline = pd.Series(start_baseline, index=daily_totals.index)
+    # Stack on top of the baseline by adding it as an invisible first layer
+    if start_baseline:
+        layers = np.vstack([np.full(len(daily_totals), float(start_baseline)), layers])
+        labels, colors = ['_nolegend_'] + labels, ['none'] + colors
 
-    # Plot each stock's profit over time and color the area under the curve
-    for id in daily_totals.columns:
-        color = color_mapping[id]
-        label = name_mapping[id] if name_mapping[id] not in used_labels else None
-        if label:  # If label is not None, add to used_labels set
-            used_labels.add(label)
-        ax.fill_between(daily_totals.index, baseline, baseline + daily_totals[id], label=label, color=color)
-        baseline += daily_totals[id]
+    # Plot every stock's profit over time as one stacked area chart
+    ax.stackplot(daily_totals.index, layers, labels=labels, colors=colors)
 
 
 
-def plot_stock_growth(engine, visual_reports_dir):
-    with engine.connect() as conn:
-        # Retrieve all history from portfolio_history with growth calculated
-        query = """
-        WITH previous_profits as
-        (
-            SELECT
-                ph.id,
-                s.name,
-                ph.end_price as price,
-                LAG(ph.end_price, 1, end_price) OVER (PARTITION BY ph.id ORDER BY ph.dt) AS prev_price,
-                ph.dt,
-                c.color_name_hex
-            FROM portfolio_history ph
-            JOIN stocks s ON ph.id = s.id
-            JOIN colors c ON s.color_id = c.color_id
-        ),
-        growth AS
-        (
-            SELECT
-                id,
-                name,
-                (price-prev_price)*100/prev_price as growth,
-                dt,
-                color_name_hex
-            FROM previous_profits
-        )
-        SELECT * FROM growth
-        WHERE growth != 0
-        ORDER BY id ASC, dt ASC
-        """
-        growth_df = pd.read_sql(query, conn)
-
-        # Retrieve all change dates from changes
-        change_dates_df = pd.read_sql("SELECT DISTINCT dt FROM changes", conn)
+def plot_stock_growth(report_data, window='all', max_points=None):
+    report_data = report_data.windowed(window)
 
+    # Growth of every stock from one record to the next, one column per stock over every day of the range
+    # (spikes are kept when older days are merged into buckets)
+    daily_growth = downsample(report_data.growth_pivot(), max_points, how='peak')
 
     # Extract color mapping
-    color_mapping = dict(zip(growth_df['id'], growth_df['color_name_hex']))
-    name_mapping = dict(zip(growth_df['id'], growth_df['name']))
-
-    # Create a date range from min to max date
-    date_range = pd.date_range(start=growth_df['dt'].min(), end=growth_df['dt'].max())
+    color_mapping = report_data.color_mapping
+    name_mapping = report_data.name_mapping
 
     # Plot the growth for each stock
-    fig, ax = plt.subplots(figsize=(15, 5))
-
-    # Get a list of unique stock ids
-    stock_ids = growth_df['id'].unique()
+    fig, ax = new_figure()
 
     # Plot each stock's growth over time
-    for id in stock_ids:
-        stock_growth = growth_df[growth_df['id'] == id]
-        
-        # We need to reindex the growth data to include all dates, filling missing values with 0 growth
-        stock_growth.set_index('dt', inplace=True)
-        stock_growth = stock_growth.reindex(date_range, fill_value=0).reset_index().rename(columns={'index': 'dt'})
-        
-        # Plotting the growth
-        ax.plot(stock_growth['dt'], stock_growth['growth'], color='gray', linewidth=2)
-        ax.plot(stock_growth['dt'], stock_growth['growth'], label=name_mapping[id], color=color_mapping[id], linewidth=1.5)
+    for id in daily_growth.columns:
+        ax.plot(daily_growth.index, daily_growth[id], color='gray', linewidth=2)
+        ax.plot(daily_growth.index, daily_growth[id], label=name_mapping[id], color=color_mapping[id], linewidth=1.5)
 
     # indicate changes
-    for change_date in change_dates_df['dt']:
+    for change_date in report_data.change_dates:
         ax.axvline(x=change_date, color='gray', linestyle=':')
     
     # Plot growth = 0 line:
@@ -583,29 +707,78 @@ def plot_stock_growth(engine, visual_reports_dir):
     ax.set_title('Stock Profit Growth Over Time')
     ax.set_xlabel('Date')
     ax.set_ylabel('Growth')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+
+    return fig
 
-    # Show the plot
-    #plt.show()
 
-    # Saving the plot as an image:
 
-    fig.savefig(os.path.join(visual_reports_dir, 'growth' + '.png'))
-    plt.close(fig)  # Close the figure to free memory
+def new_figure():
+    # Headless figure drawn on its own Agg canvas - no pyplot global state, so charts can be rendered in worker processes
+    # (matplotlib is only imported once a chart is drawn)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(15, 5))
+    FigureCanvasAgg(fig)
+    return fig, fig.subplots()
+
+
+# Charts of the daily report: file name -> plot function (in the order they are sent)
+REPORT_CHARTS = {
+    'total_portfolio': plot_total_value,
+    'combined_profits': plot_combined_profits,
+    'growth': plot_stock_growth,
+}
+
+
+def render_chart(chart_name, report_data, window='all', max_points=None):
+    # Draws one chart into an in-memory PNG, returns (chart name, PNG bytes, rendering time in seconds)
+    start = time.perf_counter()
+    fig = REPORT_CHARTS[chart_name](report_data, window, max_points)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return chart_name, buffer.getvalue(), time.perf_counter() - start
+
+
+def render_reports(report_data, max_workers=None, window='all', max_points=None, visual_reports_dir=None, pool=None):
+    # Draw all charts in parallel worker processes, returns {file name: PNG bytes} & the rendering time (seconds) of every chart.
+    # The charts are also written to 'visual_reports_dir' when it is given. 'pool' - an already running executor to draw them on
+    max_workers = max_workers or min(len(REPORT_CHARTS), os.cpu_count() or 1)
+    if max_workers == 1:
+        rendered = [render_chart(chart_name, report_data, window, max_points) for chart_name in REPORT_CHARTS]
+    else:
+        with contextlib.nullcontext(pool) if pool else ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(render_chart, chart_name, report_data, window, max_points) for chart_name in REPORT_CHARTS]
+            rendered = [future.result() for future in futures]
+
+    charts = {chart_name + '.png': png for chart_name, png, _ in rendered}
+    if visual_reports_dir:
+        save_charts(charts, visual_reports_dir)
+
+    return charts, {chart_name: seconds for chart_name, _, seconds in rendered}
+
+
+def save_charts(charts, visual_reports_dir):
+    os.makedirs(visual_reports_dir, exist_ok=True)
+    for file_name, png in charts.items():
+        with open(os.path.join(visual_reports_dir, file_name), 'wb') as file:
+            file.write(png)
 
 
 
 
 # Generating colors:
 def generate_and_store_colors(engine, num_colors=50):
+    from matplotlib import colormaps
+    from matplotlib.colors import to_hex
 
     cmaps_list = ['tab20', 'tab20b', 'tab20c']
 
     # Generate the list of color hex codes
     colors = []
     for cmap_name in cmaps_list:
-        cmap = plt.get_cmap(cmap_name)
+        cmap = colormaps[cmap_name]
         # Extract colors from the colormap
         for i in range(cmap.N):
             rgb = cmap(i)[:3]  # will return rgba, we take only first 3 to get rgb
@@ -631,25 +804,10 @@ def generate_and_store_colors(engine, num_colors=50):
 ############################################################################################
 
 def important_triggers(engine):
-
-    message_list = []
-
-    ### Look for important events:
-    with engine.connect() as conn:
-
-        total_profit = """
-                            SELECT
-                                total_profit
-                            FROM portfolio
-                            WHERE total_profit > 500
-                            ORDER BY DT DESC
-                            LIMIT 1
-                        """
-        tax_free_profit = pd.read_sql(total_profit, conn)
-
-    if not tax_free_profit.empty:
-        message_list.append('TAX FREE PROFIT ALERT: you can only cash out 500 euros per year without paying taxes.')
-
+    # Alerts are declared in alert_rules.ALERT_RULES & evaluated together against one snapshot of the latest data,
+    # each one is sent once when its condition starts to hold (state kept in alert_state)
+    with engine.begin() as conn:
+        message_list = evaluate_alerts(conn)
 
     return message_list
 
@@ -664,20 +822,12 @@ def important_triggers(engine):
     
 
 
-async def telegram_send_updates(engine, token, chatId, visual_reports_dir, trigger_messages):
-
-    bot = Bot(token=token)
-
-    ### Construct summary:
+def portfolio_summary(engine, analytics_options=None):
+    # Summary message built from the latest portfolio_daily row, followed by the risk & performance figures (see analytics.py)
+    from analytics import analytics_summary
     with engine.connect() as conn:
-        profit_over_time = """
-                        SELECT
-                            *
-                        FROM portfolio
-                        ORDER BY dt DESC
-                        LIMIT 1
-                        """
-        profit_over_time_df = pd.read_sql(profit_over_time, conn)
+        profit_over_time_df = pd.read_sql(sql_latest_portfolio_daily, conn)
+        analytics_lines = analytics_summary(conn, **(analytics_options or {}))
     profit_dict = profit_over_time_df.iloc[0].to_dict()
 
     message_lines = ['Portfolio Summary:']
@@ -689,34 +839,25 @@ async def telegram_send_updates(engine, token, chatId, visual_reports_dir, trigg
                 message_lines.append(f'{label}: {value:.3f}')
             else:
                 message_lines.append(f'{label}: {value}')
+    if analytics_lines:
+        message_lines += [''] + analytics_lines
 
     # Join the message lines into a single string
-    message = '\n'.join(message_lines)
-
-    await bot.send_message(chat_id=chatId, text=message)
-    
+    return '\n'.join(message_lines)
 
-    ### Construct and send the media group message:
-    image_paths = [
-        visual_reports_dir+'\\combined_profits.png',
-        visual_reports_dir+'\\growth.png',
-        visual_reports_dir+'\\total_portfolio.png'
-    ]
 
-    media_group = [InputMediaPhoto(open(path, 'rb').read(), caption=path.split('\\')[-1]) for path in image_paths]
+async def telegram_send_updates(engine, token, chatId, charts, trigger_messages, base_url=None, max_retries=3, backoff_seconds=1.0,
+                                analytics_options=None):
+    # Sends the summary, the charts ({file name: PNG bytes}) & the trigger messages concurrently,
+    # returns the deliveries that failed after all retries
+    from telegram_delivery import TelegramSender
+    sender = TelegramSender(token, chatId, base_url=base_url, max_retries=max_retries, backoff_seconds=backoff_seconds)
+    return await sender.send_update(telegram_messages(engine, trigger_messages, analytics_options), charts)
 
-    await bot.send_media_group(chat_id=chatId, media=media_group)
 
-    # Close all opened image files
-    for path in image_paths:
-        open(path, 'rb').close()
-
-
-    ### Construct important messages:
+def telegram_messages(engine, trigger_messages, analytics_options=None):
+    ### Construct summary & important messages:
+    text_messages = [portfolio_summary(engine, analytics_options)]
     if trigger_messages:
-        message = '\n'.join(trigger_messages)
-        await bot.send_message(chat_id=chatId, text=message)
-
-
-
-
+        text_messages.append('\n'.join(trigger_messages))
+    return text_messages
@@ -0,0 +1,223 @@
+import functions as f
+from alert_rules import AlertSnapshot, evaluate_alerts, sql_alert_portfolio
+from storage import dialect_text
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+
+
+
+
+#######################################################################################
+############################### INTRADAY REFRESH: #####################################
+#######################################################################################
+
+# 'python main.py intraday' polls the latest quotes of the held stocks every INTRADAY_INTERVAL_SECONDS between the daily runs:
+#   1) only the delta is requested - quotes newer than each ticker's last stored one (price_provider.fetch_quotes)
+#   2) the new quotes are appended to intraday_quotes (ticker, ts, price - COPY on Postgres)
+#   3) the in-memory valuation (positions of the latest portfolio_history day x latest quotes) is updated & the alert rules
+#      are evaluated against it, so alerts fire within minutes. The alert state is shared with the daily run, an alert sent
+#      intraday is not sent again the next morning
+# Nothing of the daily pipeline runs: no history insert, no charts. Positions & totals are reloaded only when a daily run
+# has added a new day to portfolio_history.
+#
+# Compaction: quotes of finished days are reduced to the day's last quote (its close) & dropped once portfolio_history holds
+# the official close of that day. Timestamps are UTC.
+
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def quotes_start(history_dt):
+    # Quotes belong to the days after the latest portfolio_history day
+    return datetime.combine(history_dt + timedelta(days=1), datetime.min.time())
+
+
+def last_history_dt(connection):
+    last_dt = connection.execute(f.sql_last_runtime).scalar()
+    return None if last_dt is None else datetime.strptime(str(last_dt), '%Y-%m-%d').date()
+
+
+sql_intraday_positions = text('''
+                SELECT id, ticker, name, end_price AS prev_price, shares, invested
+                FROM portfolio_history
+                WHERE dt = :history_dt''')
+
+sql_latest_quotes = text('''
+                SELECT q.ticker, q.ts, q.price
+                FROM intraday_quotes q
+                JOIN
+                (
+                    SELECT ticker, MAX(ts) AS ts
+                    FROM intraday_quotes
+                    WHERE ts >= :since
+                    GROUP BY ticker
+                ) latest
+                    ON latest.ticker = q.ticker
+                    AND latest.ts = q.ts''')
+
+sql_delete_closed_quotes = text('''
+                DELETE FROM intraday_quotes
+                WHERE ts < :before''')
+
+sql_compact_quotes = dialect_text('''
+                DELETE FROM intraday_quotes AS q           -- all but the last quote of each ticker & finished day
+                WHERE q.ts < :before
+                    AND EXISTS
+                    (
+                        SELECT 1 FROM intraday_quotes later
+                        WHERE later.ticker = q.ticker
+                            AND later.ts > q.ts
+                            AND CAST(later.ts AS DATE) = CAST(q.ts AS DATE)
+                    )''', sqlite='''
+                DELETE FROM intraday_quotes AS q
+                WHERE q.ts < :before
+                    AND EXISTS
+                    (
+                        SELECT 1 FROM intraday_quotes later
+                        WHERE later.ticker = q.ticker
+                            AND later.ts > q.ts
+                            AND DATE(later.ts) = DATE(q.ts)
+                    )''')
+
+
+def compact_quotes(connection, now=None):
+    # Drops the quotes of days already in portfolio_history & all but the close of the other finished days, returns the rows deleted
+    history_dt = last_history_dt(connection)
+    deleted = 0
+    if history_dt is not None:
+        deleted += connection.execute(sql_delete_closed_quotes, {'before': quotes_start(history_dt)}).rowcount
+    today = datetime.combine((now or utc_now()).date(), datetime.min.time())
+    deleted += connection.execute(sql_compact_quotes, {'before': today}).rowcount
+    return deleted
+
+
+def store_quotes(connection, quotes):
+    # Plain datetime objects, so that both drivers store them as timestamps
+    frame = pd.DataFrame({'ticker': quotes['ticker'].to_numpy(), 'ts': pd.Series([ts.to_pydatetime() for ts in quotes['ts']], dtype=object),
+                          'price': quotes['price'].astype(float).to_numpy()})
+    return f.copy_rows(connection, 'intraday_quotes', frame)
+
+
+
+#######################################################################################
+############################### IN-MEMORY VALUATION: ##################################
+#######################################################################################
+
+
+class IntradayPortfolio:
+
+    # positions - latest portfolio_history record of every stock by ticker: id, name, shares, invested & prev_price (its close that day)
+    # daily     - latest portfolio_daily row + its twr, twr_peak & drawdown (see alert_rules.AlertSnapshot), None if empty
+    # prices    - latest known price of every ticker (quote, or prev_price before the first one), last_ts - time of that quote
+    def __init__(self, history_dt, positions, daily, quotes):
+        self.history_dt = history_dt
+        self.positions = positions
+        self.daily = daily
+        self.prices = positions['prev_price'].astype(float)
+        self.last_ts = pd.Series(quotes_start(history_dt), index=positions.index, dtype='datetime64[us]')
+        self.apply_quotes(quotes)
+
+
+    @classmethod
+    def load(cls, connection, history_dt):
+        positions = pd.read_sql(sql_intraday_positions, connection, params={'history_dt': history_dt})
+        positions = positions.astype({'prev_price': float, 'shares': float, 'invested': float}).set_index('ticker')
+        daily = pd.read_sql(sql_alert_portfolio, connection).astype({'twr': float, 'twr_peak': float, 'drawdown': float})
+        quotes = pd.read_sql(sql_latest_quotes, connection, params={'since': quotes_start(history_dt)})
+        quotes['ts'] = pd.to_datetime(quotes['ts'])
+        return cls(history_dt, positions, None if daily.empty else daily.iloc[0].to_dict(), quotes)
+
+
+    def apply_quotes(self, quotes):
+        latest = quotes.sort_values('ts', kind='stable').drop_duplicates(subset='ticker', keep='last').set_index('ticker')
+        latest = latest[latest.index.isin(self.positions.index)]
+        self.prices.update(latest['price'].astype(float))
+        self.last_ts.update(latest['ts'])
+
+
+    def since(self):
+        # {ticker: last quote timestamp} - the delta request of the next poll
+        return self.last_ts.to_dict()
+
+
+    def snapshot(self, dt):
+        # AlertSnapshot of the current prices, in the shape of the stored one (see alert_rules.AlertSnapshot)
+        positions = self.positions
+        stocks = pd.DataFrame({'ticker': positions.index, 'name': positions['name'].to_numpy(), 'end_price': self.prices.to_numpy(),
+                               'prev_price': positions['prev_price'].to_numpy()})
+        stocks['move'] = ((stocks['end_price'] - stocks['prev_price']) * 100 / stocks['prev_price']).fillna(0)
+        stocks['value'] = stocks['end_price'] * positions['shares'].to_numpy()
+        stocks['profit'] = stocks['value'] - positions['invested'].to_numpy()
+        total_value = stocks['value'].sum()
+        stocks['weight'] = stocks['value'] / total_value if total_value else 0.0
+
+        if positions.empty:
+            return AlertSnapshot(None, stocks)
+
+        # Today's totals on top of the latest daily row: its longer term changes are kept, the 1 day change is recomputed.
+        # The positions are those of the daily row, so today's return continues its time-weighted return without flows
+        portfolio = dict(self.daily or {})
+        previous_value = portfolio.get('total_value')
+        twr, twr_peak = portfolio.get('twr', np.nan), portfolio.get('twr_peak', np.nan)
+        if previous_value and pd.notna(twr):
+            twr = twr * total_value / previous_value
+            twr_peak = max(twr_peak, twr)
+        portfolio.update({
+            'dt': dt,
+            'total_value': total_value,
+            'total_profit': stocks['profit'].sum(),
+            'change': None,
+            'ch_1d_ago': round((total_value - previous_value) / previous_value, 3) if previous_value else None,
+            'twr': twr,
+            'twr_peak': twr_peak,
+            'drawdown': 1 - twr / twr_peak if pd.notna(twr) else np.nan,
+        })
+        return AlertSnapshot(portfolio, stocks)
+
+
+
+#######################################################################################
+############################### POLLING: ##############################################
+#######################################################################################
+
+
+class IntradayRefresh:
+
+    def __init__(self, engine, price_provider, rules=None):
+        self.engine = engine
+        self.price_provider = price_provider
+        self.rules = rules
+        self.portfolio = None
+        self.compacted_day = None
+
+
+    def poll(self, now=None):
+        # One refresh: delta quotes -> intraday_quotes -> valuation -> alerts. Returns (new quotes, snapshot, alert messages)
+        now = now or utc_now()
+        with self.engine.begin() as connection:
+            history_dt = last_history_dt(connection)
+            if history_dt is None:
+                return pd.DataFrame(columns=['ts', 'price', 'ticker']), None, []
+
+            # Reload the positions after a daily run, compact once a day (and after a daily run)
+            if self.portfolio is None or self.portfolio.history_dt != history_dt or self.compacted_day != now.date():
+                deleted = compact_quotes(connection, now)
+                if deleted:
+                    print(f"Compacted intraday quotes: {deleted} rows deleted")
+                self.compacted_day = now.date()
+                self.portfolio = IntradayPortfolio.load(connection, history_dt)
+
+            quotes = self.price_provider.fetch_quotes(self.portfolio.since())
+            quotes = quotes[np.asarray(quotes['ts'] <= now, dtype=bool)] if not quotes.empty else quotes
+            if quotes.empty:
+                return quotes, self.portfolio.snapshot(now.date()), []
+
+            store_quotes(connection, quotes)
+            self.portfolio.apply_quotes(quotes)
+            snapshot = self.portfolio.snapshot(now.date())
+            messages = evaluate_alerts(connection, self.rules, dt=now.date(), snapshot=snapshot)
+
+        return quotes, snapshot, messages
@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+
+
+
+
+#######################################################################################
+############################### FIFO LOT LEDGER: ######################################
+#######################################################################################
+
+# Purchase records ("lots") of every ticker are kept as NumPy arrays in FIFO order:
+#   dt, price, share  - purchase date, purchase price & shares still held
+#   record            - row position in the records the ledger was loaded with (-1 for lots bought through apply)
+#   change            - row position of the change that bought the lot (-1 for loaded lots)
+#
+# A sequence of changes (share > 0 buy, share < 0 sell, share = 0 sell all) is resolved per ticker without row loops:
+#   * B[k] - shares bought up to change k, C[i] - cumulative lot boundaries, both plain cumsums.
+#   * S[k] - shares consumed from the front of the lot queue after change k. A sale can't consume more than was bought
+#     before it, S[k] = min(S[k-1] + x[k], B[k]), which unrolls into cumsum + running minimum:
+#         S = X + min(0, minimum.accumulate(B - X)),   X = cumsum(x)
+#   * sale k consumes the interval [S[k-1]; S[k]) of the lot queue, lots are matched to it with searchsorted.
+# A sale of more shares than held at that point raises ValueError.
+
+EPSILON = 1e-9
+
+LOT_FIELDS = ['dt', 'price', 'share', 'record', 'change']
+
+
+class LotLedger:
+
+    def __init__(self, records=None):
+        self.books = {}
+        if records is not None and not records.empty:
+            self.load(records)
+
+
+    def load(self, records):
+        # records: DataFrame with 'ticker', 'price', 'share', 'dt' (e.g. rows of active_stocks_info)
+        records = records.reset_index(drop=True)
+        positions = np.arange(len(records))
+        for ticker, index in records.groupby('ticker', sort=False).indices.items():
+            group = records.iloc[index]
+            order = np.argsort(to_days(group['dt']), kind='stable')
+            self.books[ticker] = {
+                'dt': to_days(group['dt'])[order],
+                'price': group['price'].to_numpy(dtype=float)[order],
+                'share': group['share'].to_numpy(dtype=float)[order],
+                'record': positions[index][order],
+                'change': np.full(len(index), -1),
+            }
+
+
+    def lots(self, tickers=None):
+        tickers = self.books.keys() if tickers is None else tickers
+        frames = [pd.DataFrame(dict(self.books[ticker], ticker=ticker)) for ticker in tickers if ticker in self.books]
+        if not frames:
+            return pd.DataFrame(columns=['ticker'] + LOT_FIELDS)
+        lots = pd.concat(frames, ignore_index=True)[['ticker'] + LOT_FIELDS]
+        lots['dt'] = pd.to_datetime(lots['dt']).dt.date
+        return lots
+
+
+    def apply(self, changes):
+        # changes: DataFrame with 'ticker', 'price', 'share', 'dt' in the order they happened
+        changes = changes.reset_index(drop=True)
+        holdings = np.zeros(len(changes))
+        invested = np.zeros(len(changes))
+        changed_lots, realized = [], []
+
+        for ticker, index in changes.groupby('ticker', sort=False).indices.items():
+            book = self.books.get(ticker, empty_book())
+            book, held, held_cost, ticker_changed, ticker_realized = resolve_ticker(book, changes.iloc[index], index)
+            self.books[ticker] = book
+            holdings[index] = held
+            invested[index] = held_cost
+            changed_lots.append(ticker_changed.assign(ticker=ticker))
+            realized.append(ticker_realized.assign(ticker=ticker))
+
+        return LedgerResult(holdings, invested, concat_or_empty(changed_lots, CHANGED_LOT_COLUMNS),
+                            concat_or_empty(realized, REALIZED_COLUMNS))
+
+
+
+class LedgerResult:
+
+    # holdings      - shares held of the ticker right after each change (aligned with the applied changes)
+    # invested      - purchase cost of those shares (sum of share * price over the lots still held)
+    # changed_lots  - lots that were 'added' (bought & still held), 'updated' (partly sold) or 'removed' (sold out)
+    # realized      - one record per sale: shares sold, proceeds, FIFO cost basis & realized gain
+    def __init__(self, holdings, invested, changed_lots, realized):
+        self.holdings = holdings
+        self.invested = invested
+        self.changed_lots = changed_lots
+        self.realized = realized
+
+
+
+#######################################################################################
+############################### VECTORIZED MATCHING: ##################################
+#######################################################################################
+
+CHANGED_LOT_COLUMNS = ['ticker', 'status'] + LOT_FIELDS
+REALIZED_COLUMNS = ['change', 'ticker', 'dt', 'shares_sold', 'sale_price', 'proceeds', 'cost_basis', 'realized_gain']
+
+
+def resolve_ticker(book, changes, change_positions):
+    share = changes['share'].to_numpy(dtype=float)
+    price = changes['price'].to_numpy(dtype=float)
+    days = to_days(changes['dt'])
+    is_buy = share > 0
+
+    # Lot queue: lots held so far followed by every lot bought in this sequence
+    queue = {
+        'dt': np.concatenate([book['dt'], days[is_buy]]),
+        'price': np.concatenate([book['price'], price[is_buy]]),
+        'share': np.concatenate([book['share'], share[is_buy]]),
+        'record': np.concatenate([book['record'], np.full(is_buy.sum(), -1)]),
+        'change': np.concatenate([book['change'], change_positions[is_buy]]),
+    }
+    lot_end = np.cumsum(queue['share'])
+    lot_start = lot_end - queue['share']
+
+    # Shares bought up to each change & shares consumed from the queue after each change
+    bought = book['share'].sum() + np.cumsum(np.where(is_buy, share, 0))
+    to_sell = np.where(is_buy, 0, np.where(share == 0, bought, -share))        # sell all <==> sell everything bought
+    sold_total = np.cumsum(to_sell)
+    consumed = sold_total + np.minimum(0, np.minimum.accumulate(bought - sold_total))
+    consumed_before = np.concatenate([[0.0], consumed[:-1]])
+    held = np.where(bought - consumed < EPSILON, 0, bought - consumed)
+
+    oversold = np.flatnonzero((share < 0) & (to_sell - (consumed - consumed_before) > EPSILON))
+    if len(oversold):
+        k = oversold[0]
+        raise ValueError(f"Cannot sell {to_sell[k]:g} shares of {changes['ticker'].iloc[k]} on {pd.Timestamp(days[k]).date()}: "
+                         f"only {bought[k] - consumed_before[k]:g} held")
+
+    # Split the consumed part of the queue at every lot & sale boundary and match each piece to its lot & sale
+    total_consumed = consumed[-1] if len(consumed) else 0.0
+    cuts = np.unique(np.concatenate([[0.0], lot_end, consumed]))
+    cuts = cuts[cuts <= total_consumed]
+    piece_start, piece_size = cuts[:-1], np.diff(cuts)
+    piece_lot = np.searchsorted(lot_end, piece_start, side='right')
+    piece_sale = np.searchsorted(consumed, piece_start, side='right')
+    cost_basis = np.bincount(piece_sale, weights=piece_size * queue['price'][piece_lot], minlength=len(share))
+
+    # Cost of the shares held after each change: everything bought so far minus the cost basis sold so far
+    bought_cost = (book['share'] * book['price']).sum() + np.cumsum(np.where(is_buy, share * price, 0))
+    held_cost = np.where(held == 0, 0, bought_cost - np.cumsum(cost_basis))
+
+    is_sale = ~is_buy
+    shares_sold = (consumed - consumed_before)[is_sale]
+    realized = pd.DataFrame({
+        'change': change_positions[is_sale],
+        'dt': pd.to_datetime(days[is_sale]).date,
+        'shares_sold': shares_sold,
+        'sale_price': price[is_sale],
+        'proceeds': shares_sold * price[is_sale],
+        'cost_basis': cost_basis[is_sale],
+    })
+    realized['realized_gain'] = realized['proceeds'] - realized['cost_basis']
+
+    # Shares left in every lot of the queue & the lots that differ from what was held before
+    remaining = queue['share'] - np.clip(total_consumed - lot_start, 0, queue['share'])
+    remaining[remaining < EPSILON] = 0
+    was_held = np.arange(len(remaining)) < len(book['share'])
+    status = np.select(
+        [~was_held & (remaining > 0), was_held & (remaining == 0), was_held & (remaining != queue['share'])],
+        ['added', 'removed', 'updated'], default='')
+    is_changed = status != ''
+
+    changed = pd.DataFrame({field: queue[field][is_changed] for field in LOT_FIELDS})
+    changed['share'] = remaining[is_changed]
+    changed['status'] = status[is_changed]
+    changed['dt'] = pd.to_datetime(changed['dt'].to_numpy()).date
+
+    keep = remaining > 0
+    new_book = {field: queue[field][keep] for field in LOT_FIELDS}
+    new_book['share'] = remaining[keep]
+
+    return new_book, held, held_cost, changed, realized
+
+
+
+def empty_book():
+    return {'dt': np.array([], dtype='datetime64[D]'), 'price': np.array([]), 'share': np.array([]),
+            'record': np.array([], dtype=int), 'change': np.array([], dtype=int)}
+
+
+def to_days(dates):
+    return pd.to_datetime(pd.Series(dates)).to_numpy().astype('datetime64[D]')
+
+
+def concat_or_empty(frames, columns):
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
@@ -1,85 +1,367 @@
-import functions as f
 from config import DATABASE_URI, BASE_DIRECTORY, TOKEN, CHAT_ID
-import pandas as pd
-import shutil
+from config import PRICE_FIXTURE_PATH, PRICE_BATCH_SIZE, PRICE_MAX_WORKERS, PRICE_CALLS_PER_SECOND, PRICE_MAX_RETRIES, BASE_CURRENCY
+from config import PRICE_CACHE_FILE, PRICE_CACHE_FRESHNESS_HOURS, PRICE_CACHE_MAX_AGE_DAYS, PRICE_CACHE_MAX_ROWS
+from config import REPORT_WINDOW, REPORT_MAX_POINTS, SAVE_VISUAL_REPORTS
+from config import TELEGRAM_BASE_URL, TELEGRAM_MAX_RETRIES, TELEGRAM_BACKOFF_SECONDS
+from config import BACKFILL_CHUNK_DAYS, BACKFILL_MAX_WORKERS
+from config import CHANGES_DROP_DIRECTORY, CHANGES_MAX_WORKERS
+from config import RUN_LOG_FILE
+from config import INTRADAY_INTERVAL_SECONDS, INTRADAY_QUOTE_INTERVAL, PRICE_QUOTES_FIXTURE_PATH
+from config import SERVICE_HOST, SERVICE_PORT, SERVICE_EXCHANGES, SERVICE_RUN_DELAY_MINUTES
+from config import ANALYTICS_BENCHMARK, ANALYTICS_WINDOW_DAYS, ANALYTICS_RISK_FREE_RATE
+from run_log import RunLog
+import storage
+import argparse
+import time
 import os
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine
-import asyncio
+from sqlalchemy import text
 
+# pandas, matplotlib, yfinance & telegram are imported by the stages that need them (functions, price_providers, ...),
+# so a run with nothing to do finishes after one query
 
+# Risk & performance figures (see analytics.py), the same settings for the daily update & the Telegram summary
+ANALYTICS_OPTIONS = {'benchmark': ANALYTICS_BENCHMARK, 'window': ANALYTICS_WINDOW_DAYS, 'risk_free_rate': ANALYTICS_RISK_FREE_RATE}
 
 
-# Create the engine to connect to the PostgreSQL database
-engine = create_engine(DATABASE_URI)
 
 
-# Check for an excel file in local directory and read it:
-file_name = 'changes_in_portfolio.xlsx'
-portfolio_changes = f.portfolio_changes_etl_excel(file_name, BASE_DIRECTORY)
+def make_configured_price_provider():
+    from price_providers import make_price_provider
+    # Price source: Yahoo Finance by default, a local CSV/Parquet fixture when PRICE_FIXTURE_PATH is set (offline runs & benchmarks)
+    # Already downloaded closes are served from a local cache, only missing (ticker, date) ranges are requested,
+    # then converted into BASE_CURRENCY if one is set
+    price_cache_path = BASE_DIRECTORY + PRICE_CACHE_FILE if PRICE_CACHE_FILE else None
+    price_cache_options = {'freshness_hours': PRICE_CACHE_FRESHNESS_HOURS, 'max_age_days': PRICE_CACHE_MAX_AGE_DAYS, 'max_rows': PRICE_CACHE_MAX_ROWS}
+    return make_price_provider(PRICE_FIXTURE_PATH, price_cache_path, price_cache_options, PRICE_QUOTES_FIXTURE_PATH, BASE_CURRENCY,
+                               batch_size=PRICE_BATCH_SIZE, max_workers=PRICE_MAX_WORKERS,
+                               calls_per_second=PRICE_CALLS_PER_SECOND, max_retries=PRICE_MAX_RETRIES,
+                               quote_interval=INTRADAY_QUOTE_INTERVAL)
 
 
-# Connect to database:
-with engine.connect() as connection:
-    # Start transaction
-    with connection.begin() as transaction:                  
-        try:
+def newest_data_processed(engine):
+    # Cheap check before the heavy imports: yesterday is already in portfolio_history
+    with engine.connect() as connection:
+        last_runtime = connection.execute(text('SELECT MAX(dt) FROM portfolio_history')).scalar()
+    if last_runtime is None:
+        return False
+    last_runtime = datetime.strptime(str(last_runtime), '%Y-%m-%d').date()
+    return last_runtime + timedelta(days=1) >= datetime.now().date()
+
+
+def run_daily_update(engine, price_provider, run_log, report_cache=None):
+    # New days into the database, then the alerts, charts & Telegram update of them. Returns False if there was nothing new
+    if not update_database(engine, price_provider, run_log):
+        return False
+    send_updates(engine, run_log, report_cache)
+    return True
+
 
-            # Gather last runtime date:
-            last_runtime = str(connection.execute(f.sql_last_runtime).fetchone()[0])
-            last_runtime = datetime.strptime(last_runtime, '%Y-%m-%d').date()
+def update_database(engine, price_provider, run_log):
+    import functions as f
+    import change_ingestion
+    import intraday
+    import analytics
+    import pandas as pd
+
+    # Connect to database:
+    with engine.connect() as connection:
+        # Start transaction (rolled back if any stage before the commit fails, the error is kept in the run log)
+        with connection.begin() as transaction:
+
+            # Gather last runtime date (None on the first run after init-db, see below):
+            last_runtime = connection.execute(f.sql_last_runtime).scalar()
+            if last_runtime is not None:
+                last_runtime = datetime.strptime(str(last_runtime), '%Y-%m-%d').date()
             #last_runtime = datetime.strptime('2024-02-20', '%Y-%m-%d').date()
 
             # If latest day not executed, collect new data and place it into a staging table:
-            if last_runtime + timedelta(days=1) < datetime.now().date():
+            if last_runtime is not None and last_runtime + timedelta(days=1) >= datetime.now().date():
+                print("Newest available data has been already processed")
+                return False
 
-                # Look for changes in portfolio:
-                if not portfolio_changes.empty:
-                    f.process_portfolio_changes(file_name, BASE_DIRECTORY, portfolio_changes, engine, connection, f.sql_active_stocks)     
-                    print(portfolio_changes)  
-            
+            # Look for changes in portfolio (new files of the drop directory, all applied as one batch):
+            with run_log.span('change_ingestion') as span:
+                pending = change_ingestion.load_pending_changes(connection, BASE_DIRECTORY + CHANGES_DROP_DIRECTORY, CHANGES_MAX_WORKERS)
+                span.update(rows=len(pending.changes), files=len(pending.files), bytes=int(pending.files['bytes'].sum()),
+                            rejected_files=int(pending.errors['file'].nunique()))
+            if not pending.changes.empty:
+                with run_log.span('apply_changes', rows=len(pending.changes)):
+                    f.apply_portfolio_changes(pending.changes, connection, f.sql_active_stocks)
+                print(pending.changes)
+            change_ingestion.record_ingested(connection, pending.files)
 
-                # Gather currently purchased stock details
-                active_stocks = pd.read_sql_query(f.sql_active_stocks, engine)
+            # Empty portfolio_history: the history starts on the earliest change (just applied or stored before), else yesterday
+            if last_runtime is None:
+                first_change = connection.execute(f.sql_first_change).scalar()
+                first_day = datetime.strptime(str(first_change)[:10], '%Y-%m-%d').date() if first_change is not None \
+                    else datetime.now().date() - timedelta(days=1)
+                last_runtime = first_day - timedelta(days=1)
+                print(f"portfolio_history is empty, starting it on {first_day}")
 
-                # Pull updates and insert them into staging table in postgres
-                new_stock_info_df = f.get_stock_info(active_stocks, last_runtime)
-                new_stock_info_df.to_sql('new_data_stg', con=engine, if_exists='replace', index=False, method='multi')
 
+            # Gather currently purchased stock details
+            active_stocks = pd.read_sql_query(f.sql_active_stocks, connection)
 
-                # Insert new data into portfolio history:
-                connection.execute(f.sql_insert_history)
+            # Pull updates and stream them into the staging table (same transaction)
+            with run_log.span('price_fetch', tickers=len(active_stocks)) as span:
+                new_stock_info_df = f.get_stock_info(active_stocks, last_runtime, price_provider)
+                span['rows'] = len(new_stock_info_df)
+            with run_log.span('staging') as span:
+                span['rows'], span['bytes'] = f.load_staging(connection, new_stock_info_df)
 
-                # # Update active stock values:
-                connection.execute(f.sql_update_stock_price)
 
-                # Commit the transaction
+            # Insert new data into portfolio history:
+            with run_log.span('history_insert') as span:
+                span['rows'] = connection.execute(f.sql_insert_history).rowcount
+
+            # Intraday quotes of the days that now have their close in portfolio_history are no longer needed:
+            with run_log.span('intraday_compaction') as span:
+                span['rows'] = intraday.compact_quotes(connection)
+
+            # Append the new days to the daily portfolio totals:
+            with run_log.span('portfolio_daily') as span:
+                span['rows'] = f.update_portfolio_daily(connection, last_runtime + timedelta(days=1))
+
+            # Risk & performance figures of the new trading days (rolling window continued from the stored days):
+            with run_log.span('analytics') as span:
+                span['rows'] = analytics.update_analytics(connection, price_provider, **ANALYTICS_OPTIONS)
+
+            # # Update active stock values:
+            with run_log.span('price_update') as span:
+                span['rows'] = connection.execute(f.sql_update_stock_price).rowcount
+
+            # Commit the transaction
+            with run_log.span('commit'):
                 transaction.commit()
 
+    # Ingested change files leave the drop directory only once they are committed
+    change_ingestion.archive_files(pending.files, BASE_DIRECTORY + 'processed_portfolio_changes')
+    return True
 
-                # Important notification triggers:
-                trigger_messages = f.important_triggers(engine)
 
+def send_updates(engine, run_log, report_cache=None):
+    import functions as f
+    import asyncio
 
-                # Plot portfolio reports:
-                visual_reports_dir = BASE_DIRECTORY + 'visual_reports'
-                shutil.rmtree(visual_reports_dir)   # delete outdated graphs
-                os.makedirs(visual_reports_dir)
-                f.plot_total_value(engine, visual_reports_dir)
-                f.plot_combined_profits(engine, visual_reports_dir)
-                f.plot_stock_growth(engine, visual_reports_dir)
+    # Important notification triggers:
+    with run_log.span('triggers') as span:
+        trigger_messages = f.important_triggers(engine)
+        span['rows'] = len(trigger_messages)
 
+    charts = render_charts(engine, run_log, report_cache)
 
+    # Send updates to a telegram chat:
+    with run_log.span('telegram', bytes=sum(len(png) for png in charts.values())) as span:
+        failures = asyncio.run(f.telegram_send_updates(engine, TOKEN, CHAT_ID, charts, trigger_messages, base_url=TELEGRAM_BASE_URL,
+                                                       max_retries=TELEGRAM_MAX_RETRIES, backoff_seconds=TELEGRAM_BACKOFF_SECONDS,
+                                                       analytics_options=ANALYTICS_OPTIONS))
+        span['failures'] = len(failures)
 
-                # Send updates to a telegram chat:
-                asyncio.run(f.telegram_send_updates(engine, TOKEN, CHAT_ID, visual_reports_dir, trigger_messages))
 
-            else:
-                print("Newest available data has been already processed")
+def render_charts(engine, run_log, report_cache=None):
+    import functions as f
+
+    # A warm service reuses the charts of its previous run as long as their data hasn't changed (see service.ReportCache)
+    if report_cache is not None:
+        charts = report_cache.lookup(engine)
+        if charts is not None:
+            run_log.record('charts', 0, rows=len(charts), bytes=sum(len(png) for png in charts.values()), cached=True)
+            return charts
+
+    # Plot portfolio reports (in memory, copies are kept in visual_reports if enabled).
+    # Charts are drawn in worker processes, or in this one when profiling so that the profile covers them
+    visual_reports_dir = BASE_DIRECTORY + 'visual_reports' if SAVE_VISUAL_REPORTS else None
+    with run_log.span('report_data') as span:
+        report_data = f.ReportData.load(engine)
+        span['rows'] = len(report_data.history)
+    with run_log.span('charts') as span:
+        charts, chart_timings = f.render_reports(report_data, max_workers=1 if run_log.profile_dir else None, window=REPORT_WINDOW,
+                                                 max_points=REPORT_MAX_POINTS, visual_reports_dir=visual_reports_dir,
+                                                 pool=report_cache.pool if report_cache is not None else None)
+        span.update(rows=len(charts), bytes=sum(len(png) for png in charts.values()))
+        for chart, seconds in chart_timings.items():
+            run_log.record(f'chart:{chart}', seconds, bytes=len(charts[chart + '.png']))
+    print('Charts rendered: ' + ', '.join(f'{chart} {seconds:.2f}s' for chart, seconds in chart_timings.items()))
+
+    if report_cache is not None:
+        report_cache.store(engine, report_data, charts)
+    return charts
+
+
+def run_intraday(engine, price_provider, run_log, interval, once=False):
+    import intraday
+    import asyncio
+
+    # Polls the quotes of the held stocks until stopped (Ctrl+C), alerts are sent as soon as they fire
+    refresh = intraday.IntradayRefresh(engine, price_provider)
+    print(f"Intraday refresh every {interval}s")
+    while True:
+        try:
+            with run_log.span('intraday_poll') as span:
+                quotes, snapshot, messages = refresh.poll()
+                span.update(rows=len(quotes), alerts=len(messages))
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            # a failed poll (network, locked database, ...) is in the run log & retried on the next interval
+            print(f"Intraday poll failed: {type(e).__name__}: {e}")
+            if once:
+                raise
+            quotes, snapshot, messages = [], None, []
+
+        if snapshot is not None and snapshot.portfolio is not None:
+            portfolio = snapshot.portfolio
+            change = f" ({portfolio['ch_1d_ago']:+.1%})" if portfolio['ch_1d_ago'] is not None else ''
+            print(f"{datetime.now():%H:%M:%S} {len(quotes)} new quotes, value {portfolio['total_value']:.2f}{change}, "
+                  f"profit {portfolio['total_profit']:.2f}")
+
+        if messages:
+            from telegram_delivery import TelegramSender
+            sender = TelegramSender(TOKEN, CHAT_ID, base_url=TELEGRAM_BASE_URL, max_retries=TELEGRAM_MAX_RETRIES,
+                                    backoff_seconds=TELEGRAM_BACKOFF_SECONDS)
+            with run_log.span('telegram', rows=len(messages)) as span:
+                span['failures'] = len(asyncio.run(sender.send_update(['\n'.join(messages)], {})))
+
+        if once:
+            return
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            break
+    print("Intraday refresh stopped")
+
+
+def serve(engine, price_provider, host, port):
+    import service
+    from concurrent.futures import ProcessPoolExecutor
+    # loaded once, not on every run:
+    import functions
+    import change_ingestion
+    import intraday
+    import analytics
+    import telegram_delivery
+    import asyncio
+
+    def pipeline(run_log, report_cache, force):
+        # New day -> the whole daily update. Without one nothing runs, unless the reports are requested again (force)
+        if not newest_data_processed(engine) and run_daily_update(engine, price_provider, run_log, report_cache):
+            return True
+        if force:
+            send_updates(engine, run_log, report_cache)
+        else:
+            print("Newest available data has been already processed")
+        return False
+
+    with ProcessPoolExecutor(max_workers=min(len(functions.REPORT_CHARTS), os.cpu_count() or 1)) as chart_pool:
+        portfolio_service = service.PortfolioService(engine, pipeline, SERVICE_EXCHANGES, SERVICE_RUN_DELAY_MINUTES, host, port,
+                                                     BASE_DIRECTORY + RUN_LOG_FILE if RUN_LOG_FILE else None,
+                                                     service.ReportCache(chart_pool))
+        try:
+            asyncio.run(portfolio_service.serve())
+        except KeyboardInterrupt:
+            print("Service stopped")
+
+
+def backfill_history(engine, price_provider, from_dt, to_dt, chunk_days):
+    import backfill
+    summary = backfill.backfill(engine, price_provider, from_dt, to_dt, chunk_days=chunk_days, max_workers=BACKFILL_MAX_WORKERS)
+    if not summary.empty:
+        print(summary.to_string(index=False))
+        update_analytics(engine, price_provider)
+
+
+def replay_changes(engine, price_provider, to_dt, diff_only):
+    import replay
+    replay.run_replay(engine, price_provider, to_dt, diff_only=diff_only)
+    if not diff_only:
+        update_analytics(engine, price_provider)
+
+
+def update_analytics(engine, price_provider, rebuild=False):
+    # Computes the portfolio_analytics rows missing after the last stored one (all of them with rebuild)
+    import analytics
+    with engine.begin() as connection:
+        if rebuild:
+            analytics.invalidate_analytics(connection)
+        rows = analytics.update_analytics(connection, price_provider, **ANALYTICS_OPTIONS)
+    print(f"portfolio_analytics: {rows} days computed")
+
+
+def init_db(engine):
+    # Creates the missing tables, indexes & views (e.g. a new SQLite file) and fills the colors table
+    import functions as f
+    if storage.bootstrap_schema(engine):
+        f.generate_and_store_colors(engine)
+    print(f"Database schema is ready ({engine.dialect.name})")
+
+
+def rebuild_portfolio_daily(engine):
+    import functions as f
+    with engine.begin() as connection:
+        f.rebuild_portfolio_daily(connection)
+    print("portfolio_daily has been rebuilt from portfolio_history")
+
+
+
+
+def date_argument(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Portfolio tracking')
+    parser.add_argument('--profile', action='store_true', help='dump cProfile & tracemalloc output of every stage to BASE_DIRECTORY/profiles')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='process new data & send the reports (default)')
+    subparsers.add_parser('init-db', help='create the missing tables, indexes & views')
+    serve_parser = subparsers.add_parser('serve', help='long-running service: scheduled runs per exchange close & status endpoint')
+    serve_parser.add_argument('--host', default=SERVICE_HOST)
+    serve_parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    intraday_parser = subparsers.add_parser('intraday', help='poll the latest quotes & fire alerts until stopped')
+    intraday_parser.add_argument('--interval', type=int, default=INTRADAY_INTERVAL_SECONDS, help='seconds between two polls')
+    intraday_parser.add_argument('--once', action='store_true', help='poll once & exit')
+    subparsers.add_parser('rebuild-portfolio-daily', help='recompute the portfolio_daily table from portfolio_history')
+    subparsers.add_parser('rebuild-analytics', help='recompute the portfolio_analytics table from portfolio_history (e.g. after changing the benchmark)')
+    backfill_parser = subparsers.add_parser('backfill', help='fill the days missing from portfolio_history')
+    backfill_parser.add_argument('--from', dest='from_dt', type=date_argument, help='first day to check (YYYY-MM-DD), default: first position')
+    backfill_parser.add_argument('--to', dest='to_dt', type=date_argument, help='last day to check (YYYY-MM-DD), default: yesterday')
+    backfill_parser.add_argument('--chunk-days', type=int, default=BACKFILL_CHUNK_DAYS, help='days per price request & insert')
+    replay_parser = subparsers.add_parser('replay', help='rebuild stocks, lots, positions, realized gains & history from the changes table')
+    replay_parser.add_argument('--to', dest='to_dt', type=date_argument, help='last history day (YYYY-MM-DD), default: current last day')
+    replay_parser.add_argument('--diff', action='store_true', help='only report the differences against the current tables')
+    args = parser.parse_args()
+
+    # Create the engine to connect to the database (PostgreSQL or an embedded SQLite file)
+    engine = storage.make_engine(DATABASE_URI)
 
+    # Stage timings go to the JSON-lines run log, --profile adds cProfile & tracemalloc dumps per stage
+    command = args.command or 'run'
+    run_log = RunLog(BASE_DIRECTORY + RUN_LOG_FILE if RUN_LOG_FILE else None,
+                     BASE_DIRECTORY + 'profiles' if args.profile else None, command)
 
-        except:
-            transaction.rollback()
-            raise Exception()
-        
+    with run_log.span(command, profile=command not in ('run', 'intraday', 'serve')):
+        if command == 'init-db':
+            init_db(engine)
+        elif command == 'rebuild-portfolio-daily':
+            rebuild_portfolio_daily(engine)
+        elif command == 'rebuild-analytics':
+            update_analytics(engine, make_configured_price_provider(), rebuild=True)
+        elif command == 'replay':
+            replay_changes(engine, make_configured_price_provider(), args.to_dt, args.diff)
+        elif command == 'serve':
+            serve(engine, make_configured_price_provider(), args.host, args.port)
+        elif command == 'intraday':
+            run_intraday(engine, make_configured_price_provider(), run_log, args.interval, args.once)
+        elif command == 'backfill':
+            backfill_history(engine, make_configured_price_provider(), args.from_dt, args.to_dt, args.chunk_days)
+        elif newest_data_processed(engine):
+            print("Newest available data has been already processed")
+        else:
+            run_daily_update(engine, make_configured_price_provider(), run_log)
 
+    if len(run_log.spans) > 1:
+        print(run_log.summary())
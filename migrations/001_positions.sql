@@ -0,0 +1,36 @@
+-- Daily positions per stock id: shares & invested amount held from 'dt' on, written whenever changes are applied.
+-- portfolio_history is filled from the latest position on or before each day instead of re-aggregating active_stocks_info.
+--
+-- Only the currently active stocks are seeded below. Stocks already sold have no purchase records left, so their
+-- positions (FIFO invested amounts) can only be rebuilt from the changes table: run 'python main.py replay' once after
+-- this migration, otherwise backfill can't find the missing history days of those stocks.
+
+CREATE TABLE IF NOT EXISTS positions
+(
+    id INTEGER,
+    ticker VARCHAR(200),
+    shares REAL,
+    invested REAL,
+    dt DATE
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS positions_id_dt ON positions (id, dt);
+CREATE INDEX IF NOT EXISTS portfolio_history_dt ON portfolio_history (dt);
+CREATE INDEX IF NOT EXISTS portfolio_history_id_dt ON portfolio_history (id, dt);
+CREATE INDEX IF NOT EXISTS active_stocks_info_ticker_dt ON active_stocks_info (ticker, dt);
+
+
+-- Seed positions of the currently active stocks from their purchase records (the same sums the old range join produced)
+INSERT INTO positions (id, ticker, shares, invested, dt)
+SELECT
+    asi.id,
+    asi.ticker,
+    SUM(SUM(asi.share)) OVER (PARTITION BY asi.id ORDER BY asi.dt),
+    SUM(SUM(asi.share*asi.price)) OVER (PARTITION BY asi.id ORDER BY asi.dt),
+    asi.dt
+FROM active_stocks_info asi
+JOIN stocks s
+    ON s.id = asi.id
+    AND s.st = 'Active'
+GROUP BY asi.id, asi.ticker, asi.dt
+ON CONFLICT (id, dt) DO NOTHING;
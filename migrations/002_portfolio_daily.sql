@@ -0,0 +1,22 @@
+-- Daily portfolio totals with 1D/7D/1M/6M/1Y changes, the stored counterpart of the 'portfolio' view.
+-- main.py appends/updates it for the newly processed days, 'python main.py rebuild-portfolio-daily' recomputes it from scratch.
+
+CREATE TABLE IF NOT EXISTS portfolio_daily
+(
+    dt DATE PRIMARY KEY,
+    total_profit REAL,
+    total_value REAL,
+    change INTEGER,
+    ch_1D_ago NUMERIC,
+    ch_7D_ago NUMERIC,
+    ch_1M_ago NUMERIC,
+    ch_6M_ago NUMERIC,
+    ch_1Y_ago NUMERIC
+);
+
+
+-- Initial fill from the existing view
+INSERT INTO portfolio_daily (dt, total_profit, total_value, change, ch_1D_ago, ch_7D_ago, ch_1M_ago, ch_6M_ago, ch_1Y_ago)
+SELECT dt, total_profit, total_value, change, ch_1D_ago, ch_7D_ago, ch_1M_ago, ch_6M_ago, ch_1Y_ago
+FROM portfolio
+ON CONFLICT (dt) DO NOTHING;
@@ -0,0 +1,11 @@
+-- Last known state of every alert rule & subject ('portfolio' or a ticker), see alert_rules.py.
+-- An alert is sent when its condition turns true and re-armed once it turns false again.
+
+CREATE TABLE IF NOT EXISTS alert_state
+(
+    rule VARCHAR(200),
+    subject VARCHAR(200),
+    active BOOLEAN,
+    changed_dt DATE,
+    PRIMARY KEY (rule, subject)
+);
@@ -0,0 +1,12 @@
+-- Persistent staging table of the fetched end prices, truncated & loaded with COPY FROM STDIN on every run (functions.load_staging).
+-- UNLOGGED: no write-ahead log for rows that are reloaded anyway. Replaces the table pandas used to drop & recreate on every run.
+
+DROP TABLE IF EXISTS new_data_stg;
+
+CREATE UNLOGGED TABLE new_data_stg
+(
+    dt DATE,
+    end_price REAL,
+    name VARCHAR(200),
+    ticker VARCHAR(200)
+);
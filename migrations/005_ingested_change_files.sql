@@ -0,0 +1,10 @@
+-- Change files ingested from the drop directory (see change_ingestion.py), keyed by the SHA-256 of their content.
+-- A file whose content is already here is skipped, so dropping the same file twice doesn't apply its changes twice.
+
+CREATE TABLE IF NOT EXISTS ingested_change_files
+(
+    sha256 VARCHAR(64) PRIMARY KEY,
+    file_name VARCHAR(200),
+    row_count INTEGER,
+    ingested_at TIMESTAMP
+);
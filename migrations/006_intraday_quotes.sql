@@ -0,0 +1,11 @@
+-- Latest quotes of the held stocks polled by 'python main.py intraday' (see intraday.py), timestamps in UTC.
+-- Finished days are compacted to their last quote & dropped once portfolio_history holds the day's close,
+-- so the table only ever holds a few days of quotes. The primary key serves the per-ticker latest quote lookups.
+
+CREATE TABLE IF NOT EXISTS intraday_quotes
+(
+    ticker VARCHAR(200),
+    ts TIMESTAMP,
+    price REAL,
+    PRIMARY KEY (ticker, ts)
+);
@@ -0,0 +1,19 @@
+-- Risk & performance figures per trading day (see analytics.py): cash flow adjusted daily return, time-weighted return index,
+-- drawdowns & the rolling volatility, Sharpe, Sortino & beta. Appended by every daily run, starting from the last stored rows.
+-- Left empty here: the next run (or 'python main.py rebuild-analytics') computes the whole history.
+
+CREATE TABLE IF NOT EXISTS portfolio_analytics
+(
+    dt DATE PRIMARY KEY,
+    net_flow REAL,
+    daily_return REAL,
+    benchmark_return REAL,
+    twr DOUBLE PRECISION,
+    twr_peak DOUBLE PRECISION,
+    drawdown REAL,
+    max_drawdown REAL,
+    volatility REAL,
+    sharpe REAL,
+    sortino REAL,
+    beta REAL
+);
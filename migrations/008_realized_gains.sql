@@ -0,0 +1,13 @@
+-- One record per sale written by the FIFO lot ledger (see lot_ledger.py): shares sold, sale price, cost basis & realized gain.
+-- Sales processed before this table existed have no records, 'python main.py replay' rebuilds them from the changes table.
+
+CREATE TABLE IF NOT EXISTS realized_gains
+(
+    dt DATE,
+    stock_id INTEGER,
+    ticker VARCHAR(200),
+    shares_sold REAL,
+    sale_price REAL,
+    cost_basis REAL,
+    realized_gain REAL
+);
@@ -0,0 +1,504 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import sqlite3
+import time
+import os
+from datetime import datetime, timedelta, timezone
+
+
+
+
+#######################################################################################
+############################### PRICE PROVIDER INTERFACE: #############################
+#######################################################################################
+
+# Every provider returns closing prices in a long format with columns ['dt', 'end_price', 'ticker'],
+# covering the interval [start; end) - the same interval yfinance uses for history().
+# Providers that support intraday mode (see intraday.py) also return the latest quotes with columns ['ts', 'price', 'ticker']
+# (ts = naive UTC timestamp), only those newer than each ticker's 'since' timestamp.
+# currencies(tickers) tells the currency each ticker is quoted in: {ticker: 'USD', ...}, None if the source has no currency
+# information (taken as the base currency), tickers whose lookup failed are left out.
+
+PRICE_COLUMNS = ['dt', 'end_price', 'ticker']
+QUOTE_COLUMNS = ['ts', 'price', 'ticker']
+
+
+class PriceProvider:
+
+    def fetch(self, tickers, start, end):
+        raise NotImplementedError
+
+    def fetch_quotes(self, since):
+        # since: {ticker: last stored quote timestamp}
+        raise NotImplementedError(f"{type(self).__name__} doesn't provide intraday quotes")
+
+    def currencies(self, tickers):
+        return dict.fromkeys(tickers)
+
+
+def empty_prices():
+    return pd.DataFrame(columns=PRICE_COLUMNS)
+
+
+def empty_quotes():
+    return pd.DataFrame(columns=QUOTE_COLUMNS)
+
+
+def newer_quotes(quotes, since):
+    # Delta of 'quotes': only the ones after each ticker's 'since' timestamp (tickers not in 'since' are dropped)
+    last_ts = quotes['ticker'].map(since)
+    return quotes[last_ts.notna().to_numpy() & (quotes['ts'] > last_ts).to_numpy()].reset_index(drop=True)
+
+
+
+#######################################################################################
+############################### YAHOO (DEFAULT) PROVIDER: #############################
+#######################################################################################
+
+
+class RateLimiter:
+
+    # Spaces out calls so that no more than 'calls_per_second' requests are started, shared between threads
+    def __init__(self, calls_per_second):
+        self.interval = 1.0 / calls_per_second if calls_per_second else 0
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class YahooPriceProvider(PriceProvider):
+
+    def __init__(self, batch_size=50, max_workers=4, calls_per_second=2, max_retries=3, backoff_seconds=1.0, quote_interval='1m'):
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.quote_interval = quote_interval
+        self.rate_limiter = RateLimiter(calls_per_second)
+
+
+    def fetch(self, tickers, start, end):
+        tickers = list(dict.fromkeys(tickers))          # drop duplicates, keep order
+        if not tickers:
+            return empty_prices()
+
+        # Split tickers into multi-symbol requests and run them on a bounded pool
+        batches = [tickers[i:i + self.batch_size] for i in range(0, len(tickers), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+            results = list(pool.map(lambda batch: self.fetch_batch(batch, start, end), batches))
+
+        return pd.concat(results, ignore_index=True)
+
+
+    def fetch_batch(self, batch, start, end):
+        return self.download(batch, self.to_long_format, start=start, end=end, interval='1d')
+
+
+    def fetch_quotes(self, since):
+        # Intraday bars of today's session (quote_interval), one request per batch from the oldest 'since' of the batch on.
+        # Outside trading hours nothing new comes back, so empty answers are not retried
+        tickers = list(since)
+        if not tickers:
+            return empty_quotes()
+
+        batches = [tickers[i:i + self.batch_size] for i in range(0, len(tickers), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+            results = list(pool.map(lambda batch: self.fetch_quote_batch(batch, min(since[ticker] for ticker in batch)), batches))
+
+        return newer_quotes(pd.concat(results, ignore_index=True), since)
+
+
+    def fetch_quote_batch(self, batch, since):
+        return self.download(batch, self.to_quotes, retry_empty=False, start=since.date(), interval=self.quote_interval, prepost=False)
+
+
+    def currencies(self, tickers):
+        # One quote lookup per ticker, done once per ticker (CachedPriceProvider keeps the answers)
+        import yfinance as yf
+        def lookup(ticker):
+            self.rate_limiter.wait()
+            try:
+                return ticker, yf.Ticker(ticker).fast_info['currency']
+            except Exception as e:
+                print(f"Currency lookup for {ticker} failed ({e})")
+                return ticker, False
+
+        tickers = list(dict.fromkeys(tickers))
+        if not tickers:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(tickers))) as pool:
+            return {ticker: currency for ticker, currency in pool.map(lookup, tickers) if currency is not False}
+
+
+    def download(self, batch, convert, retry_empty=True, **options):
+        # yf.download logs failed symbols instead of raising, so an empty batch is retried as well
+        import yfinance as yf
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            try:
+                data = yf.download(batch, auto_adjust=True, progress=False, threads=False, **options)
+                prices = convert(data, batch)
+                if not prices.empty or not retry_empty or attempt == self.max_retries:
+                    return prices
+                reason = 'no data returned'
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                reason = e
+
+            wait_time = self.backoff_seconds * 2 ** attempt
+            print(f"Price request for {batch[0]}..{batch[-1]} failed ({reason}), retrying in {wait_time}s")
+            time.sleep(wait_time)
+
+
+    @staticmethod
+    def to_long_format(data, batch):
+        if data is None or data.empty:
+            return empty_prices()
+
+        # Columns are (field, ticker) for multi-symbol requests, plain fields for single symbol ones on older yfinance
+        closes = data['Close']
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(name=batch[0])
+
+        closes = closes.rename_axis(index='dt', columns='ticker').stack().rename('end_price').reset_index()
+        closes['dt'] = pd.to_datetime(closes['dt']).dt.date
+
+        return closes.dropna(subset=['end_price'])[PRICE_COLUMNS]
+
+
+    @staticmethod
+    def to_quotes(data, batch):
+        if data is None or data.empty:
+            return empty_quotes()
+
+        closes = data['Close']
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(name=batch[0])
+
+        quotes = closes.rename_axis(index='ts', columns='ticker').stack().rename('price').reset_index()
+        ts = pd.to_datetime(quotes['ts'])
+        quotes['ts'] = ts.dt.tz_convert('UTC').dt.tz_localize(None) if ts.dt.tz is not None else ts
+
+        return quotes.dropna(subset=['price'])[QUOTE_COLUMNS]
+
+
+
+#######################################################################################
+############################### OFFLINE FIXTURE PROVIDER: #############################
+#######################################################################################
+
+
+class FixturePriceProvider(PriceProvider):
+
+    # Serves prices from a CSV or Parquet file with columns 'dt', 'ticker', 'end_price' & optionally 'currency' (no network needed),
+    # FX rates as tickers like 'USDEUR=X'. Intraday quotes come from an optional second file with columns 'ts', 'ticker', 'price' (UTC),
+    # each quote once its time has come
+    def __init__(self, path, quotes_path=None):
+        prices = self.read(path, PRICE_COLUMNS + ['currency'])
+        prices['dt'] = pd.to_datetime(prices['dt']).dt.date
+        self.prices = prices.sort_values(['ticker', 'dt']).reset_index(drop=True)
+        self.ticker_currencies = {}
+        if 'currency' in prices:
+            self.ticker_currencies = prices.dropna(subset=['currency']).drop_duplicates(subset='ticker').set_index('ticker')['currency'].to_dict()
+
+        self.quotes = None
+        if quotes_path:
+            quotes = self.read(quotes_path, QUOTE_COLUMNS)
+            quotes['ts'] = pd.to_datetime(quotes['ts'])
+            self.quotes = quotes.sort_values(['ticker', 'ts']).reset_index(drop=True)
+
+
+    @staticmethod
+    def read(path, columns):
+        # the listed columns that exist in the file
+        if os.path.splitext(path)[1].lower() == '.parquet':
+            frame = pd.read_parquet(path)
+            return frame[[column for column in columns if column in frame]]
+        return pd.read_csv(path, usecols=lambda column: column in columns)
+
+
+    def fetch(self, tickers, start, end):
+        mask = self.prices['ticker'].isin(tickers) & (self.prices['dt'] >= start) & (self.prices['dt'] < end)
+        return self.prices.loc[mask, PRICE_COLUMNS].reset_index(drop=True)
+
+
+    def fetch_quotes(self, since):
+        if self.quotes is None:
+            return super().fetch_quotes(since)
+        quotes = self.quotes[self.quotes['ts'] <= datetime.now(timezone.utc).replace(tzinfo=None)]
+        return newer_quotes(quotes[QUOTE_COLUMNS], since)
+
+
+    def currencies(self, tickers):
+        return {ticker: self.ticker_currencies.get(ticker) for ticker in tickers}
+
+
+
+#######################################################################################
+############################### LOCAL PRICE CACHE: ####################################
+#######################################################################################
+
+
+class CachedPriceProvider(PriceProvider):
+
+    # SQLite cache in front of another provider, keyed by (ticker, dt). Requested calendar days up to a ticker's latest
+    # returned close are stored, the ones without a close (weekends, holidays) with end_price = NULL, so they are not
+    # requested again. Empty responses are never stored.
+    # The close of day 'dt' counts as final only if it was fetched at least 'freshness_hours' after that day ended,
+    # otherwise (e.g. the latest close fetched before markets settled) it is requested again.
+    def __init__(self, provider, path, freshness_hours=6, max_age_days=730, max_rows=2000000):
+        self.provider = provider
+        self.path = path
+        self.freshness = timedelta(hours=freshness_hours)
+        self.max_age = timedelta(days=max_age_days)
+        self.max_rows = max_rows
+
+        with self.connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS prices
+                            (
+                                ticker TEXT,
+                                dt TEXT,
+                                end_price REAL,
+                                fetched_at TEXT,
+                                PRIMARY KEY (ticker, dt)
+                            )''')
+            conn.execute('''CREATE INDEX IF NOT EXISTS prices_fetched_at ON prices (fetched_at)''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS currencies
+                            (
+                                ticker TEXT PRIMARY KEY,
+                                currency TEXT,
+                                fetched_at TEXT
+                            )''')
+
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+
+    def fetch(self, tickers, start, end):
+        tickers = list(dict.fromkeys(tickers))
+        if not tickers or start >= end:
+            return empty_prices()
+
+        cached = self.read(tickers, start, end)
+
+        # Find each ticker's missing/stale days & request the envelope of them, grouping tickers with equal envelopes
+        all_days = pd.DataFrame(list(pd.MultiIndex.from_product(
+            [tickers, pd.date_range(start, end - timedelta(days=1)).date], names=['ticker', 'dt'])), columns=['ticker', 'dt'])
+        known = all_days.merge(cached, on=['ticker', 'dt'], how='left')
+        day_end = pd.to_datetime(known['dt']) + timedelta(days=1)
+        missing = known[~(pd.to_datetime(known['fetched_at']) >= day_end + self.freshness)]
+
+        if not missing.empty:
+            envelopes = missing.groupby('ticker')['dt'].agg(['min', 'max']).reset_index()
+            for (first_day, last_day), group in envelopes.groupby(['min', 'max']):
+                self.refresh(group['ticker'].tolist(), first_day, last_day + timedelta(days=1))
+
+            cached = self.read(tickers, start, end)
+
+        self.evict()
+
+        prices = cached.dropna(subset=['end_price'])
+        return prices[PRICE_COLUMNS].sort_values(['ticker', 'dt']).reset_index(drop=True)
+
+
+    def fetch_quotes(self, since):
+        # Intraday quotes change all the time, they always come from the source
+        return self.provider.fetch_quotes(since)
+
+
+    def currencies(self, tickers):
+        # A ticker's currency doesn't change, it is looked up once & kept (not evicted)
+        tickers = list(dict.fromkeys(tickers))
+        placeholders = ','.join('?' * len(tickers))
+        with self.connect() as conn:
+            known = dict(conn.execute(f'SELECT ticker, currency FROM currencies WHERE ticker IN ({placeholders})', tickers).fetchall())
+
+        missing = [ticker for ticker in tickers if ticker not in known]
+        if missing:
+            found = self.provider.currencies(missing)
+            fetched_at = datetime.now().isoformat(timespec='seconds')
+            with self.connect() as conn:
+                conn.executemany('''INSERT OR REPLACE INTO currencies (ticker, currency, fetched_at) VALUES (?, ?, ?)''',
+                                 [(ticker, currency, fetched_at) for ticker, currency in found.items()])
+            known.update(found)
+        return known
+
+
+    def read(self, tickers, start, end):
+        placeholders = ','.join('?' * len(tickers))
+        with self.connect() as conn:
+            cached = pd.read_sql_query(f'''SELECT ticker, dt, end_price, fetched_at FROM prices
+                                          WHERE ticker IN ({placeholders}) AND dt >= ? AND dt < ?''',
+                                       conn, params=tickers + [start.isoformat(), end.isoformat()])
+        cached['dt'] = pd.to_datetime(cached['dt']).dt.date
+        return cached
+
+
+    def refresh(self, tickers, start, end):
+        print(f"Price cache: requesting {len(tickers)} tickers for [{start};{end})")
+        fetched = self.provider.fetch(tickers, start, end)
+        fetched = fetched.dropna(subset=['end_price'])
+        if fetched.empty:
+            # an outage looks the same as a range without closes: nothing is stored, the days are requested again
+            print(f"Price cache: no prices returned for [{start};{end}), nothing stored")
+            return
+
+        # Store the requested days up to each ticker's latest returned close, the ones without a close (weekends, holidays)
+        # as NULL. Days after it & tickers that returned nothing may still get closes, they are requested again
+        requested = pd.DataFrame(list(pd.MultiIndex.from_product(
+            [tickers, pd.date_range(start, end - timedelta(days=1)).date], names=['ticker', 'dt'])), columns=['ticker', 'dt'])
+        requested = requested.merge(fetched, on=['ticker', 'dt'], how='left')
+        last_close = pd.to_datetime(requested['ticker'].map(fetched.groupby('ticker')['dt'].max()))
+        requested = requested[(pd.to_datetime(requested['dt']) <= last_close).to_numpy()]
+        requested['end_price'] = requested['end_price'].astype(float)
+        fetched_at = datetime.now().isoformat(timespec='seconds')
+
+        rows = [(ticker, dt.isoformat(), None if pd.isna(price) else price, fetched_at)
+                for ticker, dt, price in requested[['ticker', 'dt', 'end_price']].itertuples(index=False)]
+        with self.connect() as conn:
+            conn.executemany('''INSERT OR REPLACE INTO prices (ticker, dt, end_price, fetched_at) VALUES (?, ?, ?, ?)''', rows)
+
+
+    def evict(self):
+        # Drop entries older than max_age, then the oldest entries above max_rows
+        oldest_allowed = (datetime.now() - self.max_age).isoformat(timespec='seconds')
+        with self.connect() as conn:
+            conn.execute('''DELETE FROM prices WHERE fetched_at < ?''', (oldest_allowed,))
+            conn.execute('''DELETE FROM prices WHERE rowid IN
+                            (
+                                SELECT rowid FROM prices
+                                ORDER BY fetched_at DESC
+                                LIMIT -1 OFFSET ?
+                            )''', (self.max_rows,))
+
+
+#######################################################################################
+############################### CURRENCY CONVERSION: ##################################
+#######################################################################################
+
+# Prices are converted into the base currency (config.BASE_CURRENCY) before they reach the database, so end_price and the
+# value & profit computed from it are all in one currency. Per provider fetch:
+#   1) each ticker's currency - looked up once (kept in memory & by CachedPriceProvider)
+#   2) the FX closes of all needed pairs ('USDEUR=X', ...) in one batched request through the wrapped provider
+#      (cached & served offline like any other ticker), carried forward over days without a rate
+#   3) one vectorized multiplication by the (currency, date) rate of every row
+# Purchase prices of the change files are expected in the base currency. Stored history stays in the currency it was
+# fetched in, switching the base currency on for an existing database needs a replay (see readme).
+
+# Yahoo quotes some exchanges in minor units: currency -> (major currency, factor)
+MINOR_CURRENCIES = {'GBp': ('GBP', 0.01), 'GBX': ('GBP', 0.01), 'ZAc': ('ZAR', 0.01), 'ILA': ('ILS', 0.01)}
+
+
+class ConvertedPriceProvider(PriceProvider):
+
+    def __init__(self, provider, base_currency, rate_lookback_days=10):
+        self.provider = provider
+        self.base_currency = base_currency
+        self.rate_lookback = timedelta(days=rate_lookback_days)      # for rates at the start of a range that falls on a weekend/holiday
+        self.known_currencies = {}
+        self.lock = threading.Lock()
+
+
+    def fetch(self, tickers, start, end):
+        prices = self.provider.fetch(tickers, start, end)
+        return self.convert(prices, 'end_price', prices['dt'], start, end)
+
+
+    def fetch_quotes(self, since):
+        quotes = self.provider.fetch_quotes(since)
+        if quotes.empty:
+            return quotes
+        dates = quotes['ts'].dt.date
+        return self.convert(quotes, 'price', dates, min(dates), max(dates) + timedelta(days=1))
+
+
+    def currencies(self, tickers):
+        # {ticker: currency}, unknown ones as the base currency
+        with self.lock:
+            missing = [ticker for ticker in dict.fromkeys(tickers) if ticker not in self.known_currencies]
+        if missing:
+            found = self.provider.currencies(missing)
+            failed = [ticker for ticker in missing if ticker not in found]
+            if failed:
+                print(f"Currency unknown for {', '.join(failed)} - prices taken as {self.base_currency}")
+            with self.lock:
+                self.known_currencies.update({ticker: currency for ticker, currency in found.items()})
+        with self.lock:
+            return {ticker: self.known_currencies.get(ticker) or self.base_currency for ticker in tickers}
+
+
+    def rates(self, currencies, start, end):
+        # (currency, date) -> units of base currency per unit of 'currency', every calendar day of [start; end)
+        pairs = {f'{currency}{self.base_currency}=X': currency for currency in currencies}
+        fetched = self.provider.fetch(list(pairs), start - self.rate_lookback, end)
+        fetched = fetched.assign(currency=fetched['ticker'].map(pairs)).drop_duplicates(subset=['currency', 'dt'], keep='last')
+
+        grid = pd.MultiIndex.from_product([currencies, pd.date_range(start - self.rate_lookback, end - timedelta(days=1)).date],
+                                          names=['currency', 'dt'])
+        rates = fetched.set_index(['currency', 'dt'])['end_price'].astype(float).reindex(grid)
+        rates = rates.groupby(level='currency', sort=False).ffill()
+
+        missing = [currency for currency in currencies if rates.loc[currency].isna().all()]
+        if missing:
+            print(f"No {self.base_currency} exchange rate for {', '.join(missing)} - their prices are left out")
+        return rates
+
+
+    def convert(self, prices, column, dates, start, end):
+        if prices.empty:
+            return prices
+
+        ticker_currencies = pd.Series(self.currencies(prices['ticker'].unique()))
+        major = ticker_currencies.map(lambda currency: MINOR_CURRENCIES.get(currency, (currency, 1.0))[0])
+        factor = ticker_currencies.map(lambda currency: MINOR_CURRENCIES.get(currency, (currency, 1.0))[1])
+        foreign = sorted(set(major) - {self.base_currency})
+
+        row_currency = prices['ticker'].map(major)
+        row_rate = np.ones(len(prices))
+        if foreign:
+            rates = self.rates(foreign, start, end)
+            foreign_rows = (row_currency != self.base_currency).to_numpy()
+            row_rate[foreign_rows] = rates.reindex(pd.MultiIndex.from_arrays(
+                [row_currency[foreign_rows], np.asarray(dates)[foreign_rows]])).to_numpy()
+
+        prices = prices.assign(**{column: prices[column].astype(float) * row_rate * prices['ticker'].map(factor).to_numpy()})
+        return prices.dropna(subset=[column]).reset_index(drop=True)
+
+
+
+def daily_closes(price_provider, tickers, start, end):
+    # Close of every ticker & calendar day in [start; end], carried forward over days without one (weekends, holidays)
+    # and back to 'start' if a ticker's first close comes later. Series indexed by (ticker, dt), NaN for tickers without any close
+    tickers = list(dict.fromkeys(tickers))
+    prices = price_provider.fetch(tickers, start, end + timedelta(days=1))
+    prices = prices.drop_duplicates(subset=['ticker', 'dt'], keep='last')
+
+    grid = pd.MultiIndex.from_product([tickers, pd.date_range(start, end).date], names=['ticker', 'dt'])
+    end_prices = prices.set_index(['ticker', 'dt'])['end_price'].astype(float).reindex(grid)
+    end_prices = end_prices.groupby(level='ticker', sort=False).ffill().groupby(level='ticker', sort=False).bfill()
+    return end_prices.rename('end_price')
+
+
+def make_price_provider(fixture_path=None, cache_path=None, cache_options=None, quotes_fixture_path=None, base_currency=None, **yahoo_options):
+    if fixture_path:
+        provider = FixturePriceProvider(fixture_path, quotes_fixture_path)
+    else:
+        provider = YahooPriceProvider(**yahoo_options)
+
+    if cache_path:
+        provider = CachedPriceProvider(provider, cache_path, **(cache_options or {}))
+    # Conversion on top of the cache: quoted prices are cached, the base currency can change without refetching them
+    if base_currency:
+        provider = ConvertedPriceProvider(provider, base_currency)
+    return provider
@@ -0,0 +1,243 @@
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+from sqlalchemy import text, bindparam
+import time
+import functions as f
+import analytics
+from lot_ledger import LotLedger
+from price_providers import daily_closes
+
+
+
+
+#######################################################################################
+############################### REPLAY ENGINE: ########################################
+#######################################################################################
+
+# Rebuilds the tables derived from the change log, for every stock that appears in 'changes':
+#   stocks (share, st, price), active_stocks_info (lots still held), positions, realized_gains & portfolio_history,
+#   followed by portfolio_daily. portfolio_analytics is emptied, the next analytics update recomputes it.
+#
+# Changes are replayed per stock id in date order (within a day buys before sells), lots are resolved with the FIFO
+# LotLedger and every held day gets a history record with the ticker's close (carried over days without one).
+# The result is computed in memory and written in a single transaction, so readers see either the old or the new tables.
+# Stocks without any change are left untouched.
+#
+# Correcting a bad trade entry: fix the row in 'changes', then 'python main.py replay --diff' to review & 'python main.py replay'.
+
+
+sql_replay_changes = text('''
+                SELECT
+                    c.dt,
+                    c.stock_id AS id,
+                    s.name,
+                    s.ticker,
+                    c.shares_bought_sold AS share,
+                    c.purchase_price AS price
+                FROM changes c
+                JOIN stocks s
+                    ON s.id = c.stock_id
+                ORDER BY c.dt, c.stock_id, c.shares_bought_sold <= 0''')
+
+sql_replay_end_dt = text('''
+                SELECT MAX(dt) FROM portfolio_history''')
+
+
+class ReplayResult:
+
+    # New contents of the derived tables for the replayed stock ids (column names as in the tables):
+    #   stocks       - id, share, st, price
+    #   lots         - active_stocks_info rows
+    #   positions    - id, ticker, shares, invested, dt
+    #   realized     - realized_gains rows
+    #   history      - portfolio_history rows
+    def __init__(self, stocks, lots, positions, realized, history):
+        self.stocks = stocks
+        self.lots = lots
+        self.positions = positions
+        self.realized = realized
+        self.history = history
+
+
+def replay(changes, price_provider, end_dt):
+    # changes: rows of sql_replay_changes, history is built up to & including 'end_dt'
+    changes = changes.astype({'id': int, 'share': float, 'price': float}).reset_index(drop=True)
+    changes['dt'] = pd.to_datetime(changes['dt']).dt.date
+    stock_info = changes.drop_duplicates(subset='id').set_index('id')[['name', 'ticker']]
+
+    # Lots, FIFO sales & holdings after every change, keyed by stock id
+    ledger = LotLedger()
+    ledger_result = ledger.apply(changes.assign(ticker=changes['id'])[['ticker', 'price', 'share', 'dt']])
+
+    # Positions: last change of the day wins
+    positions = changes[['id', 'ticker', 'dt']].assign(shares=ledger_result.holdings, invested=ledger_result.invested)
+    positions = positions.drop_duplicates(subset=['id', 'dt'], keep='last').sort_values(['id', 'dt']).reset_index(drop=True)
+
+    lots = ledger.lots().rename(columns={'ticker': 'id'})
+    lots = lots[lots['share'] > 0].join(stock_info, on='id')[['id', 'name', 'ticker', 'price', 'share', 'dt']]
+
+    realized = ledger_result.realized.rename(columns={'ticker': 'stock_id'})
+    realized = realized.assign(ticker=realized['stock_id'].map(stock_info['ticker']))[
+        ['dt', 'stock_id', 'ticker', 'shares_sold', 'sale_price', 'cost_basis', 'realized_gain']]
+
+    history = replay_history(positions, stock_info, price_provider, end_dt)
+
+    # Stocks: final holdings, disabled once nothing is left, price of active stocks = latest close in the history
+    # (price NaN = keep the current one)
+    final = positions.groupby('id').last()
+    stocks = pd.DataFrame({'id': final.index, 'share': final['shares'].to_numpy(),
+                           'st': np.where(final['shares'].to_numpy() > 0, 'Active', 'Disabled')})
+    latest_prices = history.sort_values('dt').groupby('id')['end_price'].last()
+    stocks['price'] = stocks['id'].map(latest_prices).where(stocks['st'] == 'Active')
+
+    return ReplayResult(stocks, lots.reset_index(drop=True), positions, realized.reset_index(drop=True), history)
+
+
+def replay_history(positions, stock_info, price_provider, end_dt):
+    # One record per stock & day held (shares > 0), from each position until the next one (or end_dt)
+    start = pd.to_datetime(positions['dt'])
+    next_start = start.groupby(positions['id']).shift(-1).fillna(pd.Timestamp(end_dt) + pd.Timedelta(days=1))
+    days = (next_start.clip(upper=pd.Timestamp(end_dt) + pd.Timedelta(days=1)) - start).dt.days
+    held = (positions['shares'] > 0) & (days > 0)
+
+    history = positions[held].loc[positions.index[held].repeat(days[held].to_numpy())]
+    offsets = history.groupby(level=0).cumcount().to_numpy()
+    history['dt'] = (pd.to_datetime(history['dt']) + pd.to_timedelta(offsets, unit='D')).dt.date
+    history = history.reset_index(drop=True)
+    if history.empty:
+        return pd.DataFrame(columns=['id', 'name', 'ticker', 'end_price', 'shares', 'value', 'invested', 'profit', 'dt'])
+
+    closes = daily_closes(price_provider, history['ticker'].unique(), history['dt'].min(), history['dt'].max())
+    history = history.merge(closes.reset_index(), on=['ticker', 'dt'], how='left')
+    missing = history['end_price'].isna()
+    if missing.any():
+        print(f"Replay: no prices for {history.loc[missing, 'ticker'].nunique()} tickers, {missing.sum()} days skipped")
+        history = history[~missing]
+
+    history['name'] = history['id'].map(stock_info['name'])
+    history['value'] = history['end_price'] * history['shares']
+    history['profit'] = history['value'] - history['invested']
+    return history[['id', 'name', 'ticker', 'end_price', 'shares', 'value', 'invested', 'profit', 'dt']] \
+        .sort_values(['dt', 'id']).reset_index(drop=True)
+
+
+
+#######################################################################################
+############################### ATOMIC SWAP & DIFF: ###################################
+#######################################################################################
+
+
+sql_delete_replayed = {
+    'portfolio_history': text('''DELETE FROM portfolio_history WHERE id IN :ids''').bindparams(bindparam('ids', expanding=True)),
+    'positions': text('''DELETE FROM positions WHERE id IN :ids''').bindparams(bindparam('ids', expanding=True)),
+    'active_stocks_info': text('''DELETE FROM active_stocks_info WHERE id IN :ids''').bindparams(bindparam('ids', expanding=True)),
+    'realized_gains': text('''DELETE FROM realized_gains WHERE stock_id IN :ids''').bindparams(bindparam('ids', expanding=True)),
+}
+
+sql_update_replayed_stock = text('''
+                UPDATE stocks
+                SET
+                    share = :share,
+                    st = :st,
+                    price = COALESCE(:price, price)
+                WHERE id = :id''')
+
+
+def records(frame):
+    return [{key: (None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value)
+             for key, value in row.items()} for row in frame.to_dict('records')]
+
+
+def swap_in(connection, result):
+    # Replace the replayed stocks' rows of every derived table inside the caller's transaction
+    ids = [int(id) for id in result.stocks['id']]
+    for statement in sql_delete_replayed.values():
+        connection.execute(statement, {'ids': ids})
+
+    f.copy_rows(connection, 'portfolio_history', result.history)
+    f.copy_rows(connection, 'positions', result.positions[['id', 'ticker', 'shares', 'invested', 'dt']])
+    if not result.lots.empty:
+        connection.execute(f.sql_insert_active_stocks_info, records(result.lots))
+    if not result.realized.empty:
+        connection.execute(f.sql_insert_realized_gains, records(result.realized))
+    connection.execute(sql_update_replayed_stock, records(result.stocks))
+
+    f.rebuild_portfolio_daily(connection)
+    analytics.invalidate_analytics(connection)
+
+
+# table -> (key columns, compared value columns, query of the current rows)
+DIFF_TABLES = {
+    'stocks': (['id'], ['share', 'st', 'price'], 'SELECT id, share, st, price FROM stocks'),
+    'lots': (['id', 'dt', 'price'], ['share'], 'SELECT id, dt, price, share FROM active_stocks_info'),
+    'positions': (['id', 'dt'], ['shares', 'invested'], 'SELECT id, dt, shares, invested FROM positions'),
+    'realized': (['stock_id', 'dt', 'sale_price'], ['shares_sold', 'cost_basis', 'realized_gain'],
+                 'SELECT stock_id, dt, sale_price, shares_sold, cost_basis, realized_gain FROM realized_gains'),
+    'history': (['id', 'dt'], ['end_price', 'shares', 'invested', 'value', 'profit'],
+                'SELECT id, dt, end_price, shares, invested, value, profit FROM portfolio_history'),
+}
+
+
+def diff(connection, result, tolerance=1e-3):
+    # Rows that only exist in the current tables ('current'), only in the replay ('replay') or differ ('changed'),
+    # limited to the replayed stock ids. Numbers are compared with a relative tolerance (tables store REAL),
+    # replayed NaN values keep the current ones
+    ids = set(result.stocks['id'])
+    differences = {}
+    for table, (keys, columns, query) in DIFF_TABLES.items():
+        current = pd.read_sql_query(text(query), connection)
+        current = current[current[keys[0]].isin(ids)]
+        replayed = getattr(result, table)[keys + columns].copy()
+
+        for frame in (current, replayed):
+            if 'dt' in frame:
+                frame['dt'] = pd.to_datetime(frame['dt']).dt.date
+            for key in keys:
+                if key != 'dt' and key not in ('id', 'stock_id'):
+                    frame[key] = frame[key].astype(float).round(4)
+
+        merged = current.merge(replayed, on=keys, how='outer', suffixes=('_current', '_replay'), indicator=True)
+        is_changed = pd.Series(False, index=merged.index)
+        for column in columns:
+            old, new = merged[column + '_current'], merged[column + '_replay']
+            if pd.api.types.is_numeric_dtype(old) and pd.api.types.is_numeric_dtype(new):
+                old, new = old.astype(float), new.astype(float)
+                is_changed |= ~(np.isclose(old, new, rtol=tolerance, atol=tolerance) | new.isna())
+            else:
+                is_changed |= (old.astype(str) != new.astype(str)) & new.notna()
+
+        merged['diff'] = np.select([merged['_merge'] == 'left_only', merged['_merge'] == 'right_only', is_changed],
+                                   ['current', 'replay', 'changed'], default='')
+        differences[table] = merged[merged['diff'] != ''].drop(columns='_merge').reset_index(drop=True)
+
+    return differences
+
+
+def run_replay(engine, price_provider, end_dt=None, diff_only=False):
+    # Replays the change log up to end_dt (default: the current last history day), then either reports the differences
+    # against the current tables or swaps the result in
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        changes = pd.read_sql_query(sql_replay_changes, connection)
+        end_dt = end_dt or connection.execute(sql_replay_end_dt).scalar() or datetime.now().date() - timedelta(days=1)
+    end_dt = pd.Timestamp(end_dt).date()                  # SQLite returns dates as text
+
+    result = replay(changes, price_provider, end_dt)
+    print(f"Replayed {len(changes)} changes of {len(result.stocks)} stocks up to {end_dt}: "
+          f"{len(result.history)} history records, {len(result.lots)} lots in {time.perf_counter() - start:.2f}s")
+
+    if diff_only:
+        with engine.connect() as connection:
+            differences = diff(connection, result)
+        for table, rows in differences.items():
+            counts = rows['diff'].value_counts().to_dict()
+            print(f"{table}: " + (', '.join(f'{count} {kind}' for kind, count in counts.items()) if counts else 'no differences'))
+            if not rows.empty:
+                print(rows.head(20).to_string(index=False))
+        return differences
+
+    with engine.begin() as connection:
+        swap_in(connection, result)
+    print(f"Derived tables replaced in {time.perf_counter() - start:.2f}s")
+    return result
@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+from datetime import datetime
+import tracemalloc
+import cProfile
+import json
+import time
+import os
+
+
+
+
+#######################################################################################
+############################### RUN LOG & PROFILING: ##################################
+#######################################################################################
+
+# Every stage of a run is wrapped in a span:
+#
+#   with run_log.span('staging') as span:
+#       span['rows'], span['bytes'] = f.load_staging(connection, new_stock_info_df)
+#
+# and written as one JSON line to the run log (config.RUN_LOG_FILE) when it ends:
+#   run_id, command, stage, parent (enclosing span), started_at, seconds, status ('ok'/'error'), error & the fields set on it
+# Stages measured elsewhere (e.g. charts drawn in worker processes) are added with record().
+#
+# With profile_dir set ('python main.py --profile'), every span that isn't inside another profiled span also writes
+#   <profile_dir>/<stage>.prof        - cProfile stats (python -m pstats <file>, snakeviz, ...)
+#   <profile_dir>/<stage>.memory.txt  - allocations of the stage still alive at its end, by line (tracemalloc)
+# and adds the stage's peak traced memory to the span as peak_memory_bytes. Memory is only traced while a profiled span runs,
+# so the output covers that stage alone.
+
+
+class RunLog:
+
+    def __init__(self, path=None, profile_dir=None, command='run'):
+        self.path = path
+        self.command = command
+        self.run_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.profile_dir = os.path.join(profile_dir, self.run_id) if profile_dir else None
+        self.stack = []
+        self.profiling = False
+        self.spans = []
+
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+
+
+    @contextmanager
+    def span(self, stage, profile=True, **fields):
+        record = self.new_record(stage, **fields)
+        profiler = self.start_profile() if profile and self.profile_dir and not self.profiling else None
+        self.stack.append(stage)
+        start = time.perf_counter()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as e:
+            record['status'] = 'error'
+            record['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            self.stack.pop()
+            if profiler:
+                self.stop_profile(stage, profiler, record)
+            self.write(record)
+
+
+    def record(self, stage, seconds, **fields):
+        record = self.new_record(stage, **fields)
+        record.update({'status': 'ok', 'seconds': round(seconds, 4)})
+        self.write(record)
+
+
+    def new_record(self, stage, **fields):
+        return {'run_id': self.run_id, 'command': self.command, 'stage': stage, 'parent': self.stack[-1] if self.stack else None,
+                'started_at': datetime.now().isoformat(timespec='milliseconds'), **fields}
+
+
+    def write(self, record):
+        if record.get('rows') is not None and record['rows'] < 0:           # rowcount not reported by the driver
+            record['rows'] = None
+        self.spans.append(record)
+        if self.path:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(record, default=str) + '\n')
+
+
+    def start_profile(self):
+        # Only one profiler can be active, nested spans are covered by the enclosing one
+        self.profiling = True
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+
+    def stop_profile(self, stage, profiler, record):
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        record['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.profiling = False
+
+        file_name = os.path.join(self.profile_dir, stage.replace(':', '_').replace('/', '_'))
+        profiler.dump_stats(file_name + '.prof')
+        allocations = snapshot.statistics('lineno')
+        with open(file_name + '.memory.txt', 'w') as file:
+            file.write(f"{stage}: peak {record['peak_memory_bytes']} bytes traced, {sum(a.size for a in allocations)} bytes still allocated\n")
+            file.write('\n'.join(str(allocation) for allocation in allocations[:25]) + '\n')
+
+
+    def summary(self):
+        # One line per finished span in the order they ended, e.g. printed at the end of a run
+        lines = []
+        for record in self.spans:
+            details = ', '.join(f'{key}={record[key]}' for key in ('rows', 'bytes', 'status') if record.get(key) not in (None, 'ok'))
+            indent = '  ' if record['parent'] else ''
+            lines.append(f"{indent}{record['stage']:<24} {record['seconds']:>8.3f}s" + (f'  {details}' if details else ''))
+        return '\n'.join(lines)
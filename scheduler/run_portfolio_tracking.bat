@@ -1,34 +1,12 @@
-rem Running PortfolioTracking/Code/main.py
+rem Starting the PortfolioTracking service (PortfolioTracking/Code/main.py serve)
 @echo off
 
 rem Affect only local variables:
 setlocal
 
-rem Path to the file that stores the last run date:
-set LAST_RUN_FILE=BASE_DIRECTORY/scheduler/last_run_date.txt
+rem Start once (e.g. a Task Scheduler 'At log on' trigger): the service stays up, schedules the runs after the exchange
+rem closes (SERVICE_EXCHANGES in config.py) & answers on http://127.0.0.1:8765/status.
+rem A single cold run instead: python BASE_DIRECTORY/main.py
+python BASE_DIRECTORY/main.py serve
 
-rem Get today's date in YYYY-MM-DD format, i.e. Retrieve local DateTime and parse it within a loop then truncate for date:
-for /f "tokens=2 delims==" %%I in ('wmic os get localdatetime /value') do set datetime=%%I
-set TODAY=%datetime:~0,4%-%datetime:~4,2%-%datetime:~6,2%
-
-rem Check if the last run file exists and read the date:
-if exist "%LAST_RUN_FILE%" (
-    set /p LAST_RUN=<"%LAST_RUN_FILE%"
-) else (
-    set LAST_RUN=
-)
-
-rem Check if the script ran today:
-if "%TODAY%"=="%LAST_RUN%" (
-    rem Exit if the script ran today
-    goto end
-)
-
-rem Run portfolio tracking script:
-python BASE_DIRECTORY/main.py
-
-rem Update the last run file with today's date:
-echo %TODAY% > "%LAST_RUN_FILE%"
-
-:end
 endlocal
@@ -0,0 +1,247 @@
+from run_log import RunLog
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from sqlalchemy import text
+import traceback
+import asyncio
+import json
+import time
+
+
+
+
+#######################################################################################
+############################### SERVICE: ##############################################
+#######################################################################################
+
+# 'python main.py serve' - one long-running process instead of a scheduled cold start (replaces the .bat loop):
+#   * the engine & its connection pool, the price provider (cache, rate limiter), the imported libraries, a chart worker pool
+#     and the report data & charts of the last run stay loaded between runs
+#   * runs are scheduled per exchange close (SERVICE_EXCHANGES): a trading day is processed once every configured exchange has
+#     closed and the day has ended locally (the pipeline stores completed days), plus SERVICE_RUN_DELAY_MINUTES
+#   * a run only does the stages whose inputs changed: nothing without a new day, charts are reused while their data is the
+#     same (ReportCache), Telegram only for new data or a forced run
+#   * HTTP endpoint (SERVICE_HOST:SERVICE_PORT, JSON):
+#       GET  /health          - 200 if the database answers & the last run didn't fail, 503 otherwise
+#       GET  /status          - state, next scheduled run, last run (stages & timings), runs so far
+#       POST /run[?force=1]   - run now, force=1 sends the reports even without new data
+# Every run is written to the run log like a 'python main.py' run (command 'service').
+
+HTTP_REASONS = {200: 'OK', 202: 'Accepted', 404: 'Not Found', 409: 'Conflict', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def next_run_time(now, exchanges, delay_minutes=30):
+    # now: aware local time. Earliest run of a trading day (Mon-Fri) that is still ahead:
+    # max(close of every exchange that day, end of the local day) + delay
+    for offset in range(-1, 8):
+        day = now.date() + timedelta(days=offset)
+        if day.weekday() >= 5:
+            continue
+        closes = [datetime.combine(day, datetime.strptime(close, '%H:%M').time(), tzinfo=ZoneInfo(time_zone))
+                  for time_zone, close in exchanges.values()]
+        day_end = datetime.combine(day + timedelta(days=1), datetime.min.time()).astimezone()
+        due = max(closes + [day_end]) + timedelta(minutes=delay_minutes)
+        if due > now:
+            return due.astimezone(now.tzinfo)
+
+
+def local_now():
+    return datetime.now().astimezone()
+
+
+
+#######################################################################################
+############################### WARM REPORT STATE: ####################################
+#######################################################################################
+
+
+sql_data_version = text('''
+                SELECT
+                    (SELECT MAX(dt) FROM portfolio_history) AS history_dt,
+                    (SELECT COUNT(*) FROM portfolio_history) AS history_rows,
+                    (SELECT COUNT(*) FROM changes) AS changes,
+                    (SELECT COUNT(*) FROM stocks) AS stocks''')
+
+
+class ReportCache:
+
+    # Report data & charts of the last run, valid while the data they were drawn from is unchanged (one cheap query),
+    # and the worker pool the charts are drawn on, kept alive between runs
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.version = None
+        self.report_data = None
+        self.charts = None
+
+
+    @staticmethod
+    def data_version(engine):
+        with engine.connect() as connection:
+            return tuple(str(value) for value in connection.execute(sql_data_version).fetchone())
+
+
+    def lookup(self, engine):
+        if self.charts is not None and self.data_version(engine) == self.version:
+            return self.charts
+        return None
+
+
+    def store(self, engine, report_data, charts):
+        self.version = self.data_version(engine)
+        self.report_data = report_data
+        self.charts = charts
+
+
+
+#######################################################################################
+############################### SCHEDULER & STATUS ENDPOINT: ##########################
+#######################################################################################
+
+
+class PortfolioService:
+
+    # pipeline(run_log, report_cache, force) -> True if new data was processed, runs in a worker thread so that the
+    # endpoint keeps answering during a run
+    def __init__(self, engine, pipeline, exchanges, delay_minutes=30, host='127.0.0.1', port=8765, run_log_path=None, report_cache=None):
+        self.engine = engine
+        self.pipeline = pipeline
+        self.exchanges = exchanges
+        self.delay_minutes = delay_minutes
+        self.host = host
+        self.port = port
+        self.run_log_path = run_log_path
+        self.report_cache = report_cache or ReportCache()
+
+        self.started_at = local_now()
+        self.state = 'starting'
+        self.next_run = None
+        self.current_run = None
+        self.last_run = None
+        self.runs = 0
+        self.force = False
+        self.trigger = None
+        self.lock = None
+
+
+    def run_once(self, reason, force=False):
+        run_log = RunLog(self.run_log_path, None, 'service')
+        record = {'run_id': run_log.run_id, 'reason': reason, 'force': force, 'started_at': local_now().isoformat(timespec='seconds'),
+                  'status': 'running'}
+        self.current_run = record
+        start = time.perf_counter()
+        try:
+            with run_log.span('run', reason=reason) as span:
+                span['updated'] = record['updated'] = self.pipeline(run_log, self.report_cache, force)
+            record['status'] = 'ok'
+        except Exception as e:
+            # a failed run is reported by /health & /status, the service keeps its schedule
+            record['status'] = 'error'
+            record['error'] = f'{type(e).__name__}: {e}'
+            traceback.print_exc()
+
+        record['seconds'] = round(time.perf_counter() - start, 3)
+        record['stages'] = {span['stage']: span['seconds'] for span in run_log.spans if span['parent'] == 'run'}
+        self.current_run = None
+        self.last_run = record
+        self.runs += 1
+        print(run_log.summary())
+
+
+    async def run(self, reason, force=False):
+        async with self.lock:
+            self.state = 'running'
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.run_once, reason, force)
+            finally:
+                self.state = 'idle'
+
+
+    async def scheduler(self):
+        # Catch up on the days missed while the service was down, then wait for the next close or a manual trigger
+        await self.run('startup')
+        while True:
+            self.next_run = next_run_time(local_now(), self.exchanges, self.delay_minutes)
+            print(f"Next run: {self.next_run:%Y-%m-%d %H:%M %Z}")
+            reason = 'schedule'
+            while (remaining := (self.next_run - local_now()).total_seconds()) > 0:
+                try:
+                    # woken up at least hourly, so a changed clock (sleep, DST) doesn't delay the run
+                    await asyncio.wait_for(self.trigger.wait(), timeout=min(remaining, 3600))
+                    reason = 'manual'
+                    break
+                except asyncio.TimeoutError:
+                    pass
+
+            force = reason == 'manual' and self.force
+            self.trigger.clear()
+            self.force = False
+            await self.run(reason, force)
+
+
+    def status(self):
+        return {
+            'state': self.state,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'next_run': self.next_run.isoformat(timespec='seconds') if self.next_run else None,
+            'runs': self.runs,
+            'current_run': self.current_run,
+            'last_run': self.last_run,
+            'charts_cached': self.report_cache.charts is not None,
+            'data_version': self.report_cache.version,
+        }
+
+
+    def health(self):
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            database = 'ok'
+        except Exception as e:
+            database = f'{type(e).__name__}: {e}'
+        last_status = self.last_run['status'] if self.last_run else None
+        healthy = database == 'ok' and last_status != 'error'
+        return (200 if healthy else 503), {'status': 'ok' if healthy else 'unhealthy', 'database': database, 'last_run': last_status}
+
+
+    async def route(self, method, path, query):
+        if method == 'GET' and path == '/health':
+            return await asyncio.get_running_loop().run_in_executor(None, self.health)
+        if method == 'GET' and path == '/status':
+            return 200, self.status()
+        if method == 'POST' and path == '/run':
+            if self.state == 'running' or self.trigger.is_set():
+                return 409, {'status': 'already running', 'current_run': self.current_run}
+            self.force = 'force=1' in query.split('&')
+            self.trigger.set()
+            return 202, {'status': 'triggered', 'force': self.force}
+        return 404, {'error': f'unknown endpoint {method} {path}'}
+
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1: request line, headers skipped, JSON response, connection closed
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            method, target = request_line[:2] if len(request_line) >= 2 else ('', '')
+            path, _, query = target.partition('?')
+            status, body = await self.route(method, path.rstrip('/') or '/', query)
+        except Exception as e:
+            status, body = 500, {'error': f'{type(e).__name__}: {e}'}
+
+        payload = json.dumps(body, default=str, indent=2).encode()
+        writer.write(f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+    async def serve(self):
+        self.trigger = asyncio.Event()
+        self.lock = asyncio.Lock()
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Service listening on http://{self.host}:{self.port} (GET /health, GET /status, POST /run[?force=1])")
+        async with server:
+            await self.scheduler()
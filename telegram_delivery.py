@@ -0,0 +1,164 @@
+from telegram import Bot, InputMediaPhoto
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+import threading
+import asyncio
+import json
+import time
+
+
+
+
+#######################################################################################
+############################### TELEGRAM SENDER: ######################################
+#######################################################################################
+
+# Sends the messages of one update concurrently. Every message is retried on its own:
+#   * RetryAfter (flood control) - waits as long as Telegram asks
+#   * other network errors & timeouts - exponential backoff (backoff_seconds * 2^attempt)
+#   * BadRequest (wrong chat id, too long message, ...) - not retried
+# A message that still fails is reported instead of raised, so a failed delivery doesn't fail the whole run.
+
+
+class TelegramSender:
+
+    def __init__(self, token, chat_id, base_url=None, max_retries=3, backoff_seconds=1.0):
+        self.bot = Bot(token=token, base_url=base_url) if base_url else Bot(token=token)
+        self.chat_id = chat_id
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+
+
+    def build_deliveries(self, text_messages, charts):
+        # text_messages: list of texts, charts: {file name: PNG bytes} sent as one media group -> [(label, send method, kwargs)]
+        deliveries = [('message', self.bot.send_message, {'text': text}) for text in text_messages if text]
+        if charts:
+            media = [InputMediaPhoto(png, caption=file_name) for file_name, png in charts.items()]
+            deliveries.append(('charts', self.bot.send_media_group, {'media': media}))
+        return deliveries
+
+
+    async def send_update(self, text_messages, charts):
+        deliveries = self.build_deliveries(text_messages, charts)
+
+        async with self.bot:
+            results = await asyncio.gather(*[self.send_with_retries(label, send, kwargs)
+                                             for label, send, kwargs in deliveries], return_exceptions=True)
+
+        failures = [f'{label}: {result}' for (label, _, _), result in zip(deliveries, results)
+                    if isinstance(result, Exception)]
+        for failure in failures:
+            print(f"Telegram delivery failed - {failure}")
+        return failures
+
+
+    async def send_with_retries(self, label, send, kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await send(chat_id=self.chat_id, **kwargs)
+            except BadRequest:
+                raise
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                wait_time = retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+            except NetworkError:
+                if attempt == self.max_retries:
+                    raise
+                wait_time = self.backoff_seconds * 2 ** attempt
+
+            print(f"Telegram {label} failed (attempt {attempt + 1}), retrying in {wait_time}s")
+            await asyncio.sleep(wait_time)
+
+
+
+#######################################################################################
+############################### LOCAL STUB BOT API: ###################################
+#######################################################################################
+
+# Minimal Bot API server for running the delivery offline, point the sender at it with base_url=stub.base_url.
+# Every request is recorded as (method, raw body); the first 'fail_first' sendMessage/sendMediaGroup calls answer
+# with 'fail_status' (502 = network error, 429 = flood control, 400 = bad request) to exercise the retries.
+#
+#   with StubBotServer(fail_first=2) as stub:
+#       asyncio.run(TelegramSender('123:abc', 1, base_url=stub.base_url, backoff_seconds=0).send_update(['hi'], {}))
+#       stub.calls('sendMessage')
+
+
+class StubBotServer:
+
+    def __init__(self, fail_first=0, fail_status=502, retry_after=1, delay_seconds=0):
+        self.requests = []
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.retry_after = retry_after
+        self.delay_seconds = delay_seconds
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/bot'
+
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def calls(self, method):
+        return [body for name, body in self.requests if name == method]
+
+
+    def respond(self, method, body):
+        with self.lock:
+            self.requests.append((method, body))
+            failing = method != 'getMe' and self.fail_first > 0
+            if failing:
+                self.fail_first -= 1
+            message_id = len(self.requests)
+
+        if self.delay_seconds:
+            time.sleep(self.delay_seconds)
+
+        if failing:
+            error = {'ok': False, 'error_code': self.fail_status, 'description': 'Stub failure'}
+            if self.fail_status == 429:
+                error['parameters'] = {'retry_after': self.retry_after}
+            return self.fail_status, error
+
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}}
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+        elif method == 'sendMediaGroup':
+            result = [message]
+        else:
+            result = message
+        return 200, {'ok': True, 'result': result}
+
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, payload = stub.respond(self.path.rsplit('/', 1)[-1], body)
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
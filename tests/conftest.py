@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The scripts are flat top-level modules, importable from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'slow: full size comparisons, deselect with -m "not slow"')
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+import analytics
+import storage
+from alert_rules import DrawdownRule, evaluate_alerts
+from benchmarks.synthetic import build_database
+from intraday import IntradayPortfolio, last_history_dt
+
+
+RULES = [DrawdownRule('drawdown_10', 0.10, 'DRAWDOWN ALERT: {drawdown:.1%} below its peak.')]
+
+
+def portfolio(tmp_path, closes, trades):
+    # One stock with the given business day closes (ending yesterday) & (day index, shares) trades at that day's close
+    dates = pd.bdate_range(end=datetime.now().date() - timedelta(days=1), periods=len(closes)).date
+    prices = pd.DataFrame({'dt': dates, 'ticker': 'AAA', 'end_price': closes})
+    prices.to_csv(tmp_path / 'prices.csv', index=False)
+    changes = pd.DataFrame({'name': 'Stock A', 'ticker': 'AAA', 'price': [closes[day] for day, _ in trades],
+                            'share': [float(share) for _, share in trades], 'dt': [dates[day] for day, _ in trades]})
+
+    engine = storage.make_engine(f"sqlite:///{tmp_path / 'portfolio.sqlite'}")
+    build_database(engine, str(tmp_path / 'prices.csv'), changes)
+    with engine.begin() as connection:
+        analytics.update_analytics(connection)
+    return engine
+
+
+def test_sale_does_not_fire_the_alert(tmp_path):
+    engine = portfolio(tmp_path, [100.0] * 40, [(0, 100), (20, -60)])
+
+    with engine.begin() as connection:
+        values = connection.execute(text('SELECT MAX(total_value), MIN(total_value) FROM portfolio_daily')).fetchone()
+        assert values[1] / values[0] < 0.5
+        assert evaluate_alerts(connection, RULES) == []
+
+        # intraday the positions after the sale are valued on top of the same time-weighted return
+        snapshot = IntradayPortfolio.load(connection, last_history_dt(connection)).snapshot(datetime.now().date())
+        assert snapshot.portfolio['drawdown'] == 0
+
+
+def test_price_fall_fires_once(tmp_path):
+    closes = [100.0] * 30 + [85.0] * 10
+    engine = portfolio(tmp_path, closes, [(0, 100), (20, -60)])
+
+    with engine.begin() as connection:
+        assert evaluate_alerts(connection, RULES) == ['DRAWDOWN ALERT: 15.0% below its peak.']
+        assert evaluate_alerts(connection, RULES) == []
+
+
+def test_intraday_fall_continues_the_time_weighted_return(tmp_path):
+    engine = portfolio(tmp_path, [100.0] * 40, [(0, 100), (20, -60)])
+
+    with engine.begin() as connection:
+        intraday = IntradayPortfolio.load(connection, last_history_dt(connection))
+    intraday.apply_quotes(pd.DataFrame({'ticker': ['AAA'], 'ts': [pd.Timestamp.now()], 'price': [88.0]}))
+
+    snapshot = intraday.snapshot(datetime.now().date())
+    assert np.isclose(snapshot.portfolio['drawdown'], 0.12)
+    assert RULES[0].evaluate(snapshot)['active'].tolist() == [True]
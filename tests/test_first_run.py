@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+from sqlalchemy import text
+
+import main
+import storage
+from price_providers import FixturePriceProvider
+from run_log import RunLog
+
+
+def first_run(tmp_path, monkeypatch, changes):
+    # init-db on an empty SQLite file, then one daily run with 'changes' in the drop directory
+    dates = pd.bdate_range(end=datetime.now().date() - timedelta(days=1), periods=30).date
+    pd.DataFrame({'dt': dates, 'ticker': 'AAA', 'end_price': 100.0}).to_csv(tmp_path / 'prices.csv', index=False)
+    (tmp_path / main.CHANGES_DROP_DIRECTORY).mkdir()
+    if changes is not None:
+        changes.to_csv(tmp_path / main.CHANGES_DROP_DIRECTORY / 'changes.csv', index=False)
+    monkeypatch.setattr(main, 'BASE_DIRECTORY', f'{tmp_path}/')
+
+    engine = storage.make_engine(f"sqlite:///{tmp_path / 'portfolio.sqlite'}")
+    main.init_db(engine)
+    assert main.update_database(engine, FixturePriceProvider(str(tmp_path / 'prices.csv')), RunLog())
+    return engine
+
+
+def test_history_starts_on_the_first_change(tmp_path, monkeypatch):
+    first_day = datetime.now().date() - timedelta(days=20)
+    changes = pd.DataFrame({'name': 'Stock A', 'ticker': 'AAA', 'price': 100.0, 'share': 10, 'date': [first_day.isoformat()]})
+    engine = first_run(tmp_path, monkeypatch, changes)
+
+    with engine.connect() as connection:
+        first, last, rows = connection.execute(text('SELECT MIN(dt), MAX(dt), COUNT(*) FROM portfolio_history')).fetchone()
+    # every calendar day from the change until yesterday
+    assert (first, last, rows) == (str(first_day), str(datetime.now().date() - timedelta(days=1)), 20)
+    assert not (tmp_path / main.CHANGES_DROP_DIRECTORY / 'changes.csv').exists()
+
+
+def test_no_changes_yet(tmp_path, monkeypatch):
+    engine = first_run(tmp_path, monkeypatch, None)
+
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT COUNT(*) FROM portfolio_history')).scalar() == 0
@@ -0,0 +1,99 @@
+import functions as f
+from price_providers import PriceProvider, PRICE_COLUMNS
+from itertools import product
+from datetime import datetime, timedelta
+import pandas as pd
+import numpy as np
+import pytest
+
+
+
+
+#######################################################################################
+############################### PRICE GRID ASSEMBLY: ##################################
+#######################################################################################
+
+# get_stock_info builds the (ticker, day) grid with one reindex & grouped fills. It has to give the same rows as the
+# per-ticker merge & loop it replaced (copied below) and never carry a price from one ticker into another.
+
+
+class FramePriceProvider(PriceProvider):
+
+    def __init__(self, prices):
+        self.prices = prices
+
+    def fetch(self, tickers, start, end):
+        mask = self.prices['ticker'].isin(tickers) & (self.prices['dt'] >= start) & (self.prices['dt'] < end)
+        return self.prices.loc[mask, PRICE_COLUMNS].reset_index(drop=True)
+
+
+def previous_get_stock_info(active_stocks, last_day, price_provider):
+    # get_stock_info before the vectorized grid (row merges & one mask per ticker), without the prints
+    next_day = last_day + timedelta(days=1)
+    end_date = datetime.now().date()
+    update_dates = [d.date() for d in pd.date_range(start=next_day, end=end_date - timedelta(days=1)).to_pydatetime().tolist()]
+
+    tickers = active_stocks['ticker'].tolist()
+    all_stocks_df = price_provider.fetch(tickers, last_day, end_date)
+    all_stocks_df.reset_index(drop=True, inplace=True)
+
+    all_dates_df = pd.DataFrame(list(product(tickers, update_dates)), columns=['ticker', 'dt'])
+    all_dates_and_named_df = all_dates_df.merge(active_stocks[['ticker', 'name']], on=['ticker'], how='left')
+    all_dates_and_updates = all_dates_and_named_df.merge(all_stocks_df, on=['ticker', 'dt'], how='left')
+
+    for ticker in tickers:
+        current_price = active_stocks[active_stocks['ticker'] == ticker]['price'].iloc[0]
+        earliest_date_mask = (all_dates_and_updates['ticker'] == ticker) & \
+                             (all_dates_and_updates['dt'] == all_dates_and_updates['dt'].min())
+        all_dates_and_updates.loc[earliest_date_mask & all_dates_and_updates['end_price'].isna(), 'end_price'] = current_price
+
+    all_dates_and_updates['end_price'] = all_dates_and_updates.groupby('ticker')['end_price'].ffill().bfill()
+    return all_dates_and_updates
+
+
+def synthetic_market(tickers, days, seed=0):
+    # Weekday closes with random gaps (holidays, missing quotes) & the active stocks with their last known price
+    rng = np.random.default_rng(seed)
+    last_day = datetime.now().date() - timedelta(days=days + 1)
+    dates = [d.date() for d in pd.bdate_range(last_day, datetime.now().date() - timedelta(days=1))]
+    names = [f'TCK{i:04d}' for i in range(tickers)]
+
+    prices = pd.DataFrame(list(product(names, dates)), columns=['ticker', 'dt'])
+    prices['end_price'] = rng.uniform(1, 500, len(prices))
+    prices = prices[rng.random(len(prices)) > 0.1].reset_index(drop=True)
+
+    active_stocks = pd.DataFrame({'id': range(tickers), 'name': [f'Stock {i}' for i in range(tickers)], 'ticker': names,
+                                  'price': rng.uniform(1, 500, tickers), 'share': 1.0})
+    return active_stocks, last_day, prices
+
+
+# 1,000 tickers x 2 years is the size the vectorized grid was written for, skip it with -m "not slow"
+@pytest.mark.parametrize('tickers', [200, pytest.param(1000, marks=pytest.mark.slow)])
+def test_same_rows_as_previous_implementation(tickers):
+    active_stocks, last_day, prices = synthetic_market(tickers=tickers, days=730)
+    provider = FramePriceProvider(prices)
+
+    expected = previous_get_stock_info(active_stocks, last_day, provider)
+    result = f.get_stock_info(active_stocks, last_day, provider)
+
+    columns = ['ticker', 'dt', 'name', 'end_price']
+    expected = expected[columns].sort_values(['ticker', 'dt']).reset_index(drop=True)
+    result = result[columns].sort_values(['ticker', 'dt']).reset_index(drop=True)
+    assert len(result) == tickers * 730
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_prices_are_filled_within_each_ticker_only():
+    last_day = datetime.now().date() - timedelta(days=6)
+    days = [last_day + timedelta(days=i) for i in range(1, 6)]
+    active_stocks = pd.DataFrame({'id': [1, 2, 3], 'name': ['A', 'B', 'C'], 'ticker': ['AAA', 'BBB', 'CCC'],
+                                  'price': [10.0, np.nan, 30.0], 'share': 1.0})
+    prices = pd.DataFrame({'dt': [days[1], days[3], days[0]], 'end_price': [11.0, 12.0, 31.0], 'ticker': ['AAA', 'AAA', 'CCC']})
+
+    result = f.get_stock_info(active_stocks, last_day, FramePriceProvider(prices)).set_index(['ticker', 'dt'])['end_price']
+
+    # carried forward from the ticker's own closes, the first day falls back to its current price
+    assert result.loc['AAA'].tolist() == [10.0, 11.0, 11.0, 12.0, 12.0]
+    assert result.loc['CCC'].tolist() == [31.0] * 5
+    # no close & no current price: stays empty instead of taking a neighbour's price
+    assert result.loc['BBB'].isna().all()
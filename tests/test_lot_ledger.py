@@ -0,0 +1,131 @@
+from lot_ledger import LotLedger
+from datetime import date, timedelta
+import pandas as pd
+import numpy as np
+import pytest
+
+
+
+
+#######################################################################################
+############################### FIFO LOT LEDGER: ######################################
+#######################################################################################
+
+# The vectorized ledger (cumsum / running minimum / searchsorted) against a plain row by row FIFO queue.
+
+
+def changes_frame(rows):
+    # rows: (ticker, price, share, dt)
+    return pd.DataFrame(rows, columns=['ticker', 'price', 'share', 'dt'])
+
+
+def naive_fifo(records, changes):
+    # Row by row FIFO: holdings & invested after every change, (shares sold, cost basis) of every sale
+    books = {}
+    for ticker, price, share, dt in records.sort_values('dt', kind='stable')[['ticker', 'price', 'share', 'dt']].itertuples(index=False):
+        books.setdefault(ticker, []).append([price, share])
+
+    holdings, invested, sales = [], [], []
+    for ticker, price, share, dt in changes[['ticker', 'price', 'share', 'dt']].itertuples(index=False):
+        lots = books.setdefault(ticker, [])
+        if share > 0:
+            lots.append([price, share])
+        else:
+            to_sell = sum(lot[1] for lot in lots) if share == 0 else -share
+            sold, cost = 0.0, 0.0
+            while to_sell - sold > 1e-9:
+                take = min(lots[0][1], to_sell - sold)
+                sold += take
+                cost += take * lots[0][0]
+                lots[0][1] -= take
+                if lots[0][1] < 1e-9:
+                    lots.pop(0)
+            sales.append((sold, cost))
+        holdings.append(sum(lot[1] for lot in lots))
+        invested.append(sum(lot[0] * lot[1] for lot in lots))
+    return np.array(holdings), np.array(invested), sales
+
+
+def assert_matches_naive(records, changes):
+    expected_holdings, expected_invested, expected_sales = naive_fifo(records, changes)
+    result = LotLedger(records).apply(changes)
+
+    np.testing.assert_allclose(result.holdings, expected_holdings, atol=1e-6)
+    np.testing.assert_allclose(result.invested, expected_invested, atol=1e-6)
+    realized = result.realized.sort_values('change')
+    np.testing.assert_allclose(realized['shares_sold'].astype(float), [sold for sold, _ in expected_sales], atol=1e-6)
+    np.testing.assert_allclose(realized['cost_basis'].astype(float), [cost for _, cost in expected_sales], atol=1e-6)
+    return result
+
+
+def test_partial_sale_spans_lots():
+    records = changes_frame([('AAA', 10.0, 5.0, date(2024, 1, 2)), ('AAA', 20.0, 5.0, date(2024, 2, 1))])
+    changes = changes_frame([('AAA', 30.0, -7.0, date(2024, 3, 1))])
+
+    result = assert_matches_naive(records, changes)
+
+    sale = result.realized.iloc[0]
+    assert sale['shares_sold'] == 7 and sale['cost_basis'] == 5 * 10 + 2 * 20
+    assert sale['realized_gain'] == 7 * 30 - 90
+    assert result.holdings.tolist() == [3.0] and result.invested.tolist() == [60.0]
+    changed = result.changed_lots.set_index('status')
+    assert changed.loc['removed', 'price'] == 10 and changed.loc['updated', 'share'] == 3
+
+
+def test_sell_all_empties_the_book():
+    records = changes_frame([('AAA', 10.0, 2.0, date(2024, 1, 2))])
+    changes = changes_frame([('AAA', 12.0, 3.0, date(2024, 1, 5)), ('AAA', 15.0, 0.0, date(2024, 1, 9))])
+
+    result = assert_matches_naive(records, changes)
+
+    assert result.holdings.tolist() == [5.0, 0.0] and result.invested.tolist() == [56.0, 0.0]
+    assert result.realized['shares_sold'].tolist() == [5.0]
+    assert result.changed_lots['status'].tolist() == ['removed']
+
+
+def test_same_day_changes_in_given_order():
+    day = date(2024, 4, 2)
+    changes = changes_frame([('AAA', 10.0, 4.0, day), ('AAA', 11.0, -3.0, day), ('AAA', 12.0, 2.0, day),
+                             ('AAA', 13.0, -2.0, day), ('BBB', 50.0, 1.0, day)])
+
+    result = assert_matches_naive(changes_frame([]), changes)
+
+    assert result.holdings.tolist() == [4.0, 1.0, 3.0, 1.0, 1.0]
+    assert result.realized['cost_basis'].tolist() == [30.0, 10.0 + 12.0]
+    assert sorted(result.changed_lots['ticker']) == ['AAA', 'BBB']
+
+
+def test_overselling_is_rejected():
+    records = changes_frame([('AAA', 10.0, 2.0, date(2024, 1, 2))])
+    changes = changes_frame([('AAA', 12.0, 1.0, date(2024, 1, 5)), ('AAA', 15.0, -4.0, date(2024, 1, 9))])
+
+    with pytest.raises(ValueError, match='Cannot sell 4 shares of AAA on 2024-01-09: only 3 held'):
+        LotLedger(records).apply(changes)
+    with pytest.raises(ValueError):
+        LotLedger().apply(changes_frame([('BBB', 15.0, -1.0, date(2024, 1, 9))]))
+
+
+def test_random_sequences_match_naive_fifo():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        tickers = ['AAA', 'BBB', 'CCC'][:rng.integers(1, 4)]
+        start = date(2024, 1, 1)
+        records = changes_frame([(rng.choice(tickers), float(rng.integers(1, 100)), float(rng.integers(1, 10)),
+                                  start - timedelta(days=int(rng.integers(1, 30)))) for _ in range(rng.integers(0, 5))])
+
+        held = records.groupby('ticker')['share'].sum().to_dict()
+        rows = []
+        for day in range(rng.integers(1, 25)):
+            ticker = rng.choice(tickers)
+            price = float(rng.integers(1, 100))
+            action = rng.random()
+            if action < 0.5 or held.get(ticker, 0) == 0:
+                share = float(rng.integers(1, 10)) / rng.choice([1, 2, 4])
+            elif action < 0.85:
+                share = -float(rng.uniform(0, held[ticker]))
+            else:
+                share = 0.0
+            held[ticker] = 0 if share == 0 else held.get(ticker, 0) + share
+            rows.append((ticker, price, share, start + timedelta(days=day // 3)))
+
+        assert_matches_naive(records, changes_frame(rows))
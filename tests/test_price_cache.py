@@ -0,0 +1,58 @@
+from datetime import date, timedelta
+
+import pandas as pd
+
+from price_providers import PRICE_COLUMNS, CachedPriceProvider, PriceProvider, empty_prices
+
+
+class ScriptedPriceProvider(PriceProvider):
+    # Answers each fetch with the next scripted frame (filtered to the request), recording every request
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def fetch(self, tickers, start, end):
+        self.requests.append((sorted(tickers), start, end))
+        prices = self.responses.pop(0)
+        mask = prices['ticker'].isin(tickers) & (prices['dt'] >= start) & (prices['dt'] < end)
+        return prices.loc[mask, PRICE_COLUMNS].reset_index(drop=True)
+
+
+def closes(ticker, days):
+    return pd.DataFrame({'dt': days, 'end_price': [100.0 + i for i in range(len(days))], 'ticker': ticker})
+
+
+START = date.today() - timedelta(days=40)
+END = START + timedelta(days=10)
+DAYS = [START + timedelta(days=i) for i in range(10)]
+
+
+def test_empty_response_is_requested_again(tmp_path):
+    prices = pd.concat([closes('AAA', DAYS), closes('BBB', DAYS)], ignore_index=True)
+    provider = ScriptedPriceProvider([empty_prices(), prices])
+    cache = CachedPriceProvider(provider, tmp_path / 'prices.sqlite')
+
+    assert cache.fetch(['AAA', 'BBB'], START, END).empty
+    second = cache.fetch(['AAA', 'BBB'], START, END)
+
+    assert provider.requests == [(['AAA', 'BBB'], START, END)] * 2
+    assert len(second) == 20
+
+    # now everything is cached
+    assert len(cache.fetch(['AAA', 'BBB'], START, END)) == 20
+    assert len(provider.requests) == 2
+
+
+def test_only_days_up_to_the_latest_close_are_stored(tmp_path):
+    # AAA has closes on days 0, 2 & 5 only, BBB returns nothing
+    partial = closes('AAA', [DAYS[0], DAYS[2], DAYS[5]])
+    complete = pd.concat([closes('AAA', DAYS), closes('BBB', DAYS)], ignore_index=True)
+    provider = ScriptedPriceProvider([partial, complete, complete])
+    cache = CachedPriceProvider(provider, tmp_path / 'prices.sqlite')
+
+    assert len(cache.fetch(['AAA', 'BBB'], START, END)) == 3
+    cache.fetch(['AAA', 'BBB'], START, END)
+
+    # days 1, 3 & 4 of AAA are stored without a close, days after 5 & all of BBB are requested again
+    assert sorted(provider.requests[1:]) == [(['AAA'], DAYS[6], END), (['BBB'], START, END)]
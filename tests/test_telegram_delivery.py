@@ -0,0 +1,68 @@
+from telegram_delivery import TelegramSender, StubBotServer
+import asyncio
+
+
+
+
+#######################################################################################
+############################### TELEGRAM SENDER: ######################################
+#######################################################################################
+
+# TelegramSender against the local StubBotServer: retries on network errors & flood control, none on bad requests,
+# failures reported instead of raised.
+
+TOKEN = '123456:test'
+
+
+def send(stub, text_messages, charts=None, max_retries=3):
+    sender = TelegramSender(TOKEN, 1, base_url=stub.base_url, max_retries=max_retries, backoff_seconds=0)
+    return asyncio.run(sender.send_update(text_messages, charts or {}))
+
+
+def test_delivers_messages_and_charts():
+    with StubBotServer() as stub:
+        failures = send(stub, ['summary', 'alerts'], {'growth.png': b'\x89PNG'})
+
+    assert failures == []
+    assert len(stub.calls('sendMessage')) == 2
+    assert len(stub.calls('sendMediaGroup')) == 1
+
+
+def test_network_errors_are_retried():
+    with StubBotServer(fail_first=2, fail_status=502) as stub:
+        failures = send(stub, ['summary'])
+
+    assert failures == []
+    assert len(stub.calls('sendMessage')) == 3
+
+
+def test_flood_control_is_retried():
+    with StubBotServer(fail_first=1, fail_status=429, retry_after=0) as stub:
+        failures = send(stub, ['summary'])
+
+    assert failures == []
+    assert len(stub.calls('sendMessage')) == 2
+
+
+def test_bad_request_is_not_retried():
+    with StubBotServer(fail_first=1, fail_status=400) as stub:
+        failures = send(stub, ['summary'])
+
+    assert len(stub.calls('sendMessage')) == 1
+    assert len(failures) == 1 and failures[0].startswith('message: ')
+
+
+def test_failure_reported_after_all_retries():
+    with StubBotServer(fail_first=10, fail_status=502) as stub:
+        failures = send(stub, ['summary'], max_retries=2)
+
+    assert len(stub.calls('sendMessage')) == 3
+    assert len(failures) == 1 and failures[0].startswith('message: ')
+
+
+def test_one_failed_delivery_does_not_stop_the_others():
+    with StubBotServer(fail_first=1, fail_status=400) as stub:
+        failures = send(stub, ['summary'], {'growth.png': b'\x89PNG'})
+
+    assert len(failures) == 1
+    assert len(stub.calls('sendMessage')) + len(stub.calls('sendMediaGroup')) == 2